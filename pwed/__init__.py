@@ -30,13 +30,11 @@ This modules contains classes related with EM
 """
 
 import os
+import logging
 
 import pyworkflow as pw
 import pyworkflow.utils as pwutils
 import pyworkflow.plugin as pwplugin
-from pyworkflow.viewer import Viewer
-from pyworkflow.wizard import Wizard
-from pyworkflow.protocol import Protocol, HostConfig
 
 from .constants import *
 from .objects import EdBaseObject
@@ -44,14 +42,50 @@ from .objects import EdBaseObject
 
 __version__ = '3.0.1a2'
 
+logger = logging.getLogger(__name__)
+
 
 class Domain(pwplugin.Domain):
     _name = __name__
     _objectClass = EdBaseObject
-    _protocolClass = Protocol
-    _viewerClass = Viewer
-    _wizardClass = Wizard
     _baseClasses = globals()
+    _mapperDict = None
+
+    @classmethod
+    def registerPlugin(cls, name):
+        super().registerPlugin(name)
+        cls.invalidateMapperDict()
+
+    @classmethod
+    def refreshPlugin(cls, name):
+        super().refreshPlugin(name)
+        cls.invalidateMapperDict()
+
+    @classmethod
+    def getMapperDict(cls):
+        """ Return the dictionary of classes used by the mappers.
+        It is built only once, since every set opened needs it,
+        and rebuilt after calling invalidateMapperDict. A copy is
+        returned, so callers can not change the cached one.
+        """
+        if cls._mapperDict is None:
+            # Projects load the mapper before reading the hosts
+            # configuration, so this is the first place where the
+            # ED user data is needed
+            Config.setup()
+            cls._mapperDict = super().getMapperDict()
+        return dict(cls._mapperDict)
+
+    @classmethod
+    def invalidateMapperDict(cls):
+        """ Clear the cached mapper dictionary, for example after
+        new plugins or classes have been registered. The objects and
+        protocols discovered by the base Domain are cleared too, so
+        they are discovered again.
+        """
+        cls._mapperDict = None
+        cls._objects.clear()
+        cls._protocols.clear()
 
 
 class Plugin(pwplugin.Plugin):
@@ -67,24 +101,40 @@ class Config:
     SCIPION_ED_TEST_OUTPUT = os.environ.get('SCIPION_ED_TEST_OUTPUT',
                                             os.path.join(SCIPION_ED_USERDATA, 'Tests'))
 
+    SCIPION_ED_HOSTS = os.path.join(SCIPION_ED_USERDATA, 'hosts.conf')
+
+    # Files with properties of each detector, such as bad pixel masks
+    SCIPION_ED_DETECTORS = os.path.join(SCIPION_ED_USERDATA, 'detectors')
+
+    _setupDone = False
 
-# ----------- Override some pyworkflow config settings ------------------------
+    @classmethod
+    def setup(cls):
+        """ Override some pyworkflow config settings and create the
+        user data folder with a default hosts.conf if they do not exist.
 
-# Create Config.SCIPION_ED_USERDATA if it does not already exist.
-if not os.path.exists(Config.SCIPION_ED_USERDATA):
-    os.mkdir(Config.SCIPION_ED_USERDATA)
-# Create default hosts.conf
-hostsFile = os.path.join(Config.SCIPION_ED_USERDATA, 'hosts.conf')
-if not os.path.exists(hostsFile):
-    HostConfig.writeBasic(hostsFile)
+        This is done on first use and not when importing pwed, so worker
+        processes start fast and do not need a writable home folder.
+        """
+        if cls._setupDone:
+            return
+        cls._setupDone = True
 
+        try:
+            pwutils.makePath(cls.SCIPION_ED_USERDATA)
+            if not os.path.exists(cls.SCIPION_ED_HOSTS):
+                from pyworkflow.protocol import HostConfig
+                HostConfig.writeBasic(cls.SCIPION_ED_HOSTS)
+        except OSError as e:
+            logger.warning("Could not create ED user data at %s: %s"
+                           % (cls.SCIPION_ED_USERDATA, e))
 
-os.environ['SCIPION_VERSION'] = "ED - " + __version__
-os.environ['SCIPION_USER_DATA'] = pw.Config.SCIPION_USER_DATA = Config.SCIPION_ED_USERDATA
-os.environ['SCIPION_HOSTS'] = pw.Config.SCIPION_HOSTS = hostsFile
-os.environ['SCIPION_TESTS_OUTPUT'] = pw.Config.SCIPION_TESTS_OUTPUT = Config.SCIPION_ED_TEST_OUTPUT
+        os.environ['SCIPION_VERSION'] = "ED - " + __version__
+        os.environ['SCIPION_USER_DATA'] = pw.Config.SCIPION_USER_DATA = cls.SCIPION_ED_USERDATA
+        os.environ['SCIPION_HOSTS'] = pw.Config.SCIPION_HOSTS = cls.SCIPION_ED_HOSTS
+        os.environ['SCIPION_TESTS_OUTPUT'] = pw.Config.SCIPION_TESTS_OUTPUT = cls.SCIPION_ED_TEST_OUTPUT
 
-pw.Config.setDomain('pwed')
+        pw.Config.setDomain('pwed')
 
 
 Domain.registerPlugin(__name__)
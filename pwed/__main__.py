@@ -35,6 +35,99 @@ import argparse
 import pwed
 
 
+def _addImportArgs(parser):
+    """ Add arguments shared by the 'import' and 'scan' commands. """
+    _add = parser.add_argument  # short notation
+
+    _add("--pattern", required=True,
+         help="Files pattern, containing the {TI} tag as image identifier "
+              "(e.g. '/data/experiment01/SMV/data/{TI}.img').")
+
+    _add("--threads", type=int, default=1,
+         help="Number of threads used to read the image headers.")
+
+    _add("--skip-images", type=int, default=None, dest='skipImages',
+         help="Mark every N-th image to be ignored during processing.")
+
+    _add("--rotation-axis", default=None, dest='rotationAxis',
+         help="Goniometer rotation axis relative to the image (x,y,z).")
+
+    _add("--overwrite", nargs='*', default=[], metavar='KEY=VALUE',
+         help="Header values to be overwritten (e.g. WAVELENGTH=0.0251).")
+
+    _add("--header-stride", type=int, default=None, dest='headerStride',
+         help="Only read the header of every N-th image and extrapolate "
+              "the starting angle of the others, if consistent.")
+
+
+def _createImporter(args):
+    from pwed.convert import DiffractionImageImporter
+
+    overwrites = dict(o.split('=', 1) for o in args.overwrite)
+    rotationAxis = None
+    if args.rotationAxis:
+        rotationAxis = [float(s) for s in args.rotationAxis.split(',')]
+
+    return DiffractionImageImporter(args.pattern,
+                                    overwrites=overwrites,
+                                    skipImages=args.skipImages,
+                                    rotationAxis=rotationAxis,
+                                    threads=args.threads,
+                                    headerStride=args.headerStride,
+                                    computeStats=getattr(args, 'stats',
+                                                         False))
+
+
+def scanImages(args):
+    """ Print the files matching the pattern and their headers. """
+    from pwed.convert import find_subranges
+
+    importer = _createImporter(args)
+    t0 = time.time()
+    matchingFiles = importer.getMatchingFiles()
+    t1 = time.time()
+    headers = importer.readSweepHeaders(matchingFiles)
+    t2 = time.time()
+
+    tiList = sorted(ti for _, ti in matchingFiles)
+    ranges = ['%d-%d' % r for r in find_subranges(tiList)]
+    print("Pattern: %s" % importer.getPattern())
+    print("Matching files: %d (%0.3f secs)" % (len(matchingFiles), t1 - t0))
+    print("Image identifiers: %s" % ', '.join(ranges))
+    print("Read headers: %d (%0.3f secs)"
+          % (len([h for h in headers if h is not None]), t2 - t1))
+
+    if headers and headers[0]:
+        print("\nFirst header:")
+        for k, v in headers[0].items():
+            print("   %s = %s" % (k, v))
+
+
+def importImages(args):
+    """ Write a SetOfDiffractionImages with the files matching the pattern,
+    without the need of a project.
+    """
+    import pyworkflow.utils as pwutils
+    from pyworkflow.mapper import SqliteDb
+    from pwed.objects import SetOfDiffractionImages
+
+    importer = _createImporter(args)
+    t0 = time.time()
+
+    if not args.resume:
+        pwutils.cleanPath(args.out)
+    SqliteDb.closeConnection(args.out)
+    outputSet = SetOfDiffractionImages(filename=args.out)
+    outputSet.setSkipImages(args.skipImages)
+    n = importer.importImages(outputSet, chunkSize=args.chunkSize)
+    outputSet.write()
+    size = outputSet.getSize()
+    outputSet.close()
+
+    print("Imported %d new or modified images into %s, %d images in total "
+          "(%0.3f secs)" % (n, args.out, size, time.time() - t0))
+
+
 def main():
     parser = argparse.ArgumentParser()
     _add = parser.add_argument  # short notation
@@ -58,8 +151,40 @@ def main():
     #              "(i.e, finished, aborted or failed) before this "
     #              "run will be executed.")
 
+    subparsers = parser.add_subparsers(dest='command')
+
+    scanParser = subparsers.add_parser(
+        'scan', help="Scan the files matching a pattern and read "
+                     "their headers, without writing any output.")
+    _addImportArgs(scanParser)
+
+    importParser = subparsers.add_parser(
+        'import', help="Import the files matching a pattern into a "
+                       "SetOfDiffractionImages sqlite file, without "
+                       "the need of a project or the GUI.")
+    _addImportArgs(importParser)
+    importParser.add_argument("--out", required=True,
+                              help="Output set filename (e.g. set.sqlite). "
+                                   "It will be overwritten if exists, "
+                                   "unless --resume is used.")
+    importParser.add_argument("--resume", action='store_true',
+                              help="Keep the images already in the output "
+                                   "set and only import new or modified "
+                                   "files.")
+    importParser.add_argument("--stats", action='store_true',
+                              help="Compute the intensity statistics of "
+                                   "each image.")
+    importParser.add_argument("--chunk-size", type=int, dest='chunkSize',
+                              default=1000,
+                              help="Number of images imported between "
+                                   "commits to the output set.")
+
     args = parser.parse_args()
 
+    if args.command == 'scan':
+        scanImages(args)
+    elif args.command == 'import':
+        importImages(args)
 
     if args.env:
         print("\nEnvironment:")
@@ -75,6 +200,7 @@ def main():
     if len(sys.argv) == 1:
         # Let's keep the import here to avoid GUI dependencies if not necessary
         from pyworkflow.gui.project import ProjectManagerWindow
+        pwed.Config.setup()
         ProjectManagerWindow().show()
 
 
@@ -24,4 +24,28 @@
 # *
 # **************************************************************************
 
-from .utilities import find_subranges
\ No newline at end of file
+from .utilities import (find_subranges, stageFile, stageFiles, STAGE_COPY,
+                        STAGE_LINK_ABS, STAGE_LINK_REL, STAGE_HARDLINK,
+                        STAGE_REFLINK)
+from . import formats
+from .formats import (ImageReader, registerReader, getReader, readImage,
+                      readImageHeader)
+from .sparse import (SparseFrame, readSparse, sumFrames, addFrames,
+                     hasSparseData)
+from .container import ContainerWriter, ContainerReader, SPARSE
+from .events import (loadEvents, checkSorted, checkInside, binEvents,
+                     writeBinning, EventBinningReader, BINNING_EXTENSION)
+from .remap import (TIMEPIX_QUAD, correctGaps, correctCoordinates,
+                    getCorrectedSize)
+from .processing import (binFrame, reduceFrames, reduceHeader, frameStats,
+                         findPeaks, RollingBackground, getBackgroundBlocks,
+                         PixelStatistics, findBadPixels, saveBadPixelMask,
+                         loadBadPixelMask, storeBadPixelMask,
+                         findBadPixelMaskFile)
+from .geometry import (Geometry, getGeometry, GeometryCache,
+                       getGeometryCache, getResolutionMap, getRadialBins,
+                       findBeamCenter)
+from .radial import (ICE_RINGS, getBinCounts, radialProfile,
+                     findIceRings)
+from .rotation import estimateRotationAxis, getAxisVector
+from .importer import DiffractionImageImporter
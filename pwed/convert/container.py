@@ -0,0 +1,216 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Container to pack all images of a sweep into a single file.
+
+Layout of the file:
+    MAGIC, metadata offset (u64) and length (u64), padded to DATA_OFFSET
+    frames data, one after the other
+    metadata table (JSON)
+
+The metadata contains the data type, shape and codec of the frames, and
+the header, offset and length of each frame. Without compression, all
+frames have the same size and the data can be used as a memory mapped
+stack. Otherwise, each frame is compressed as a separate chunk, or
+stored as a SparseFrame with the 'sparse' codec.
+
+Frames are referenced with a 1-based index, as in image stacks.
+"""
+
+import os
+import bz2
+import json
+import lzma
+import zlib
+import struct
+import functools
+
+import numpy
+
+from pwed.constants import NO_INDEX
+from .formats import ImageReader, registerReader, _pread
+from .sparse import SparseFrame
+
+MAGIC = b'PWEDPACK'
+DATA_OFFSET = 4096
+_PREFIX = struct.Struct('<8sQQ')
+
+# Compression codecs: (compress, decompress)
+CODECS = {'zlib': (zlib.compress, zlib.decompress),
+          'bz2': (bz2.compress, bz2.decompress),
+          'lzma': (lzma.compress, lzma.decompress)}
+
+# Codec to store only the non-zero pixels of the frames
+SPARSE = 'sparse'
+
+
+class ContainerWriter:
+    """ Write frames into a new container file.
+    It can be used as a context manager:
+
+        with ContainerWriter('sweep.edpack', codec='zlib') as writer:
+            for header, data in frames:
+                writer.addFrame(header, data)
+    """
+    def __init__(self, filename, codec=None):
+        if codec not in [None, SPARSE] and codec not in CODECS:
+            raise Exception("Unknown codec '%s', valid ones are: %s"
+                            % (codec, ', '.join(list(CODECS) + [SPARSE])))
+        self._filename = filename
+        self._codec = codec
+        self._frames = []
+        self._dtype = None
+        self._shape = None
+        self._file = open(filename, 'wb')
+        self._file.write(b'\0' * DATA_OFFSET)
+        self._offset = DATA_OFFSET
+
+    def addFrame(self, header, data):
+        """ Append a frame (dense or SparseFrame), return its
+        index in the container.
+        """
+        if isinstance(data, SparseFrame) and self._codec != SPARSE:
+            data = data.toDense()
+        if not isinstance(data, SparseFrame):
+            data = numpy.ascontiguousarray(data)
+        if self._dtype is None:
+            self._dtype, self._shape = data.dtype, data.shape
+        elif data.dtype != self._dtype or data.shape != self._shape:
+            raise Exception("All frames should have type %s and shape %s, "
+                            "got %s and %s" % (self._dtype, self._shape,
+                                               data.dtype, data.shape))
+        if self._codec == SPARSE:
+            if not isinstance(data, SparseFrame):
+                data = SparseFrame.fromDense(data)
+            block = data.toBytes()
+        else:
+            block = data.tobytes()
+            if self._codec is not None:
+                block = CODECS[self._codec][0](block)
+        self._file.write(block)
+        self._frames.append({'header': header or {},
+                             'offset': self._offset,
+                             'length': len(block)})
+        self._offset += len(block)
+        return len(self._frames)
+
+    def close(self):
+        """ Write the metadata table and close the file. """
+        meta = json.dumps({
+            'dtype': self._dtype.str if self._dtype is not None else None,
+            'shape': list(self._shape or []),
+            'codec': self._codec,
+            'frames': self._frames
+        }).encode()
+        self._file.write(meta)
+        self._file.seek(0)
+        self._file.write(_PREFIX.pack(MAGIC, self._offset, len(meta)))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+
+@functools.lru_cache(maxsize=32)
+def _loadMetadata(filename, size, mtime):
+    magic, offset, length = _PREFIX.unpack(_pread(filename, _PREFIX.size))
+    if magic != MAGIC:
+        raise Exception("%s is not an image container." % filename)
+    return json.loads(_pread(filename, length, offset))
+
+
+@functools.lru_cache(maxsize=32)
+def _loadStack(filename, size, mtime, dtype, shape):
+    return numpy.memmap(filename, dtype=dtype, mode='r', offset=DATA_OFFSET,
+                        shape=shape)
+
+
+def _fileKey(filename):
+    st = os.stat(filename)
+    return os.path.abspath(filename), st.st_size, st.st_mtime_ns
+
+
+@registerReader
+class ContainerReader(ImageReader):
+    """ Reader for the images packed into a container. """
+    EXTENSIONS = ['.edpack']
+
+    def readMetadata(self, filename):
+        """ Return the metadata table of the container. It is
+        cached until the file is modified.
+        """
+        return _loadMetadata(*_fileKey(filename))
+
+    def getSize(self, filename):
+        return len(self.readMetadata(filename)['frames'])
+
+    def _getFrame(self, meta, index):
+        i = max(index, 1) - 1  # NO_INDEX is the first frame
+        if i >= len(meta['frames']):
+            raise Exception("Index %d out of range, the container has %d "
+                            "frames." % (index, len(meta['frames'])))
+        return i, meta['frames'][i]
+
+    def readHeader(self, filename, index=NO_INDEX):
+        _, frame = self._getFrame(self.readMetadata(filename), index)
+        return dict(frame['header'])
+
+    def readData(self, filename, index=NO_INDEX):
+        meta = self.readMetadata(filename)
+        i, frame = self._getFrame(meta, index)
+        dtype, shape = numpy.dtype(meta['dtype']), tuple(meta['shape'])
+
+        if meta['codec'] is None:
+            stack = _loadStack(*_fileKey(filename), dtype,
+                               (len(meta['frames']),) + shape)
+            return stack[i]
+
+        if meta['codec'] == SPARSE:
+            return self.readSparse(filename, index).toDense()
+
+        block = _pread(filename, frame['length'], frame['offset'])
+        block = CODECS[meta['codec']][1](block)
+        return numpy.frombuffer(block, dtype=dtype).reshape(shape)
+
+    def isSparse(self, filename):
+        return self.readMetadata(filename)['codec'] == SPARSE
+
+    def readSparse(self, filename, index=NO_INDEX):
+        """ Return the frame as a SparseFrame, without creating
+        the dense array if the container uses the sparse codec.
+        """
+        meta = self.readMetadata(filename)
+        if meta['codec'] != SPARSE:
+            return SparseFrame.fromDense(self.readData(filename, index))
+        _, frame = self._getFrame(meta, index)
+        return SparseFrame.fromBytes(
+            _pread(filename, frame['length'], frame['offset']),
+            meta['shape'], meta['dtype'])
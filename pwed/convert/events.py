@@ -0,0 +1,199 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Virtual frames binned from detector event streams (e.g. Timepix).
+
+Event files are numpy .npy files with a structured array with, at least,
+the fields x, y (pixel) and toa (time of arrival, in ticks), sorted by
+toa. They are memory mapped and never loaded at once.
+
+Binning an event file writes a small JSON descriptor (.edbin) with the
+offset of the first event of each frame, found with a binary search of
+the frame edges in toa. Each frame is then a slice of the events, so the
+same acquisition can be binned again with a different width quickly.
+"""
+
+import os
+import json
+import functools
+
+import numpy
+
+from pwed.constants import NO_INDEX
+from .formats import ImageReader, registerReader
+from .sparse import SparseFrame, INDEX_DTYPE
+
+# Number of events checked at once when validating an event file
+EVENTS_CHUNK_SIZE = 1 << 20
+
+BINNING_EXTENSION = '.edbin'
+
+
+def loadEvents(filename):
+    """ Return the memory mapped events of the file. """
+    events = numpy.load(filename, mmap_mode='r')
+    names = events.dtype.names or ()
+    missing = [f for f in ('x', 'y', 'toa') if f not in names]
+    if missing:
+        raise Exception("Missing fields %s in events file %s"
+                        % (', '.join(missing), filename))
+    return events
+
+
+def checkSorted(events, chunkSize=EVENTS_CHUNK_SIZE):
+    """ Check that events are sorted by toa, reading them in chunks. """
+    toa = events['toa']
+    last = None
+    for i in range(0, len(toa), chunkSize):
+        chunk = numpy.asarray(toa[i:i + chunkSize])
+        if (last is not None and len(chunk) and chunk[0] < last) \
+                or numpy.any(chunk[1:] < chunk[:-1]):
+            raise Exception("Events are not sorted by time of arrival, "
+                            "near event %d." % i)
+        if len(chunk):
+            last = chunk[-1]
+
+
+def checkInside(events, shape, chunkSize=EVENTS_CHUNK_SIZE):
+    """ Check that the x, y of the events are inside the detector shape
+    (rows, columns), reading them in chunks.
+    """
+    rows, cols = shape
+    for i in range(0, len(events), chunkSize):
+        chunk = events[i:i + chunkSize]
+        x, y = numpy.asarray(chunk['x']), numpy.asarray(chunk['y'])
+        if len(chunk) and (x.min() < 0 or x.max() >= cols
+                           or y.min() < 0 or y.max() >= rows):
+            raise Exception("Events outside of the detector of %dx%d "
+                            "pixels, near event %d." % (cols, rows, i))
+
+
+def binEvents(eventsFile, frameTicks, startTick=None, endTick=None,
+              shape=None):
+    """ Split the events in frames of frameTicks, from startTick (the first
+    event by default) to endTick (the last one). Return the list with the
+    offset of the first event of each frame, plus the end offset.
+    If the detector shape (rows, columns) is given, events outside of it
+    are rejected.
+    """
+    events = loadEvents(eventsFile)
+    if shape is not None:
+        checkInside(events, shape)
+    toa = events['toa']
+    if not len(toa):
+        return [0]
+    if startTick is None:
+        startTick = int(toa[0])
+    if endTick is None:
+        endTick = int(toa[-1]) + 1
+    n = max(1, int(numpy.ceil((endTick - startTick) / float(frameTicks))))
+    edges = startTick + numpy.arange(n + 1, dtype=numpy.float64) * frameTicks
+    edges[-1] = min(edges[-1], endTick)
+    return numpy.searchsorted(toa, edges).tolist()
+
+
+def writeBinning(filename, eventsFile, shape, offsets, header=None,
+                 oscStart=0.0, oscRange=0.0, frameTime=0.0):
+    """ Write the descriptor of the frames binned from eventsFile.
+    Header values (with SMV keys) are shared by all frames, only
+    the starting angle changes from frame to frame.
+    """
+    with open(filename, 'w') as f:
+        json.dump({'events': os.path.abspath(eventsFile),
+                   'shape': list(shape),
+                   'offsets': list(offsets),
+                   'header': header or {},
+                   'oscStart': oscStart,
+                   'oscRange': oscRange,
+                   'frameTime': frameTime}, f)
+
+
+@functools.lru_cache(maxsize=32)
+def _loadBinning(filename, size, mtime):
+    with open(filename) as f:
+        return json.load(f)
+
+
+@registerReader
+class EventBinningReader(ImageReader):
+    """ Reader for frames binned from an events file. """
+    EXTENSIONS = [BINNING_EXTENSION]
+
+    def readBinning(self, filename):
+        """ Return the descriptor of the binning, which is parsed once
+        per file (and again if the file changes). It should not be
+        modified.
+        """
+        st = os.stat(filename)
+        return _loadBinning(os.path.abspath(filename), st.st_size,
+                            st.st_mtime_ns)
+
+    def getSize(self, filename):
+        return len(self.readBinning(filename)['offsets']) - 1
+
+    def _getFrame(self, binning, index):
+        i = max(index, 1) - 1  # NO_INDEX is the first frame
+        if i >= len(binning['offsets']) - 1:
+            raise Exception("Index %d out of range, there are %d frames."
+                            % (index, len(binning['offsets']) - 1))
+        return i
+
+    def readHeader(self, filename, index=NO_INDEX):
+        binning = self.readBinning(filename)
+        i = self._getFrame(binning, index)
+        h = dict(binning['header'])
+        h['SIZE2'], h['SIZE1'] = [str(s) for s in binning['shape']]
+        h['OSC_START'] = str(binning['oscStart'] + i * binning['oscRange'])
+        h['OSC_RANGE'] = str(binning['oscRange'])
+        h['TIME'] = str(binning['frameTime'])
+        return h
+
+    def isSparse(self, filename):
+        return True
+
+    def readSparse(self, filename, index=NO_INDEX):
+        """ Count the events of the frame into a SparseFrame. """
+        binning = self.readBinning(filename)
+        i = self._getFrame(binning, index)
+        start, end = binning['offsets'][i:i + 2]
+        events = loadEvents(binning['events'])[start:end]
+        shape = tuple(binning['shape'])
+        x = numpy.asarray(events['x'], dtype=numpy.int64)
+        y = numpy.asarray(events['y'], dtype=numpy.int64)
+        # Events outside of the detector are dropped, they would be
+        # counted in other pixels
+        inside = (x >= 0) & (x < shape[1]) & (y >= 0) & (y < shape[0])
+        if not inside.all():
+            x, y = x[inside], y[inside]
+        pixels = y * shape[1] + x
+        indexes, counts = numpy.unique(pixels, return_counts=True)
+        return SparseFrame(shape, indexes.astype(INDEX_DTYPE),
+                           counts.astype(numpy.int32))
+
+    def readData(self, filename, index=NO_INDEX):
+        return self.readSparse(filename, index).toDense()
@@ -0,0 +1,600 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Readers for the different diffraction image formats.
+
+Each reader returns the image headers as dicts using the SMV key names
+(SIZE1, SIZE2, PIXEL_SIZE, WAVELENGTH, DISTANCE, OSC_START, OSC_RANGE,
+BEAM_CENTER_X, BEAM_CENTER_Y, TIME, TWOTHETA...) so the import does not
+depend on the format of the files.
+
+Images can also be compressed with gzip or bzip2 (e.g. image.img.gz).
+Only the first bytes are decompressed to read their headers, while the
+whole decompressed files are kept in a bounded cache for pixel access.
+"""
+
+import os
+import re
+import bz2
+import gzip
+import struct
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy
+
+from pwed.constants import NO_INDEX
+
+logger = logging.getLogger(__name__)
+
+# Registered readers, by lower case file extension
+_readers = {}
+
+# Functions to open compressed files, by lower case file extension
+CODECS = {'.gz': gzip.open,
+          '.bz2': bz2.open}
+
+# Maximum bytes of decompressed files kept in memory
+DATA_CACHE_BYTES = 512 * 1024 * 1024
+
+
+def registerReader(ReaderClass):
+    """ Register a reader class for its EXTENSIONS.
+    It can be used as a class decorator.
+    """
+    reader = ReaderClass()
+    for ext in ReaderClass.EXTENSIONS:
+        _readers[ext.lower()] = reader
+    return ReaderClass
+
+
+def splitCodec(filename):
+    """ Return the filename without the compression extension,
+    and the function to open it (None if it is not compressed).
+    """
+    root, ext = os.path.splitext(filename)
+    codec = CODECS.get(ext.lower())
+    return (root, codec) if codec else (filename, None)
+
+
+def getReader(filename):
+    """ Return the reader registered for the extension of
+    filename, or None if the format is not known.
+    """
+    filename, _ = splitCodec(filename)
+    return _readers.get(os.path.splitext(filename)[1].lower())
+
+
+def getReaderExtensions():
+    """ Return the list of extensions with a registered reader. """
+    return sorted(_readers.keys())
+
+
+def readImage(filename, index=NO_INDEX):
+    """ Return the pixel data of an image as a numpy array. """
+    reader = getReader(filename)
+    if reader is None:
+        raise Exception("Unknown format of image: %s" % filename)
+    return reader.readData(filename, index)
+
+
+def readImageHeader(filename, index=NO_INDEX):
+    """ Return the header of an image as a dict. The index is only
+    passed to readers of formats with several images.
+    """
+    reader = getReader(filename)
+    if reader is None:
+        raise Exception("Unknown format of image: %s" % filename)
+    if index == NO_INDEX:
+        return reader.readHeader(filename)
+    return reader.readHeader(filename, index)
+
+
+def _pread(filename, size, offset=0):
+    """ Read size bytes from the given offset with a single system call.
+    Compressed files are only decompressed up to offset + size.
+    """
+    _, codec = splitCodec(filename)
+    if codec is not None:
+        with codec(filename, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        return os.pread(fd, size, offset)
+    finally:
+        os.close(fd)
+
+
+class _DataCache:
+    """ LRU cache of decompressed files, limited by their total size. """
+    def __init__(self, maxBytes):
+        self._maxBytes = maxBytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, filename, codec):
+        st = os.stat(filename)
+        key = (os.path.realpath(filename), st.st_size, st.st_mtime_ns)
+
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+
+        with codec(filename, 'rb') as f:
+            data = f.read()
+
+        with self._lock:
+            if key not in self._items and len(data) <= self._maxBytes:
+                self._items[key] = data
+                self._size += len(data)
+                while self._size > self._maxBytes:
+                    _, old = self._items.popitem(last=False)
+                    self._size -= len(old)
+        return data
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+
+_dataCache = _DataCache(DATA_CACHE_BYTES)
+
+
+def _readData(filename, size, offset=0):
+    """ Read size bytes of pixel data from the given offset.
+    Compressed files are decompressed once and cached.
+    """
+    _, codec = splitCodec(filename)
+    if codec is None:
+        return _pread(filename, size, offset)
+    return memoryview(_dataCache.get(filename, codec))[offset:offset + size]
+
+
+class ImageReader:
+    """ Base class for the readers of diffraction image formats. """
+    EXTENSIONS = []
+
+    def readHeader(self, filename):
+        """ Return a dict with the header values of the file. """
+        raise NotImplementedError
+
+    def readData(self, filename, index=NO_INDEX):
+        """ Return the pixel data of the image as a 2D numpy array.
+        The index is used for formats that contain several images.
+        """
+        self.unsupported(filename)
+
+    def isSparse(self, filename):
+        """ Return True if the frames of the file are stored as sparse
+        frames, so readSparse does not create the dense array.
+        """
+        return False
+
+    def unsupported(self, filename, what=None):
+        """ Raise the error for pixel data that can not be read. """
+        raise Exception("Pixel data of %s files is not supported: %s"
+                        % (what or '/'.join(self.EXTENSIONS), filename))
+
+    def readHeaders(self, filenames, overwrites=None):
+        """ Read the headers of many files.
+        Return a list of dicts in the same order as filenames,
+        with None for the files that could not be read.
+        Overwrites are applied once to each header.
+        """
+        headers = []
+        for fn in filenames:
+            try:
+                h = self.readHeader(fn)
+                if overwrites:
+                    h.update(overwrites)
+            except Exception as e:
+                logger.error("Error reading header from %s: %s" % (fn, e))
+                h = None
+            headers.append(h)
+        return headers
+
+
+@registerReader
+class SmvReader(ImageReader):
+    """ Reader for SMV (ADSC) images. """
+    EXTENSIONS = ['.img', '.smv']
+
+    # Bytes read at once, enough for the header of most SMV files
+    HEADER_BLOCK = 4096
+
+    _record = re.compile(r'(\w+)\s*=\s*([^;]*);')
+
+    def readHeader(self, filename):
+        block = _pread(filename, self.HEADER_BLOCK)
+        headerBytes = self._getHeaderBytes(block)
+        if headerBytes > len(block):
+            block += _pread(filename, headerBytes - len(block), len(block))
+        return self.parseHeader(block[:headerBytes])
+
+    def _getHeaderBytes(self, block):
+        m = re.search(rb'HEADER_BYTES\s*=\s*(\d+)', block)
+        if m is None:
+            raise Exception("HEADER_BYTES not found, it does not "
+                            "seem to be a SMV image.")
+        return int(m.group(1))
+
+    def parseHeader(self, block):
+        """ Parse the header text contained within { }. """
+        text = block.decode('ascii', 'ignore')
+        end = text.find('}')
+        if end >= 0:
+            text = text[:end]
+        return {k: v.strip() for k, v in self._record.findall(text)}
+
+    # Numpy data types for the TYPE values in the header
+    TYPES = {'unsigned_short': 'u2',
+             'signed_short': 'i2',
+             'unsigned_int': 'u4',
+             'signed_int': 'i4',
+             'unsigned_long': 'u4',
+             'signed_long': 'i4',
+             'float': 'f4'}
+
+    def getDataType(self, header):
+        order = '>' if header.get('BYTE_ORDER') == 'big_endian' else '<'
+        return numpy.dtype(order + self.TYPES[header.get('TYPE',
+                                                         'unsigned_short')])
+
+    def readData(self, filename, index=NO_INDEX):
+        h = self.readHeader(filename)
+        dtype = self.getDataType(h)
+        offset = int(h['HEADER_BYTES'])
+        shape = (int(h['SIZE2']), int(h['SIZE1']))
+
+        if splitCodec(filename)[1] is None:
+            return numpy.memmap(filename, dtype=dtype, mode='r',
+                                offset=offset, shape=shape)
+
+        data = _readData(filename, shape[0] * shape[1] * dtype.itemsize,
+                         offset)
+        return numpy.frombuffer(data, dtype=dtype).reshape(shape)
+
+
+@registerReader
+class MrcReader(ImageReader):
+    """ Reader for MRC images, e.g. written by RED. Only the dimensions
+    are read from the header. Stacks have one image per section.
+    """
+    EXTENSIONS = ['.mrc']
+
+    HEADER_BYTES = 1024
+
+    # Numpy data types for the MRC modes
+    MODES = {0: 'i1', 1: 'i2', 2: 'f4', 6: 'u2', 12: 'f2'}
+
+    def readHeader(self, filename, index=NO_INDEX):
+        return self.parseHeader(_pread(filename, self.HEADER_BYTES))
+
+    def parseHeader(self, block):
+        # Machine stamp: 0x44 0x44 for little endian, 0x11 0x11 for big
+        endian = '>' if block[212:214] == b'\x11\x11' else '<'
+        nx, ny, nz, mode = struct.unpack(endian + '4i', block[:16])
+        # The extended header (NSYMBT bytes) is before the data
+        extended = struct.unpack(endian + 'i', block[92:96])[0]
+        return {'HEADER_BYTES': str(self.HEADER_BYTES + max(0, extended)),
+                'SIZE1': str(nx),
+                'SIZE2': str(ny),
+                'SIZE3': str(nz),
+                'BYTE_ORDER': ('big_endian' if endian == '>'
+                               else 'little_endian'),
+                'MRC_MODE': str(mode)}
+
+    def readData(self, filename, index=NO_INDEX):
+        h = self.readHeader(filename)
+        mode = int(h['MRC_MODE'])
+        if mode not in self.MODES:
+            self.unsupported(filename, 'MRC mode %d' % mode)
+        order = '>' if h['BYTE_ORDER'] == 'big_endian' else '<'
+        dtype = numpy.dtype(order + self.MODES[mode])
+        shape = (int(h['SIZE2']), int(h['SIZE1']))
+        i = max(index, 1) - 1  # NO_INDEX is the first section
+        if i >= max(1, int(h['SIZE3'])):
+            raise Exception("Index %d out of range, there are %s images."
+                            % (index, h['SIZE3']))
+        size = shape[0] * shape[1] * dtype.itemsize
+        offset = int(h['HEADER_BYTES']) + i * size
+
+        if splitCodec(filename)[1] is None:
+            return numpy.memmap(filename, dtype=dtype, mode='r',
+                                offset=offset, shape=shape)
+        return numpy.frombuffer(_readData(filename, size, offset),
+                                dtype=dtype).reshape(shape)
+
+
+@registerReader
+class TiffReader(ImageReader):
+    """ Reader for TIFF images. Only the first image in the file is
+    read, and only uncompressed pixel data.
+    """
+    EXTENSIONS = ['.tif', '.tiff']
+
+    HEADER_BLOCK = 4096
+
+    TAG_IMAGE_WIDTH = 256
+    TAG_IMAGE_LENGTH = 257
+    TAG_BITS_PER_SAMPLE = 258
+    TAG_COMPRESSION = 259
+    TAG_STRIP_OFFSETS = 273
+    TAG_SAMPLES_PER_PIXEL = 277
+    TAG_STRIP_BYTE_COUNTS = 279
+    TAG_SAMPLE_FORMAT = 339
+
+    # Struct formats of the tag value types, by type code
+    VALUE_TYPES = {1: 'B', 3: 'H', 4: 'I', 16: 'Q'}
+    # Numpy kinds for the SampleFormat values (unsigned, signed, float)
+    SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+    def readHeader(self, filename):
+        endian, tags = self.readDirectory(filename)
+        header = {'SIZE1': str(tags[self.TAG_IMAGE_WIDTH][0]),
+                  'SIZE2': str(tags[self.TAG_IMAGE_LENGTH][0])}
+        if self.TAG_BITS_PER_SAMPLE in tags:
+            header['BITS_PER_SAMPLE'] = str(
+                tags[self.TAG_BITS_PER_SAMPLE][0])
+        return header
+
+    def readDirectory(self, filename):
+        """ Return the byte order and a dict with the list of values
+        of each tag of the first image directory.
+        """
+        block = _pread(filename, self.HEADER_BLOCK)
+        endian = {b'II': '<', b'MM': '>'}.get(block[:2])
+        if endian is None:
+            raise Exception("It does not seem to be a TIFF image.")
+        ifdOffset = struct.unpack(endian + 'I', block[4:8])[0]
+        blockOffset = 0
+        if ifdOffset + 2 > len(block):
+            # The first image directory is not at the beginning
+            block = _pread(filename, self.HEADER_BLOCK, ifdOffset)
+            blockOffset = ifdOffset
+        return endian, self.parseDirectory(filename, block, blockOffset,
+                                           ifdOffset, endian)
+
+    def parseDirectory(self, filename, block, blockOffset, offset, endian):
+        start = offset - blockOffset
+        n = struct.unpack(endian + 'H', block[start:start + 2])[0]
+        tags = {}
+        for i in range(n):
+            entry = block[start + 2 + 12 * i:start + 14 + 12 * i]
+            if len(entry) < 12:
+                break
+            tag, valueType, count = struct.unpack(endian + 'HHI', entry[:8])
+            fmt = self.VALUE_TYPES.get(valueType)
+            if fmt is None:
+                continue
+            size = count * struct.calcsize(fmt)
+            if size <= 4:
+                values = entry[8:8 + size]
+            else:
+                # Values that do not fit in the entry are elsewhere
+                pos = struct.unpack(endian + 'I', entry[8:12])[0]
+                values = _pread(filename, size, pos)
+            tags[tag] = list(struct.unpack('%s%d%s' % (endian, count, fmt),
+                                           values))
+        return tags
+
+    def readData(self, filename, index=NO_INDEX):
+        endian, tags = self.readDirectory(filename)
+        if tags.get(self.TAG_COMPRESSION, [1])[0] != 1:
+            self.unsupported(filename, 'compressed TIFF')
+        if tags.get(self.TAG_SAMPLES_PER_PIXEL, [1])[0] != 1:
+            self.unsupported(filename, 'multi-channel TIFF')
+        bits = tags.get(self.TAG_BITS_PER_SAMPLE, [8])[0]
+        kind = self.SAMPLE_KINDS.get(tags.get(self.TAG_SAMPLE_FORMAT, [1])[0])
+        if kind is None or bits not in (8, 16, 32, 64):
+            self.unsupported(filename, '%d-bit TIFF' % bits)
+        dtype = numpy.dtype('%s%s%d' % (endian, kind, bits // 8))
+        shape = (tags[self.TAG_IMAGE_LENGTH][0], tags[self.TAG_IMAGE_WIDTH][0])
+        size = shape[0] * shape[1] * dtype.itemsize
+        offsets = tags[self.TAG_STRIP_OFFSETS]
+        counts = tags.get(self.TAG_STRIP_BYTE_COUNTS, [size])
+
+        contiguous = all(o + c == nextO for o, c, nextO
+                         in zip(offsets, counts, offsets[1:]))
+        if contiguous and splitCodec(filename)[1] is None:
+            return numpy.memmap(filename, dtype=dtype, mode='r',
+                                offset=offsets[0], shape=shape)
+        data = b''.join(bytes(_readData(filename, c, o))
+                        for o, c in zip(offsets, counts))
+        return numpy.frombuffer(data[:size], dtype=dtype).reshape(shape)
+
+
+@registerReader
+class CbfReader(ImageReader):
+    """ Reader for mini-CBF images (e.g. written by Pilatus or Eiger
+    detectors), with pixel data compressed as x-CBF_BYTE_OFFSET.
+    """
+    EXTENSIONS = ['.cbf']
+
+    HEADER_BLOCK = 8192
+    BINARY_START = b'\x0c\x1a\x04\xd5'
+
+    # Values in the mini-CBF header: (regex, SMV key, scale)
+    HEADER_VALUES = [
+        (r'Pixel_size\s+([-\d.eE+]+)\s*m', 'PIXEL_SIZE', 1000),
+        (r'Wavelength\s+([-\d.eE+]+)\s*A', 'WAVELENGTH', 1),
+        (r'Detector_distance\s+([-\d.eE+]+)\s*m', 'DISTANCE', 1000),
+        (r'Start_angle\s+([-\d.eE+]+)', 'OSC_START', 1),
+        (r'Angle_increment\s+([-\d.eE+]+)', 'OSC_RANGE', 1),
+        (r'Exposure_time\s+([-\d.eE+]+)', 'TIME', 1),
+        (r'Detector_2theta\s+([-\d.eE+]+)', 'TWOTHETA', 1),
+        (r'Count_cutoff\s+(\d+)', 'SATURATED_VALUE', None),
+        (r'X-Binary-Size-Fastest-Dimension:\s*(\d+)', 'SIZE1', None),
+        (r'X-Binary-Size-Second-Dimension:\s*(\d+)', 'SIZE2', None),
+        (r'X-Binary-Size:\s*(\d+)', 'BINARY_SIZE', None),
+        (r'X-Binary-Number-of-Elements:\s*(\d+)', 'NUMBER_OF_ELEMENTS', None),
+    ]
+    _values = [(re.compile(r), k, scale) for r, k, scale in HEADER_VALUES]
+    _beam = re.compile(r'Beam_xy\s*\(\s*([-\d.eE+]+),\s*([-\d.eE+]+)\)')
+    _serial = re.compile(r'S/N\s+([\w-]+)')
+    _type = re.compile(r'X-Binary-Element-Type:\s*"([^"]+)"')
+
+    # Numpy data types for the X-Binary-Element-Type values
+    TYPES = {'signed 32-bit integer': 'i4',
+             'unsigned 32-bit integer': 'u4',
+             'signed 16-bit integer': 'i2',
+             'unsigned 16-bit integer': 'u2'}
+
+    def readHeader(self, filename):
+        block = _pread(filename, self.HEADER_BLOCK)
+        while self.BINARY_START not in block:
+            more = _pread(filename, len(block), len(block))
+            if not more:
+                raise Exception("Binary section not found, it does not "
+                                "seem to be a CBF image.")
+            block += more
+        return self.parseHeader(block)
+
+    def parseHeader(self, block):
+        """ Parse the text before the binary section. """
+        dataOffset = block.index(self.BINARY_START) + len(self.BINARY_START)
+        text = block[:dataOffset].decode('ascii', 'ignore')
+        header = {'HEADER_BYTES': str(dataOffset)}
+
+        for regex, key, scale in self._values:
+            m = regex.search(text)
+            if m is not None:
+                value = m.group(1)
+                header[key] = (value if scale is None
+                               else str(float(value) * scale))
+        m = self._beam.search(text)
+        if m is not None:
+            header['BEAM_CENTER_X'], header['BEAM_CENTER_Y'] = m.groups()
+        m = self._serial.search(text)
+        if m is not None:
+            header['DETECTOR_SN'] = m.group(1)
+        m = self._type.search(text)
+        header['ELEMENT_TYPE'] = m.group(1) if m else 'signed 32-bit integer'
+        return header
+
+    def readData(self, filename, index=NO_INDEX):
+        h = self.readHeader(filename)
+        data = _readData(filename, int(h['BINARY_SIZE']),
+                         int(h['HEADER_BYTES']))
+        size1, size2 = int(h['SIZE1']), int(h['SIZE2'])
+        values = decompressByteOffset(data, size1 * size2)
+        dtype = numpy.dtype('<' + self.TYPES[h['ELEMENT_TYPE']])
+        return values.astype(dtype).reshape(size2, size1)
+
+
+def decompressByteOffset(data, size):
+    """ Decompress CBF byte-offset data into an int64 array.
+
+    Each value is stored as the difference with the previous one, using
+    1 byte, or 0x80 followed by 2 bytes, or 0x80 0x0080 followed by
+    4 bytes (or 8 more after 0x80000000). Lengths and values of all
+    escaped differences are computed with numpy, no loop over pixels.
+    """
+    raw = numpy.frombuffer(data, dtype=numpy.uint8)
+    padded = numpy.concatenate([raw, numpy.zeros(16, dtype=numpy.uint8)])
+    deltas = raw.view(numpy.int8).astype(numpy.int64)
+    escapes = numpy.flatnonzero(raw == 0x80)
+
+    def _int(pos, nbytes):
+        value = numpy.zeros(len(pos), dtype=numpy.uint64)
+        for i in range(nbytes):
+            value |= padded[pos + i].astype(numpy.uint64) << numpy.uint64(8 * i)
+        return value.astype('u%d' % nbytes).view('i%d' % nbytes)
+
+    v16 = _int(escapes + 1, 2).astype(numpy.int64)
+    v32 = _int(escapes + 3, 4).astype(numpy.int64)
+    is32 = v16 == -0x8000
+    lengths = numpy.where(is32, 7, 3)
+    values = numpy.where(is32, v32, v16)
+
+    v64 = _int(escapes + 7, 8).astype(numpy.int64)
+    is64 = is32 & (v32 == -0x80000000)
+    lengths[is64] = 15
+    values[is64] = v64[is64]
+
+    # A 0x80 byte inside the value of a real escape is not an escape.
+    # The first escape is real, and after a real escape the next real
+    # one is the first escape past its end, so real escapes form a chain
+    # that is followed with pointer doubling, in log(n) vectorized steps.
+    n = len(escapes)
+    jump = numpy.append(numpy.searchsorted(escapes, escapes + lengths), n)
+    real = numpy.zeros(n + 1, dtype=bool)
+    real[:min(n, 1)] = True
+    while True:
+        targets = jump[numpy.flatnonzero(real)]
+        if (targets == n).all():
+            break
+        real[targets] = True
+        jump = jump[jump]
+    real = real[:n]
+    escapes, values, lengths = escapes[real], values[real], lengths[real]
+
+    deltas[escapes] = values
+    # Remove the bytes used by the escaped differences
+    marks = numpy.zeros(len(raw) + 16, dtype=numpy.int64)
+    numpy.add.at(marks, escapes + 1, 1)
+    numpy.add.at(marks, escapes + lengths, -1)
+    keep = numpy.cumsum(marks[:len(raw)]) == 0
+
+    return numpy.cumsum(deltas[keep])[:size]
+
+
+def compressByteOffset(array):
+    """ Compress an integer array with the CBF byte-offset
+    algorithm, return the compressed bytes.
+    """
+    values = numpy.asarray(array, dtype=numpy.int64).ravel()
+    deltas = numpy.diff(values, prepend=0)
+    small = numpy.abs(deltas) < 0x80
+    medium = ~small & (numpy.abs(deltas) < 0x8000)
+    huge = numpy.abs(deltas) >= 0x80000000
+    large = ~small & ~medium & ~huge
+    lengths = numpy.select([small, medium, large], [1, 3, 7], 15)
+    offsets = numpy.cumsum(lengths) - lengths
+    out = numpy.zeros(int(lengths.sum()), dtype=numpy.uint8)
+
+    def _put(pos, value, nbytes):
+        value = numpy.broadcast_to(value, pos.shape).astype(numpy.int64)
+        for i in range(nbytes):
+            out[pos + i] = (value >> (8 * i)) & 0xff
+
+    _put(offsets[small], deltas[small], 1)
+    out[offsets[~small]] = 0x80
+    _put(offsets[medium] + 1, deltas[medium], 2)
+    _put(offsets[large | huge] + 1, -0x8000, 2)
+    _put(offsets[large] + 3, deltas[large], 4)
+    _put(offsets[huge] + 3, -0x80000000, 4)
+    _put(offsets[huge] + 7, deltas[huge], 8)
+
+    return out.tobytes()
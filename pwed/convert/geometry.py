@@ -0,0 +1,228 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Per-pixel geometry maps of diffraction images.
+
+The resolution (d-spacing) of each pixel, and its radial bin, only depend
+on the dimensions, pixel size, distance, wavelength and beam center of
+the image. The maps are computed once per geometry and kept in an LRU
+cache limited by memory, and optionally saved in a folder, so all the
+images of a sweep share the same arrays.
+
+Pixel centers are at (column + 0.5, row + 0.5), in the same pixel units
+as the beam center.
+"""
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy
+
+# Maximum bytes of geometry maps kept in memory
+GEOMETRY_CACHE_BYTES = 256 * 1024 * 1024
+
+Geometry = namedtuple('Geometry', ['dimX', 'dimY', 'pixelSize', 'distance',
+                                   'wavelength', 'beamX', 'beamY'])
+
+
+def getGeometry(dImg):
+    """ Return the Geometry of a DiffractionImage, rounding the values
+    so images with the same geometry have the same key.
+    """
+    dimX, dimY = dImg.getDim()
+    beamX, beamY = dImg.getBeamCenter()
+    values = [dImg.getPixelSize(), dImg.getDistance(), dImg.getWavelength(),
+              beamX, beamY]
+    if None in values or dimX is None:
+        raise Exception("Image %s does not have a complete geometry."
+                        % dImg.getFileName())
+    return Geometry(int(dimX), int(dimY or dimX),
+                    *[round(float(v), 6) for v in values])
+
+
+def getRadiusMap(geometry):
+    """ Distance (in pixels) of each pixel center to the beam center. """
+    y = numpy.arange(geometry.dimY, dtype=numpy.float64) + 0.5 - geometry.beamY
+    x = numpy.arange(geometry.dimX, dtype=numpy.float64) + 0.5 - geometry.beamX
+    return numpy.hypot(y[:, None], x[None, :])
+
+
+def radiusToResolution(geometry, radius):
+    """ Return the d-spacing (in A) at a radius (in pixels), which is
+    infinite at the beam center.
+    """
+    radius = numpy.asarray(radius, dtype=numpy.float64)
+    twoTheta = numpy.arctan2(radius * geometry.pixelSize, geometry.distance)
+    with numpy.errstate(divide='ignore'):
+        return geometry.wavelength / (2 * numpy.sin(twoTheta / 2))
+
+
+def resolutionToRadius(geometry, resolution):
+    """ Return the radius (in pixels) of a d-spacing (in A). """
+    theta = numpy.arcsin(geometry.wavelength / (2 * numpy.asarray(resolution)))
+    return numpy.tan(2 * theta) * geometry.distance / geometry.pixelSize
+
+
+def computeMaps(geometry, binWidth=1.0):
+    """ Return a dict with the 'resolution' (float32) and 'radialBins'
+    (int32, radius // binWidth) maps, and the 'binResolution' at the
+    center of each radial bin.
+    """
+    radius = getRadiusMap(geometry)
+    radialBins = (radius // binWidth).astype(numpy.int32)
+    nBins = int(radialBins.max()) + 1
+    resolution = radiusToResolution(geometry, radius)
+    return {
+        'resolution': resolution.astype(numpy.float32),
+        'radialBins': radialBins,
+        'binResolution': radiusToResolution(
+            geometry, (numpy.arange(nBins) + 0.5) * binWidth)
+    }
+
+
+class GeometryCache:
+    """ LRU cache of the geometry maps, limited by their total size,
+    and optionally saved as .npz files into a folder.
+    """
+    def __init__(self, maxBytes=GEOMETRY_CACHE_BYTES, folder=None):
+        self._maxBytes = maxBytes
+        self._folder = folder
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _getFile(self, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self._folder, 'geometry-%s.npz' % name)
+
+    def _load(self, key):
+        if self._folder:
+            fn = self._getFile(key)
+            if os.path.exists(fn):
+                with numpy.load(fn) as npz:
+                    return {k: npz[k] for k in npz.files}
+        maps = computeMaps(*key)
+        if self._folder:
+            os.makedirs(self._folder, exist_ok=True)
+            with open(fn, 'wb') as f:
+                numpy.savez(f, **maps)
+        return maps
+
+    def getMaps(self, geometry, binWidth=1.0):
+        """ Return the maps of computeMaps, from the cache if possible.
+        The arrays are shared, so they should not be modified.
+        """
+        key = (geometry, float(binWidth))
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+
+        maps = self._load(key)
+        for a in maps.values():
+            a.setflags(write=False)
+        size = sum(a.nbytes for a in maps.values())
+
+        with self._lock:
+            if key not in self._items and size <= self._maxBytes:
+                self._items[key] = maps
+                self._size += size
+                while self._size > self._maxBytes:
+                    _, old = self._items.popitem(last=False)
+                    self._size -= sum(a.nbytes for a in old.values())
+        return maps
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+
+_geometryCache = GeometryCache()
+
+
+def getGeometryCache():
+    """ Return the cache shared by all users in this process. """
+    return _geometryCache
+
+
+def getResolutionMap(dImg):
+    """ Return the d-spacing (in A) of each pixel of the image. """
+    return _geometryCache.getMaps(getGeometry(dImg))['resolution']
+
+
+def getRadialBins(dImg, binWidth=1.0):
+    """ Return the radial bin of each pixel of the image, and the
+    d-spacing at the center of each bin.
+    """
+    maps = _geometryCache.getMaps(getGeometry(dImg), binWidth)
+    return maps['radialBins'], maps['binResolution']
+
+
+def findBeamCenter(data, mask=None, guess=None, searchRadius=None):
+    """ Find the center of symmetry (x, y), in pixels, of an image
+    (usually the sum of many frames).
+
+    For an image symmetric about c, the convolution of the image with
+    itself has its maximum at 2c, where every pixel is multiplied by its
+    Friedel mate. The convolution is computed with FFTs on the zero
+    padded image, and the peak is refined with a parabolic fit. If
+    guess is given, the peak is only searched within searchRadius pixels
+    of it.
+    """
+    image = numpy.asarray(data, dtype=numpy.float64)
+    valid = numpy.ones(image.shape, dtype=bool) if mask is None else ~mask
+    image = numpy.where(valid, image - image[valid].mean(), 0)
+
+    h, w = image.shape
+    shape = (2 * h, 2 * w)
+    ft = numpy.fft.rfft2(image, s=shape)
+    conv = numpy.fft.irfft2(ft * ft, s=shape)
+
+    y0, x0, window = 0, 0, conv
+    if guess is not None and searchRadius is not None:
+        # Only look near 2 * guess, see below for the pixel convention
+        sx, sy = [int(round(2 * g - 1)) for g in guess]
+        r = int(searchRadius) * 2
+        y0, x0 = max(sy - r, 0), max(sx - r, 0)
+        window = conv[y0:sy + r + 1, x0:sx + r + 1]
+
+    py, px = numpy.unravel_index(numpy.argmax(window), window.shape)
+    py, px = py + y0, px + x0
+
+    def _refine(c, m, p):
+        denom = c - 2 * m + p
+        return 0.0 if denom == 0 else 0.5 * (c - p) / denom
+
+    dy = _refine(conv[py - 1, px], conv[py, px], conv[(py + 1) % shape[0], px])
+    dx = _refine(conv[py, px - 1], conv[py, px], conv[py, (px + 1) % shape[1]])
+    # Pixel i has its center at i + 0.5, and its mate at 2c - i - 1,
+    # so the peak of the convolution is at s = 2c - 1
+    return (px + dx + 1) / 2.0, (py + dy + 1) / 2.0
@@ -0,0 +1,479 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import re
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from pwed.objects import DiffractionImage
+from . import formats
+from . import processing
+
+
+logger = logging.getLogger(__name__)
+
+# Number of images imported between commits to the output set
+IMPORT_CHUNK_SIZE = 1000
+
+# Header values that change along a continuous rotation sweep,
+# all other values are expected to be the same for all images
+SWEEP_LINEAR_KEYS = ['OSC_START', 'PHI']
+SWEEP_IGNORED_KEYS = ['DATE']
+# Maximum difference (in degrees) between extrapolated and read angles
+SWEEP_ANGLE_TOLERANCE = 0.001
+
+
+class DiffractionImageImporter:
+    """ Expand a files pattern and create DiffractionImage items
+    from the matching files.
+
+    This class does not need a project, so it is shared by the
+    import protocol and the command line import in pwed.__main__.
+    """
+
+    def __init__(self, pattern, overwrites=None, skipImages=None,
+                 rotationAxis=None, threads=1, headerStride=None,
+                 gapSpec=None, computeStats=False, detectorMasks=False):
+        """
+        Params:
+        :param pattern: files pattern, it should contain the {TI} tag
+        :param overwrites: dict with header values to be overwritten
+        :param skipImages: if set, every skipImages-th image is ignored
+        :param rotationAxis: (x, y, z) rotation axis, or None
+        :param threads: number of threads used to read the headers
+        :param headerStride: if set, only read the header of every
+            headerStride-th image (and the last one) and extrapolate
+            the others, see readSweepHeaders
+        :param gapSpec: (chipSize, chips, crossFactor) of the detector
+            chip gaps, see pwed.convert.remap
+        :param computeStats: if True, compute the intensity statistics
+            of each image, see readStats
+        :param detectorMasks: if True, use the last bad pixel mask stored
+            for the detector serial number, see getMaskFile
+        """
+        self._pattern = pattern
+        self._overwrites = overwrites or {}
+        self._skipImages = skipImages
+        self._rotationAxis = rotationAxis
+        self._threads = max(1, threads)
+        self._headerStride = headerStride
+        self._gapSpec = gapSpec
+        self._computeStats = computeStats
+        self._detectorMasks = detectorMasks
+        # Bad pixel mask files (or None) by detector serial number
+        self._maskFiles = {}
+
+        def _replace(p, ti):
+            return p.replace('{TI}', ti)
+
+        self._regexPattern = _replace(self._pattern.replace('*', '(.*)'),
+                                      r'(?P<TI>\d+)')
+        self._globPattern = _replace(self._pattern, '*')
+        self._matchingFiles = None
+        # (size, mtime) of the matching files, taken while listing them
+        self._fileStats = {}
+
+    def getPattern(self):
+        return self._pattern
+
+    def getGlobPattern(self):
+        return self._globPattern
+
+    def getRegexPattern(self):
+        return self._regexPattern
+
+    def getMatchingFiles(self):
+        """ Return a list with (path, TI) of files that matched the
+        pattern, sorted by TI. The result is cached, so the folders
+        are only listed the first time.
+        """
+        if self._matchingFiles is None:
+            parts = self._pattern.split(os.sep)
+            # Folders without wildcards are not listed, just joined
+            i = 0
+            while i < len(parts) - 1 and not _hasWildcards(parts[i]):
+                i += 1
+            root = os.sep.join(parts[:i])
+            if not root and parts[0] == '':  # pattern like /{TI}.img
+                root = os.sep
+            matchingFiles = list(self._walk(root, parts[i:], None))
+            matchingFiles.sort(key=lambda m: (m[1], m[0]))
+            self._matchingFiles = matchingFiles
+
+        return self._matchingFiles
+
+    def _walk(self, folder, parts, ti):
+        """ Yield (path, TI) for entries under folder that match the
+        remaining pattern parts, listing each folder only once.
+        """
+        part, last = parts[0], len(parts) == 1
+
+        if not _hasWildcards(part):
+            path = os.path.join(folder, part)
+            if last:
+                if ti is not None and os.path.isfile(path):
+                    self._fileStats[path] = _getFileStat(os.stat(path))
+                    yield path, ti
+            elif os.path.isdir(path):
+                yield from self._walk(path, parts[1:], ti)
+            return
+
+        regex = _partToRegex(part)
+        try:
+            entries = list(os.scandir(folder or os.curdir))
+        except OSError:
+            return
+
+        for entry in entries:
+            # Same as glob, only list hidden files if explicitly requested
+            if entry.name.startswith('.') and not part.startswith('.'):
+                continue
+            m = regex.match(entry.name)
+            if m is None:
+                continue
+            entryTi = int(m.group('TI')) if 'TI' in m.groupdict() else ti
+            path = os.path.join(folder, entry.name)
+            if last:
+                if entryTi is not None and entry.is_file():
+                    self._fileStats[path] = _getFileStat(entry.stat())
+                    yield path, entryTi
+            elif entry.is_dir():
+                yield from self._walk(path, parts[1:], entryTi)
+
+    def getFileStat(self, path):
+        """ Return the (size, mtime) of the file, from the listing of
+        the matching files if it was there.
+        """
+        fileStat = self._fileStats.get(path)
+        return fileStat if fileStat else _getFileStat(os.stat(path))
+
+    def readHeader(self, imageFile):
+        """ Return a dict with the header values of the given file,
+        or an empty dict if the format is not known.
+        """
+        return self.readHeaders([imageFile])[0]
+
+    def readHeaders(self, imageFiles):
+        """ Read the headers of all files, using several threads
+        if requested. The result is in the same order as imageFiles.
+        Failing files will have None instead of a dict.
+        """
+        # Group the files by format, keeping their position
+        batches = {}
+        for i, f in enumerate(imageFiles):
+            reader = formats.getReader(f)
+            if reader is not None:
+                batches.setdefault(reader, []).append((i, f))
+
+        # Split the files of each format in one batch per thread
+        tasks = []
+        for reader, files in batches.items():
+            size = -(-len(files) // self._threads)  # ceil division
+            for j in range(0, len(files), size):
+                tasks.append((reader, files[j:j + size]))
+
+        def _read(task):
+            reader, files = task
+            return files, reader.readHeaders([f for _, f in files],
+                                             self._overwrites)
+
+        headers = [{} for _ in imageFiles]
+
+        if self._threads > 1 and len(tasks) > 1:
+            with ThreadPoolExecutor(max_workers=self._threads) as executor:
+                results = list(executor.map(_read, tasks))
+        else:
+            results = [_read(t) for t in tasks]
+
+        for files, batchHeaders in results:
+            for (i, _), h in zip(files, batchHeaders):
+                headers[i] = h
+
+        return headers
+
+    def readSweepHeaders(self, files):
+        """ Read the headers of the (path, TI) files of a sweep.
+
+        If headerStride is set, only the headers of the first, last and
+        every headerStride-th file are read. If all of them are the same,
+        except for the rotation angle that should be linear in TI, the
+        remaining headers are extrapolated from them. Otherwise, all
+        headers are read.
+        """
+        n = len(files)
+        stride = self._headerStride
+
+        if not stride or stride < 2 or n <= 2:
+            return self.readHeaders([f for f, _ in files])
+
+        sampleIndexes = sorted(set(range(0, n, stride)) | {n - 1})
+        samples = self.readHeaders([files[i][0] for i in sampleIndexes])
+        tiList = [ti for _, ti in files]
+        headers = _extrapolateHeaders(tiList, sampleIndexes, samples)
+
+        if headers is None:
+            logger.info("Sampled headers are not consistent, "
+                        "reading all %d headers." % n)
+            return self.readHeaders([f for f, _ in files])
+
+        return headers
+
+    def readStats(self, imageFiles, headers):
+        """ Compute the intensity statistics (see processing.frameStats)
+        of the images, memory mapped when possible, using several threads.
+        Failing files will have None instead of the statistics.
+        """
+        def _stats(args):
+            f, h = args
+            try:
+                data = formats.readImage(f)
+                return processing.frameStats(
+                    data, processing.getSaturation(h, data.dtype))
+            except Exception as e:
+                logger.error("Error computing statistics of %s: %s"
+                             % (f, e))
+                return None
+
+        tasks = list(zip(imageFiles, headers))
+        if self._threads > 1 and len(tasks) > 1:
+            with ThreadPoolExecutor(max_workers=self._threads) as executor:
+                return list(executor.map(_stats, tasks))
+        return [_stats(t) for t in tasks]
+
+    def readSmvHeader(self, imageFile):
+        return formats.SmvReader().readHeaders([imageFile],
+                                               self._overwrites)[0]
+
+    def setImageInfo(self, dImg, imageFile, ti, header):
+        """ Fill the DiffractionImage properties from the file,
+        its TI and its header (could be None or empty).
+        """
+        dImg.setFileName(imageFile)
+        dImg.setObjId(int(ti))
+        if self._skipImages is not None:
+            dImg.setIgnore(true_or_false=bool(int(ti) %
+                                              self._skipImages == 0))
+        if self._rotationAxis:
+            dImg.setRotationAxis(self._rotationAxis)
+        if self._gapSpec:
+            dImg.getDetector().setGapSpec(self._gapSpec)
+
+        h = header or {}
+
+        if 'PIXEL_SIZE' in h:
+            dImg.setPixelSize(float(h['PIXEL_SIZE']))
+        if 'SIZE1' in h:
+            dImg.setDim(int(h['SIZE1']))
+        if 'WAVELENGTH' in h:
+            dImg.setWavelength(float(h['WAVELENGTH']))
+        if 'DISTANCE' in h:
+            dImg.setDistance(float(h['DISTANCE']))
+        if 'OSC_START' in h:
+            dImg.setOscillation(float(h['OSC_START']),
+                                float(h['OSC_RANGE']))
+        if 'BEAM_CENTER_X' in h:
+            dImg.setBeamCenter(float(h['BEAM_CENTER_X']),
+                               float(h['BEAM_CENTER_Y']))
+        if 'TIME' in h:
+            dImg.setExposureTime(float(h['TIME']))
+        if 'TWOTHETA' in h:
+            dImg.setTwoTheta(float(h['TWOTHETA']))
+        if 'DETECTOR_SN' in h:
+            detector = dImg.getDetector()
+            detector.setSerialNumber(h['DETECTOR_SN'])
+            detector.setBadPixelMaskFile(self.getMaskFile(h['DETECTOR_SN']))
+
+    def getMaskFile(self, serialNumber):
+        """ Return the last bad pixel mask file stored for the detector,
+        or None if there is none or detector masks are not used.
+        """
+        if not self._detectorMasks:
+            return None
+        if serialNumber not in self._maskFiles:
+            self._maskFiles[serialNumber] = \
+                processing.findBadPixelMaskFile(serialNumber)
+        return self._maskFiles[serialNumber]
+
+    def getFilesToImport(self, outputSet, matchingFiles=None,
+                         fileStats=None):
+        """ Compare the matching files with the images already in
+        outputSet, by TI, size and modification time.
+        If given, fileStats are the (size, mtime) to use for each of the
+        matchingFiles (e.g. those of the source of staged files).
+        Return a list with (path, TI, (size, mtime), isNew) for the
+        files that are new or have been modified.
+        """
+        if matchingFiles is None:
+            matchingFiles = self.getMatchingFiles()
+        if fileStats is None:
+            fileStats = [self.getFileStat(f) for f, _ in matchingFiles]
+
+        existing = outputSet.getFileStats()
+        filesToImport = []
+
+        for (f, ti), fileStat in zip(matchingFiles, fileStats):
+            oldStat = existing.pop(ti, None)
+            if oldStat != fileStat:
+                filesToImport.append((f, ti, fileStat, oldStat is None))
+
+        if existing:
+            logger.warning("%d images in the set do not match any file."
+                           % len(existing))
+
+        return filesToImport
+
+    def importImages(self, outputSet, matchingFiles=None,
+                     chunkSize=IMPORT_CHUNK_SIZE, fileStats=None):
+        """ Read headers of the matching files and add one
+        DiffractionImage per file to the outputSet.
+
+        If outputSet already contains images, only new or modified
+        files are processed. Changes are committed every chunkSize
+        images, so an interrupted import can be resumed later.
+
+        The (size, mtime) of the files, stored to find the modified
+        ones, can be given in fileStats, see getFilesToImport.
+
+        Return the number of new or updated images.
+        """
+        filesToImport = self.getFilesToImport(outputSet, matchingFiles,
+                                              fileStats)
+        if not outputSet.isEmpty():
+            outputSet.enableAppend()
+
+        for i in range(0, len(filesToImport), chunkSize):
+            chunk = filesToImport[i:i + chunkSize]
+            headers = self.readSweepHeaders([(f, ti)
+                                             for f, ti, _, _ in chunk])
+            if self._computeStats:
+                stats = self.readStats([f for f, _, _, _ in chunk], headers)
+            else:
+                stats = [None] * len(chunk)
+
+            for (f, ti, fileStat, isNew), h, st in zip(chunk, headers, stats):
+                # A new image for each file, so missing values are not
+                # taken from the previous one
+                dImg = DiffractionImage()
+                try:
+                    self.setImageInfo(dImg, f, ti, h)
+                except Exception as e:
+                    logger.error("Error setting image info from %s: %s"
+                                 % (f, e))
+                dImg.setFileStat(*fileStat)
+                dImg.setStats(*(st or (None,) * 5))
+                if isNew:
+                    outputSet.append(dImg)
+                else:
+                    outputSet.update(dImg)
+
+            outputSet.write()
+
+        return len(filesToImport)
+
+
+def _extrapolateHeaders(tiList, sampleIndexes, samples):
+    """ Return the headers for all TI values, extrapolated from the
+    samples read at sampleIndexes, or None if the samples are not
+    consistent with a continuous rotation sweep.
+    """
+    if any(not h for h in samples):
+        return None
+
+    first, last = samples[0], samples[-1]
+    ti0, tiN = tiList[sampleIndexes[0]], tiList[sampleIndexes[-1]]
+    linearKeys = [k for k in SWEEP_LINEAR_KEYS if k in first]
+    variableKeys = set(linearKeys + SWEEP_IGNORED_KEYS)
+    constant = {k: v for k, v in first.items() if k not in variableKeys}
+
+    try:
+        starts = {k: float(first[k]) for k in linearKeys}
+        slopes = {k: (float(last[k]) - starts[k]) / (tiN - ti0)
+                  for k in linearKeys}
+
+        for i, h in zip(sampleIndexes, samples):
+            if h.keys() != first.keys():
+                return None
+            if any(h[k] != v for k, v in constant.items()):
+                return None
+            for k in linearKeys:
+                expected = starts[k] + (tiList[i] - ti0) * slopes[k]
+                if abs(float(h[k]) - expected) > SWEEP_ANGLE_TOLERANCE:
+                    return None
+    except (KeyError, ValueError, ZeroDivisionError):
+        return None
+
+    headers = [None] * len(tiList)
+    for i, h in zip(sampleIndexes, samples):
+        headers[i] = h
+
+    for i, ti in enumerate(tiList):
+        if headers[i] is None:
+            h = dict(constant)
+            for k in linearKeys:
+                h[k] = '%0.6f' % (starts[k] + (ti - ti0) * slopes[k])
+            headers[i] = h
+
+    return headers
+
+
+def _hasWildcards(part):
+    return '{TI}' in part or any(c in part for c in '*?[')
+
+
+def _partToRegex(part):
+    """ Convert a part of the pattern (a file or folder name), with
+    glob wildcards and the {TI} tag, into a compiled regex.
+    """
+    regex = ''
+    i, n = 0, len(part)
+    while i < n:
+        c = part[i]
+        if part.startswith('{TI}', i):
+            regex += r'(?P<TI>\d+)'
+            i += 4
+            continue
+        if c == '*':
+            regex += '.*'
+        elif c == '?':
+            regex += '.'
+        elif c == '[' and ']' in part[i + 1:]:
+            j = part.index(']', i + 1)
+            chars = part[i + 1:j]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex += '[%s]' % chars.replace('\\', '\\\\')
+            i = j
+        else:
+            regex += re.escape(c)
+        i += 1
+    return re.compile(regex + '$')
+
+
+def _getFileStat(st):
+    return st.st_size, st.st_mtime
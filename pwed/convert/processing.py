@@ -0,0 +1,403 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Vectorized operations on diffraction frames.
+"""
+
+import glob
+import hashlib
+import os
+
+import numpy
+
+import pwed
+from .formats import readImage
+from .sparse import SparseFrame, readSparse, addFrames, hasSparseData
+
+
+def binFrame(data, factor):
+    """ Sum blocks of factor x factor pixels of a frame (or of the
+    last two dimensions of a stack). Rows and columns that do not
+    fill a complete block are discarded.
+    The frame can also be a SparseFrame, the result is always dense.
+    """
+    if isinstance(data, SparseFrame):
+        return _binSparse(data, factor)
+    if factor == 1:
+        return data
+    h, w = data.shape[-2:]
+    h, w = h - h % factor, w - w % factor
+    blocks = data[..., :h, :w].reshape(
+        data.shape[:-2] + (h // factor, factor, w // factor, factor))
+    return blocks.sum(axis=(-3, -1))
+
+
+def _binSparse(frame, factor):
+    """ Bin a SparseFrame into a dense frame of the sum type, adding
+    the values of the pixels of each block with a single bincount.
+    """
+    h, w = frame.shape
+    bh, bw = h // factor, w // factor
+    rows, cols = numpy.divmod(frame.indexes.astype(numpy.int64), w)
+    inside = (rows < bh * factor) & (cols < bw * factor)
+    blocks = (rows[inside] // factor) * bw + cols[inside] // factor
+    total = numpy.bincount(blocks, weights=frame.values[inside],
+                           minlength=bh * bw)
+    return total.reshape(bh, bw).astype(getSumType(frame.dtype))
+
+
+def getSumType(dtype):
+    """ Return the data type used to sum frames of the given type. """
+    return numpy.int32 if numpy.dtype(dtype).kind in 'iub' else numpy.float32
+
+
+def reduceFrames(locations, binning=1):
+    """ Read the frames at the (index, filename) locations,
+    sum them and bin the result. Frames stored as sparse frames
+    are summed and binned without creating their dense arrays,
+    only the binned result is dense.
+    """
+    if all(hasSparseData(fn) for fn in {fn for _, fn in locations}):
+        return binFrame(addFrames(readSparse(fn, index)
+                                  for index, fn in locations), binning)
+
+    total = None
+    for index, fn in locations:
+        data = readImage(fn, index)
+        if total is None:
+            total = numpy.zeros(data.shape, dtype=getSumType(data.dtype))
+        total += data
+    return binFrame(total, binning)
+
+
+def getSaturation(header, dtype):
+    """ Return the value of saturated pixels, from the header
+    or the maximum value of the data type.
+    """
+    if header and 'SATURATED_VALUE' in header:
+        return float(header['SATURATED_VALUE'])
+    dtype = numpy.dtype(dtype)
+    return numpy.iinfo(dtype).max if dtype.kind in 'iu' else numpy.inf
+
+
+def frameStats(data, saturation=None):
+    """ Return (mean, max, total, saturated, nonzero) of a frame, where
+    saturated is the number of pixels >= saturation and nonzero is the
+    fraction of pixels with counts.
+    """
+    flat = numpy.asarray(data).reshape(-1)
+    if saturation is None:
+        saturation = getSaturation(None, flat.dtype)
+    total = flat.sum(dtype=numpy.float64)
+    return (total / flat.size, float(flat.max()), float(total),
+            int(numpy.count_nonzero(flat >= saturation)),
+            numpy.count_nonzero(flat) / float(flat.size))
+
+
+def findPeaks(data, sigma=5.0, mask=None):
+    """ Return (x, y, intensity) of the local maxima of the frame that
+    are above the background (the median) by more than sigma times the
+    Poisson noise. Positions are centroids of the 3x3 pixels around
+    each maximum, with pixel centers at index + 0.5.
+    The frame can also be a SparseFrame, see _findSparsePeaks.
+    """
+    if isinstance(data, SparseFrame):
+        return _findSparsePeaks(data, sigma, mask)
+    data = numpy.asarray(data, dtype=numpy.float64)
+    background = numpy.median(data if mask is None else data[~mask])
+    threshold = background + sigma * numpy.sqrt(max(background, 1.0))
+    h, w = data.shape
+    center = data[1:-1, 1:-1]
+    peaks = center > threshold
+    if mask is not None:
+        peaks &= ~mask[1:-1, 1:-1]
+    offsets = [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1)]
+    for dy, dx in offsets:
+        neighbour = data[1 + dy:h - 1 + dy, 1 + dx:w - 1 + dx]
+        if (dy, dx) < (0, 0):
+            # Keep only the first pixel of flat maxima
+            peaks &= center > neighbour
+        elif dy or dx:
+            peaks &= center >= neighbour
+
+    rows, cols = numpy.nonzero(peaks)
+    rows += 1
+    cols += 1
+    total = sumX = sumY = 0
+    for dy, dx in offsets:
+        v = numpy.maximum(data[rows + dy, cols + dx] - background, 0)
+        total = total + v
+        sumX = sumX + v * dx
+        sumY = sumY + v * dy
+    return cols + 0.5 + sumX / total, rows + 0.5 + sumY / total, total
+
+
+def _sparseMedian(frame, mask=None):
+    """ Median of all the pixels of a SparseFrame (zeros included),
+    or only of those not in the mask.
+    """
+    values = frame.values
+    size = frame.shape[0] * frame.shape[1]
+    if mask is not None:
+        values = values[~mask.reshape(-1)[frame.indexes]]
+        size -= int(numpy.count_nonzero(mask))
+    if size <= 0:
+        return numpy.nan
+    # Sorted pixel values are the negative ones, the zeros, the positive
+    values = numpy.sort(values.astype(numpy.float64))
+    negative = int(numpy.searchsorted(values, 0))
+    zeros = size - len(values)
+
+    def _value(k):
+        if k < negative:
+            return values[k]
+        if k < negative + zeros:
+            return 0.0
+        return values[k - zeros]
+
+    return (_value((size - 1) // 2) + _value(size // 2)) / 2.0
+
+
+def _findSparsePeaks(frame, sigma=5.0, mask=None):
+    """ Same as findPeaks for a SparseFrame, only looking at the
+    non-zero pixels. Missing neighbours are zeros.
+    """
+    background = _sparseMedian(frame, mask)
+    threshold = background + sigma * numpy.sqrt(max(background, 1.0))
+    h, w = frame.shape
+    flat = frame.values.astype(numpy.float64)
+    rows, cols = numpy.divmod(frame.indexes.astype(numpy.int64), w)
+    peaks = ((flat > threshold) & (rows > 0) & (rows < h - 1)
+             & (cols > 0) & (cols < w - 1))
+    if mask is not None:
+        peaks &= ~mask.reshape(-1)[frame.indexes]
+    rows, cols, center = rows[peaks], cols[peaks], flat[peaks]
+    if not len(rows):
+        empty = numpy.zeros(0)
+        return empty, empty, empty
+
+    def _neighbour(dy, dx):
+        index = (rows + dy) * w + cols + dx
+        pos = numpy.minimum(numpy.searchsorted(frame.indexes, index),
+                            frame.nnz - 1)
+        return numpy.where(frame.indexes[pos] == index, flat[pos], 0.0)
+
+    offsets = [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1)]
+    neighbours = {o: _neighbour(*o) for o in offsets}
+    keep = numpy.ones(len(rows), dtype=bool)
+    for (dy, dx), neighbour in neighbours.items():
+        if (dy, dx) < (0, 0):
+            # Keep only the first pixel of flat maxima
+            keep &= center > neighbour
+        elif dy or dx:
+            keep &= center >= neighbour
+
+    rows, cols = rows[keep], cols[keep]
+    total = sumX = sumY = 0
+    for dy, dx in offsets:
+        v = numpy.maximum(neighbours[(dy, dx)][keep] - background, 0)
+        total = total + v
+        sumX = sumX + v * dx
+        sumY = sumY + v * dy
+    return cols + 0.5 + sumX / total, rows + 0.5 + sumY / total, total
+
+
+def reduceHeader(headers, binning=1):
+    """ Return the header (with SMV keys) of the sum of frames with
+    the given headers, binned by the given factor.
+    """
+    h = dict(headers[0])
+
+    def _set(key, func):
+        if key in h:
+            h[key] = str(func(h[key]))
+
+    for key in ['SIZE1', 'SIZE2']:
+        _set(key, lambda v: int(v) // binning)
+    for key in ['BEAM_CENTER_X', 'BEAM_CENTER_Y']:
+        _set(key, lambda v: float(v) / binning)
+    _set('PIXEL_SIZE', lambda v: float(v) * binning)
+    if all('OSC_RANGE' in x for x in headers):
+        h['OSC_RANGE'] = str(sum(float(x['OSC_RANGE']) for x in headers))
+    if all('TIME' in x for x in headers):
+        h['TIME'] = str(sum(float(x['TIME']) for x in headers))
+    return h
+
+
+class RollingBackground:
+    """ Background estimate over a window of consecutive frames.
+    The last frames are kept in a ring buffer, so memory does not depend
+    on the number of frames. The mean is kept updated with a running sum,
+    the median is only computed when requested.
+    """
+    MEAN = 'mean'
+    MEDIAN = 'median'
+
+    def __init__(self, window, method=MEAN):
+        if method not in [self.MEAN, self.MEDIAN]:
+            raise Exception("Unknown background method: %s" % method)
+        self._window = window
+        self._method = method
+        self._buffer = None
+        self._sum = None
+        self._count = 0  # Frames added so far
+
+    def add(self, data):
+        """ Add a frame, replacing the oldest one if the window is full. """
+        if self._buffer is None:
+            self._buffer = numpy.zeros((self._window,) + data.shape,
+                                       dtype=numpy.float32)
+            self._sum = numpy.zeros(data.shape, dtype=numpy.float64)
+        slot = self._count % self._window
+        if self._count >= self._window:
+            self._sum -= self._buffer[slot]
+        self._buffer[slot] = data
+        self._sum += self._buffer[slot]
+        self._count += 1
+
+    def getSize(self):
+        """ Number of frames currently in the window. """
+        return min(self._count, self._window)
+
+    def getBackground(self):
+        n = self.getSize()
+        if n == 0:
+            raise Exception("There are no frames in the window.")
+        if self._method == self.MEDIAN:
+            return numpy.median(self._buffer[:n], axis=0).astype(numpy.float32)
+        return (self._sum / n).astype(numpy.float32)
+
+
+def getBackgroundBlocks(n, blockSize, window):
+    """ Split n frames in blocks of blockSize frames, and return for
+    each block (first, last, windowEnd): the positions of its first and
+    last frames, and the position of the last frame of the window
+    centered on the block (shifted to fit within the n frames).
+    """
+    blocks = []
+    for first in range(0, n, blockSize):
+        last = min(first + blockSize, n) - 1
+        center = (first + last) // 2
+        windowEnd = min(max(center + window // 2, window - 1), n - 1)
+        blocks.append((first, last, windowEnd))
+    return blocks
+
+
+class PixelStatistics:
+    """ Mean and variance of each pixel over a stream of frames,
+    updated frame by frame with Welford's algorithm.
+    """
+    def __init__(self):
+        self._count = 0
+        self._mean = None
+        self._m2 = None
+
+    def add(self, data):
+        x = numpy.asarray(data, dtype=numpy.float64)
+        if self._mean is None:
+            self._mean = numpy.zeros(x.shape)
+            self._m2 = numpy.zeros(x.shape)
+        self._count += 1
+        delta = x - self._mean
+        self._mean += delta / self._count
+        self._m2 += delta * (x - self._mean)
+
+    def getCount(self):
+        return self._count
+
+    def getMean(self):
+        return self._mean
+
+    def getVariance(self):
+        if self._count < 2:
+            return numpy.zeros_like(self._mean)
+        return self._m2 / (self._count - 1)
+
+
+def findBadPixels(mean, variance, hotSigma=5.0):
+    """ Return a boolean mask of the hot and dead pixels.
+
+    Hot pixels have a mean further than hotSigma times the spread of the
+    means (robust, from the median absolute deviation, but not less than
+    the Poisson noise) above the median. Dead pixels never count, while
+    most pixels do.
+    """
+    median = numpy.median(mean)
+    mad = numpy.median(numpy.abs(mean - median)) * 1.4826
+    sigma = max(mad, numpy.sqrt(max(median, 1.0)))
+    mask = mean > median + hotSigma * sigma
+    if median > 0:
+        mask |= (mean == 0) & (variance == 0)
+    return mask
+
+
+def saveBadPixelMask(filename, mask):
+    """ Save the mask with a bit per pixel. """
+    with open(filename, 'wb') as f:
+        numpy.savez(f, shape=numpy.array(mask.shape),
+                    bits=numpy.packbits(mask.reshape(-1)))
+
+
+def loadBadPixelMask(filename):
+    with numpy.load(filename) as npz:
+        shape = tuple(npz['shape'])
+        bits = numpy.unpackbits(npz['bits'], count=int(numpy.prod(shape)))
+    return bits.reshape(shape).astype(bool)
+
+
+def _getDetectorPrefix(serialNumber, folder=None):
+    folder = folder or pwed.Config.SCIPION_ED_DETECTORS
+    safeName = ''.join(c if c.isalnum() or c in '-_.' else '_'
+                       for c in str(serialNumber))
+    return os.path.join(folder, '%s-badpixels-' % safeName)
+
+
+def storeBadPixelMask(serialNumber, mask, folder=None):
+    """ Store the mask for the detector with the given serial number and
+    return its file. Files are named by the hash of their content, so a
+    stored mask is never overwritten and files in use do not change.
+    """
+    mask = numpy.asarray(mask, dtype=bool)
+    digest = hashlib.sha1(numpy.array(mask.shape).tobytes() +
+                          numpy.packbits(mask.reshape(-1)).tobytes())
+    filename = '%s%s.npz' % (_getDetectorPrefix(serialNumber, folder),
+                             digest.hexdigest()[:12])
+    if not os.path.exists(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmpFile = '%s.%d.tmp' % (filename, os.getpid())
+        saveBadPixelMask(tmpFile, mask)
+        os.replace(tmpFile, filename)
+    return filename
+
+
+def findBadPixelMaskFile(serialNumber, folder=None):
+    """ Return the last mask stored for the detector with the given
+    serial number, or None.
+    """
+    files = glob.glob(_getDetectorPrefix(serialNumber, folder) + '*.npz')
+    return max(files, key=os.path.getmtime) if files else None
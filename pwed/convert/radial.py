@@ -0,0 +1,93 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Radial (azimuthally averaged) profiles and ice ring detection.
+"""
+
+import numpy
+
+# d-spacings (in A) of the strongest rings of hexagonal ice
+ICE_RINGS = [3.897, 3.669, 3.441, 2.671, 2.249, 2.072, 1.948, 1.918,
+             1.883, 1.721]
+
+
+def getBinCounts(radialBins, nBins, mask=None):
+    """ Return the number of valid pixels in each radial bin. """
+    bins = radialBins if mask is None else radialBins[~mask]
+    return numpy.bincount(bins.reshape(-1), minlength=nBins)[:nBins]
+
+
+def radialProfile(data, radialBins, binCounts, mask=None):
+    """ Return the mean value of the pixels in each radial bin (NaN for
+    bins without pixels), using a single bincount over the frame.
+    """
+    nBins = len(binCounts)
+    if mask is None:
+        bins, values = radialBins.reshape(-1), data.reshape(-1)
+    else:
+        bins, values = radialBins[~mask], data[~mask]
+    sums = numpy.bincount(bins, weights=values, minlength=nBins)[:nBins]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return sums / binCounts
+
+
+def findIceRings(profile, binResolution, threshold=5.0, width=0.01,
+                 rings=ICE_RINGS):
+    """ Score the ice rings in a radial profile.
+
+    For each ring, the maximum of the bins within a relative width of its
+    radius (at least one bin) is compared with the bins around it, as the
+    number of standard deviations above their median. Return the list of
+    scores (NaN for rings out of the profile) and the number of rings
+    with a score above threshold.
+    """
+    # Fractional bin of each ring, resolution decreases with the bin
+    bins = numpy.arange(len(binResolution), dtype=numpy.float64)
+    finite = numpy.isfinite(binResolution)
+    positions = numpy.interp(rings, binResolution[finite][::-1],
+                             bins[finite][::-1], left=numpy.nan,
+                             right=numpy.nan)
+    valid = numpy.isfinite(profile)
+    scores = []
+    for pos in positions:
+        if numpy.isnan(pos):
+            scores.append(numpy.nan)
+            continue
+        half = max(1.0, pos * width)
+        dist = numpy.abs(bins - pos)
+        ring = valid & (dist <= half)
+        background = valid & (dist > 2 * half) & (dist <= 2 * half + 4)
+        if not ring.any() or background.sum() < 3:
+            scores.append(numpy.nan)
+            continue
+        base = profile[background]
+        median = numpy.median(base)
+        spread = max(base.std(), 1e-6 * max(abs(median), 1))
+        scores.append((profile[ring].max() - median) / spread)
+    scores = numpy.array(scores)
+    return scores, int(numpy.sum(scores > threshold))
@@ -0,0 +1,107 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Correction of the gaps between the chips of tiled detectors.
+
+In a Timepix quad (2x2 chips of 256x256 pixels) the pixels along the
+cross between the chips are 3 times wider than the others. The corrected
+image (516x516) splits each of those pixels into 3 pixels of normal size
+with one third of the counts, so the pixel size is the same everywhere.
+
+The remapping is separable, so for each axis it is computed which raw
+pixel goes to each corrected pixel and with which weight. From these, a
+flat gather index and weights are built once per detector layout and
+applied to single frames or to stacks of frames with one numpy take.
+"""
+
+import numpy
+
+# Gap specification of the Timepix quad: (chipSize, chips, crossFactor)
+TIMEPIX_QUAD = (256, 2, 3)
+
+
+def getRemapAxis(chipSize, chips, crossFactor):
+    """ Return (source, weights) arrays with the raw pixel and weight
+    of each corrected pixel along one axis.
+    """
+    source, weights = [], []
+    for c in range(chips):
+        for p in range(chipSize):
+            raw = c * chipSize + p
+            isEdge = (p == 0 and c > 0) or (p == chipSize - 1
+                                            and c < chips - 1)
+            n = crossFactor if isEdge else 1
+            source.extend([raw] * n)
+            weights.extend([1.0 / n] * n)
+    return (numpy.array(source, dtype=numpy.intp),
+            numpy.array(weights, dtype=numpy.float32))
+
+
+def getCorrectedSize(chipSize, chips, crossFactor):
+    """ Return the size of the corrected image along one axis. """
+    return chips * chipSize + 2 * (chips - 1) * (crossFactor - 1)
+
+
+def getRemap(gapSpec):
+    """ Return the (index, weights, rawShape) of the corrected image,
+    where index are flat indexes in the raw image. Index and weights
+    have the corrected shape.
+    """
+    source, weights = getRemapAxis(*gapSpec)
+    rawSize = gapSpec[0] * gapSpec[1]
+    index = source[:, None] * rawSize + source[None, :]
+    return index, weights[:, None] * weights[None, :], (rawSize, rawSize)
+
+
+def correctGaps(data, remap):
+    """ Apply the (index, weights, rawShape) remap to a raw frame or to
+    a stack of raw frames (with the frames in the last two dimensions).
+    Return float32 corrected frames.
+    """
+    index, weights, rawShape = remap
+    if tuple(data.shape[-2:]) != rawShape:
+        raise Exception("Expected raw frames of %dx%d pixels, got %s"
+                        % (rawShape + (data.shape[-2:],)))
+    flat = numpy.asarray(data).reshape(data.shape[:-2] + (-1,))
+    return numpy.take(flat, index, axis=-1) * weights
+
+
+def correctCoordinates(values, gapSpec):
+    """ Return the corrected position (in pixels) of raw pixel
+    positions along one axis (e.g. the beam center).
+    """
+    chipSize, chips, crossFactor = gapSpec
+    values = numpy.asarray(values, dtype=numpy.float64)
+    # Each chip boundary that is passed adds the extra pixels of the
+    # two wide pixels at both sides, proportionally inside them
+    extra = crossFactor - 1
+    shift = numpy.zeros_like(values)
+    for c in range(1, chips):
+        edge = c * chipSize
+        shift += numpy.clip(values - (edge - 1), 0, 2) * extra
+    return values + shift
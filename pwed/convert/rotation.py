@@ -0,0 +1,120 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Estimation of the rotation axis from the spots found along a sweep.
+
+With the flat Ewald sphere of electron diffraction, each spot at detector
+position v (relative to the beam center) in a frame at rotation angle phi
+comes from the reciprocal lattice point R(phi) v, where R is the rotation
+about the axis. Spots of the same reflection in consecutive frames only
+map to the same point with the right axis, so the candidate axis that
+gives the most compact reconstruction, counted as the sum of squared
+occupancies of small voxels, is taken as the rotation axis.
+
+Angles of the axis are measured in the image, from the x (fast) axis
+towards the y (slow) axis, so only the line of the axis is found, not
+its sign.
+"""
+
+import numpy
+
+# Bits per voxel coordinate in the keys used to count occupancies
+_VOXEL_BITS = 18
+# Number of candidate axes evaluated at once, to limit memory
+_CHUNK_SIZE = 32
+
+
+def _reconstructionScores(dx, dy, phi, angles, voxel, offset):
+    """ Return the sum of squared voxel occupancies of the reconstruction
+    with each candidate axis angle (in radians).
+    """
+    size = 1 << _VOXEL_BITS
+    cosPhi, sinPhi = numpy.cos(phi), numpy.sin(phi)
+    scores = numpy.zeros(len(angles))
+
+    for first in range(0, len(angles), _CHUNK_SIZE):
+        theta = angles[first:first + _CHUNK_SIZE, None]
+        cosT, sinT = numpy.cos(theta), numpy.sin(theta)
+        along = cosT * dx + sinT * dy
+        across = cosT * dy - sinT * dx
+        # Rotation of (dx, dy, 0) by phi about (cosT, sinT, 0)
+        coords = [dx * cosPhi + cosT * along * (1 - cosPhi),
+                  dy * cosPhi + sinT * along * (1 - cosPhi),
+                  across * sinPhi]
+        keys = numpy.arange(len(theta), dtype=numpy.int64)[:, None]
+        for c in coords:
+            index = numpy.floor(c / voxel + offset).astype(numpy.int64)
+            keys = (keys << _VOXEL_BITS) + (index + size // 2) % size
+        values, counts = numpy.unique(keys, return_counts=True)
+        scores[first:first + len(theta)] = numpy.bincount(
+            values >> (3 * _VOXEL_BITS), counts.astype(numpy.float64) ** 2,
+            len(theta))
+    return scores
+
+
+def estimateRotationAxis(x, y, phi, beamCenter, step=1.0, voxel=2.0):
+    """ Estimate the angle (in degrees, between 0 and 180) of the
+    rotation axis in the image.
+
+    :param x, y: positions of the spots (pixels)
+    :param phi: rotation angle of the frame of each spot (degrees)
+    :param beamCenter: (x, y) of the beam center (pixels)
+    :param step: angular step between candidate axes (degrees)
+    :param voxel: size of the voxels in the reconstruction (pixels)
+    :return: (angle, scores), with the score of each candidate angle
+    """
+    dx = numpy.asarray(x, dtype=numpy.float64) - beamCenter[0]
+    dy = numpy.asarray(y, dtype=numpy.float64) - beamCenter[1]
+    phi = numpy.radians(numpy.asarray(phi, dtype=numpy.float64))
+    phi = phi - phi.min()
+    n = int(round(180.0 / step))
+    angles = numpy.radians(numpy.arange(2 * n) * step)
+
+    # Both directions of the axis, and a few shifts of the voxel grid,
+    # are added to make the scores less noisy
+    scores = sum(_reconstructionScores(dx, dy, phi, angles, voxel, offset)
+                 for offset in (0.0, 1 / 3.0, 2 / 3.0))
+    scores = scores[:n] + scores[n:]
+    k = max(1, int(round(2.0 / step)))
+    padded = numpy.concatenate([scores[-k:], scores, scores[:k]])
+    smoothed = numpy.convolve(padded, numpy.ones(2 * k + 1), 'valid')
+    return numpy.argmax(smoothed) * step, smoothed
+
+
+def getAxisVector(angle, reference=None):
+    """ Return the rotation axis vector, in the laboratory frame where
+    the image x axis is +x and the image y axis is -y, for an axis at
+    the given angle (degrees) in the image. If given, the sign is chosen
+    to agree with the reference vector.
+    """
+    theta = numpy.radians(angle)
+    axis = numpy.array([numpy.cos(theta), -numpy.sin(theta), 0.0])
+    if reference is not None and None not in reference:
+        if numpy.dot(axis, reference) < 0:
+            axis = -axis
+    return tuple(round(float(v), 6) + 0.0 for v in axis)
@@ -0,0 +1,170 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Sparse representation of diffraction frames.
+
+Frames from counting detectors with low dose are mostly zeros. A
+SparseFrame only keeps the flat (row-major) indexes and values of the
+non-zero pixels, sorted by index, so frames can be stored, summed or
+searched for bright pixels in time proportional to the counts.
+"""
+
+import numpy
+
+from pwed.constants import NO_INDEX
+from .formats import getReader, readImage
+
+# Data type of the pixel indexes
+INDEX_DTYPE = numpy.dtype('<u4')
+
+
+class SparseFrame:
+    """ Non-zero pixels of a 2D frame. """
+    def __init__(self, shape, indexes, values):
+        self.shape = tuple(shape)
+        self.indexes = indexes
+        self.values = values
+
+    @classmethod
+    def fromDense(cls, data):
+        data = numpy.asarray(data)
+        flat = data.reshape(-1)
+        indexes = numpy.flatnonzero(flat).astype(INDEX_DTYPE)
+        return cls(data.shape, indexes, flat[indexes])
+
+    @classmethod
+    def fromBytes(cls, block, shape, dtype):
+        """ Create the frame from the bytes written by toBytes. """
+        dtype = numpy.dtype(dtype)
+        nnz = len(block) // (INDEX_DTYPE.itemsize + dtype.itemsize)
+        indexes = numpy.frombuffer(block, dtype=INDEX_DTYPE, count=nnz)
+        values = numpy.frombuffer(block, dtype=dtype, count=nnz,
+                                  offset=nnz * INDEX_DTYPE.itemsize)
+        return cls(shape, indexes, values)
+
+    def toBytes(self):
+        """ Return the indexes followed by the values as bytes. """
+        return (self.indexes.astype(INDEX_DTYPE).tobytes()
+                + self.values.tobytes())
+
+    def toDense(self):
+        data = numpy.zeros(self.shape, dtype=self.values.dtype)
+        self.addTo(data)
+        return data
+
+    def addTo(self, data):
+        """ Add the values of this frame to the dense array data. """
+        data.reshape(-1)[self.indexes] += self.values
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def nnz(self):
+        """ Number of non-zero pixels. """
+        return len(self.indexes)
+
+    def getDensity(self):
+        """ Fraction of non-zero pixels. """
+        return self.nnz / float(self.shape[0] * self.shape[1])
+
+    def sum(self):
+        return self.values.sum(dtype=numpy.int64
+                               if self.values.dtype.kind in 'iu' else None)
+
+    def getCoordinates(self, minValue=None):
+        """ Return (rows, cols, values) of the non-zero pixels, or only
+        of those with at least minValue counts.
+        """
+        indexes, values = self.indexes, self.values
+        if minValue is not None:
+            mask = values >= minValue
+            indexes, values = indexes[mask], values[mask]
+        rows, cols = numpy.divmod(indexes.astype(numpy.int64), self.shape[1])
+        return rows, cols, values
+
+
+def readSparse(filename, index=NO_INDEX):
+    """ Return the image as a SparseFrame. It is read directly from
+    containers with sparse frames, other images are read as dense arrays
+    and converted.
+    """
+    reader = getReader(filename)
+    if hasattr(reader, 'readSparse'):
+        return reader.readSparse(filename, index)
+    return SparseFrame.fromDense(readImage(filename, index))
+
+
+def hasSparseData(filename):
+    """ Return True if the images of the file are stored as sparse
+    frames (e.g. binned events or sparse containers), so reading them
+    with readSparse is cheaper than reading the dense arrays.
+    """
+    reader = getReader(filename)
+    return reader is not None and reader.isSparse(filename)
+
+
+def addFrames(frames):
+    """ Return the sum of SparseFrames as a SparseFrame, with the
+    values of the pixels found in several frames added.
+    """
+    frames = list(frames)
+    if not frames:
+        raise Exception("There are no frames to sum.")
+    indexes = numpy.concatenate([f.indexes for f in frames])
+    values = numpy.concatenate([f.values for f in frames])
+    unique, inverse = numpy.unique(indexes, return_inverse=True)
+    sums = numpy.bincount(inverse, weights=values)
+    if values.dtype.kind in 'iub':
+        sums = sums.astype(numpy.int64)
+    return SparseFrame(frames[0].shape, unique.astype(INDEX_DTYPE), sums)
+
+
+def sumFrames(frames, dtype=numpy.int64):
+    """ Sum a list of frames, with sparse or dense arrays (or both).
+    Sparse frames are added with a single bincount of all their indexes.
+    """
+    frames = list(frames)
+    if not frames:
+        raise Exception("There are no frames to sum.")
+    shape = frames[0].shape
+    size = shape[0] * shape[1]
+    total = numpy.zeros(shape, dtype=dtype)
+
+    sparse = [f for f in frames if isinstance(f, SparseFrame)]
+    if sparse:
+        indexes = numpy.concatenate([f.indexes for f in sparse])
+        weights = numpy.concatenate([f.values for f in sparse])
+        total += numpy.bincount(indexes, weights=weights,
+                                minlength=size).reshape(shape).astype(dtype)
+
+    for f in frames:
+        if not isinstance(f, SparseFrame):
+            total += f
+    return total
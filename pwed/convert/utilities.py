@@ -1,3 +1,8 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+
 def find_subranges(lst: list) -> (int, int):
     """Takes a range of sequential numbers (possibly with gaps) and splits them
     in sequential sub-ranges defined by the minimum and maximum value.
@@ -9,4 +14,108 @@ def find_subranges(lst: list) -> (int, int):
 
     for key, group in groupby(enumerate(lst), lambda i: i[0] - i[1]):
         group = list(map(itemgetter(1), group))
-        yield min(group), max(group)
\ No newline at end of file
+        yield min(group), max(group)
+
+
+# Possible actions to bring input files into a project
+STAGE_COPY = 'copy'
+STAGE_LINK_ABS = 'abslink'
+STAGE_LINK_REL = 'rellink'
+STAGE_HARDLINK = 'hardlink'
+STAGE_REFLINK = 'reflink'
+
+# ioctl request to clone a file, from linux/fs.h
+FICLONE = 0x40049409
+
+
+def reflinkFile(source, dest):
+    """ Copy source into dest sharing the data blocks (copy-on-write)
+    if the filesystem supports it (e.g. btrfs or xfs), otherwise
+    do a regular copy.
+    """
+    try:
+        import fcntl
+        with open(source, 'rb') as fSrc, open(dest, 'wb') as fDst:
+            fcntl.ioctl(fDst.fileno(), FICLONE, fSrc.fileno())
+        shutil.copymode(source, dest)
+    except (ImportError, OSError):
+        shutil.copy(source, dest)
+
+
+def isStagedFile(source, dest, action):
+    """ Return True if dest already is the result of applying
+    the given action on source, so nothing needs to be done.
+    """
+    if not os.path.lexists(dest):
+        return False
+
+    if action in (STAGE_LINK_ABS, STAGE_LINK_REL):
+        return (os.path.islink(dest)
+                and os.path.isabs(os.readlink(dest)) == (action == STAGE_LINK_ABS)
+                and os.path.realpath(dest) == os.path.realpath(source))
+
+    if os.path.islink(dest):
+        return False
+
+    if action == STAGE_HARDLINK:
+        return os.path.samefile(source, dest)
+
+    # Copies are considered identical if they have the same size
+    # and are not older than the source
+    srcStat, dstStat = os.stat(source), os.stat(dest)
+    return (srcStat.st_size == dstStat.st_size
+            and dstStat.st_mtime >= srcStat.st_mtime)
+
+
+def stageFile(source, dest, action):
+    """ Copy or link source into dest, depending on the action.
+    Return False if dest was already staged and nothing was done.
+    """
+    if isStagedFile(source, dest, action):
+        return False
+
+    if os.path.lexists(dest):
+        os.remove(dest)
+
+    if action == STAGE_COPY:
+        shutil.copy(source, dest)
+    elif action == STAGE_LINK_ABS:
+        os.symlink(os.path.abspath(source), dest)
+    elif action == STAGE_LINK_REL:
+        os.symlink(os.path.relpath(os.path.abspath(source),
+                                   os.path.dirname(os.path.abspath(dest))),
+                   dest)
+    elif action == STAGE_HARDLINK:
+        os.link(source, dest)
+    elif action == STAGE_REFLINK:
+        reflinkFile(source, dest)
+    else:
+        raise Exception("Unknown action to stage files: %s" % action)
+
+    return True
+
+
+def stageFiles(filePairs, action, threads=1, progress=None):
+    """ Copy or link many files using a pool of threads.
+    Params:
+    :param filePairs: list of (source, dest) paths
+    :param action: one of the STAGE_* actions
+    :param threads: number of threads used
+    :param progress: optional function called as progress(done, total)
+    :return: number of files staged, files already staged are skipped
+    """
+    total = len(filePairs)
+    for folder in {os.path.dirname(dest) for _, dest in filePairs}:
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    staged = 0
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        results = executor.map(lambda p: stageFile(p[0], p[1], action),
+                               filePairs)
+        for done, result in enumerate(results, 1):
+            staged += int(result)
+            if progress is not None:
+                progress(done, total)
+
+    return staged
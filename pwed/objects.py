@@ -28,6 +28,8 @@
 # **************************************************************************
 
 import os
+import bisect
+import itertools
 import numpy
 
 import pyworkflow.object as pwobj
@@ -53,11 +55,76 @@ class EdBaseSet(pwobj.Set, EdBaseObject):
 class Detector(EdBaseObject):
     """ Store basic properties of detectors. """
 
+    # Gap remaps already computed, by gap specification
+    _remapCache = {}
+    # Bad pixel masks already loaded, by file
+    _maskCache = {}
+
     def __init__(self, **kwargs):
         EdBaseObject.__init__(self, **kwargs)
         # Detector type
         self._type = pwobj.String()
         self._serialNumber = pwobj.String()
+        # Gaps between chips: chip size, chips per axis and how many
+        # times wider the pixels at the chip edges are (empty if none)
+        self._gapSpec = pwobj.CsvList(pType=int)
+        # File with the bad pixel mask, shared by all images
+        # from the same detector
+        self._badPixelMaskFile = pwobj.String()
+
+    def getType(self):
+        return self._type.get()
+
+    def setType(self, value):
+        self._type.set(value)
+
+    def getSerialNumber(self):
+        return self._serialNumber.get()
+
+    def setSerialNumber(self, value):
+        self._serialNumber.set(value)
+
+    def getGapSpec(self):
+        """ Return (chipSize, chips, crossFactor) or None. """
+        return tuple(self._gapSpec) if len(self._gapSpec) else None
+
+    def setGapSpec(self, gapSpec):
+        self._gapSpec.set(list(gapSpec) if gapSpec else [])
+
+    def getGapRemap(self):
+        """ Return the (index, weights, rawShape) to correct the chip gaps,
+        see pwed.convert.remap. They are computed once per gap specification.
+        """
+        gapSpec = self.getGapSpec()
+        if gapSpec is None:
+            return None
+        if gapSpec not in self._remapCache:
+            from pwed.convert.remap import getRemap
+            self._remapCache[gapSpec] = getRemap(gapSpec)
+        return self._remapCache[gapSpec]
+
+    def getBadPixelMaskFile(self):
+        return self._badPixelMaskFile.get()
+
+    def setBadPixelMaskFile(self, filename):
+        self._badPixelMaskFile.set(filename)
+
+    def getBadPixelMask(self):
+        """ Return the boolean mask of bad pixels, or None (also if the
+        file does not exist anymore). The mask is loaded once and shared
+        by all detectors using the same file, until the file is modified.
+        """
+        filename = self.getBadPixelMaskFile()
+        if not filename:
+            return None
+        try:
+            key = (filename, os.path.getmtime(filename))
+        except OSError:
+            return None
+        if key not in self._maskCache:
+            from pwed.convert.processing import loadBadPixelMask
+            self._maskCache[key] = loadBadPixelMask(filename)
+        return self._maskCache[key]
 
 
 class DiffractionImage(EdBaseObject):
@@ -116,6 +183,27 @@ class DiffractionImage(EdBaseObject):
         self._rotY = pwobj.Float()
         self._rotZ = pwobj.Float()
 
+        # Size (in bytes) and modification time of the image file, used
+        # to find new or modified files when importing again
+        self._fileSize = pwobj.Integer()
+        self._fileMtime = pwobj.Float()
+
+        # Intensity statistics of the image, computed on import
+        self._statMean = pwobj.Float()
+        self._statMax = pwobj.Float()
+        self._statTotal = pwobj.Float()
+        self._statSaturated = pwobj.Integer()
+        self._statNonzero = pwobj.Float()
+
+        # Row of the image in the radial profiles of the set, and
+        # maximum score and number of ice rings found in the profile
+        self._profileIndex = pwobj.Integer()
+        self._iceRingScore = pwobj.Float()
+        self._iceRings = pwobj.Integer()
+
+        # Number of peaks found by hit finding
+        self._peakCount = pwobj.Integer()
+
         if location:
             self.setLocation(location)
 
@@ -247,7 +335,7 @@ class DiffractionImage(EdBaseObject):
         self._dimY.set(value)
 
     def getDetector(self):
-        return self._detector.get()
+        return self._detector
 
     def setDetector(self, detector):
         self._detector = detector
@@ -278,6 +366,49 @@ class DiffractionImage(EdBaseObject):
     def getIgnore(self):
         return self._ignore.get()
 
+    def setFileStat(self, size, mtime):
+        self._fileSize.set(size)
+        self._fileMtime.set(mtime)
+
+    def getFileStat(self):
+        return self._fileSize.get(), self._fileMtime.get()
+
+    def setStats(self, mean, maximum, total, saturated, nonzero):
+        """ Set the mean and max pixel value, total counts, number of
+        saturated pixels and fraction of non-zero pixels.
+        """
+        self._statMean.set(mean)
+        self._statMax.set(maximum)
+        self._statTotal.set(total)
+        self._statSaturated.set(saturated)
+        self._statNonzero.set(nonzero)
+
+    def getStats(self):
+        """ Return (mean, max, total, saturated, nonzero), see setStats. """
+        return (self._statMean.get(), self._statMax.get(),
+                self._statTotal.get(), self._statSaturated.get(),
+                self._statNonzero.get())
+
+    def getProfileIndex(self):
+        return self._profileIndex.get()
+
+    def setProfileIndex(self, value):
+        self._profileIndex.set(value)
+
+    def setIceRings(self, score, count):
+        """ Set the maximum ice ring score and the number of rings found. """
+        self._iceRingScore.set(score)
+        self._iceRings.set(count)
+
+    def getIceRings(self):
+        return self._iceRingScore.get(), self._iceRings.get()
+
+    def getPeakCount(self):
+        return self._peakCount.get()
+
+    def setPeakCount(self, value):
+        self._peakCount.set(value)
+
 
 class SetOfDiffractionImages(EdBaseSet):
     """ Represents a set of Images
@@ -285,10 +416,31 @@ class SetOfDiffractionImages(EdBaseSet):
     ITEM_TYPE = DiffractionImage
 
     def __init__(self, **kwargs):
+        # Index the oscillation start for queries by angle
+        kwargs.setdefault('indexes', ['_oscStart'])
         EdBaseSet.__init__(self, **kwargs)
         self._skipImages = pwobj.Integer()
         self._dialsModelPath = pwobj.String()
         self._dialsReflPath = pwobj.String()
+        # Numpy file with one radial profile per row
+        self._radialProfiles = pwobj.String()
+        self._radialBinWidth = pwobj.Float()
+        # Sorted oscillation ranges of the images, see getAngleIndex
+        self._angleIndex = None
+
+    def setRadialProfiles(self, filename, binWidth):
+        self._radialProfiles.set(filename)
+        self._radialBinWidth.set(binWidth)
+
+    def getRadialProfiles(self):
+        """ Return the memory mapped profiles (one row per image, see
+        DiffractionImage.getProfileIndex) and their bin width (pixels).
+        """
+        filename = self._radialProfiles.get()
+        if not filename:
+            return None, None
+        return (numpy.load(filename, mmap_mode='r'),
+                self._radialBinWidth.get())
 
     def setSkipImages(self, skip):
         self._skipImages.set(skip)
@@ -324,6 +476,228 @@ class SetOfDiffractionImages(EdBaseSet):
             filePaths.add(row['_filename'])
         return filePaths
 
+    def getFileStats(self):
+        """ Return a dict with the (size, mtime) of the file
+        of each image, using the image id as key.
+        """
+        if self.isEmpty():
+            return {}
+        values = self.getUniqueValues(['id', '_fileSize', '_fileMtime'])
+        return dict(zip(values['id'],
+                        zip(values['_fileSize'], values['_fileMtime'])))
+
+    def append(self, item):
+        EdBaseSet.append(self, item)
+        self._angleIndex = None
+
+    def update(self, item):
+        EdBaseSet.update(self, item)
+        self._angleIndex = None
+
+    def write(self, properties=True):
+        EdBaseSet.write(self, properties)
+        self._angleIndex = None
+
+    def load(self):
+        EdBaseSet.load(self)
+        self._angleIndex = None
+
+    def clear(self):
+        EdBaseSet.clear(self)
+        self._angleIndex = None
+
+    def getAngleIndex(self):
+        """ Return (first, last, ids) arrays with the lower and upper
+        rotation angles and the id of the images, sorted by the lower
+        angle. They are read once with a single query and kept until
+        the images of the set are modified (appended, updated, written
+        or loaded again).
+        """
+        if self._angleIndex is None:
+            values = self.getUniqueValues(['id', '_oscStart', '_oscRange'])
+            rows = [(i, s, r or 0) for i, s, r in zip(values['id'],
+                                                      values['_oscStart'],
+                                                      values['_oscRange'])
+                    if s is not None]
+            ids, start, oscRange = (numpy.array(rows).reshape(-1, 3).T
+                                    if rows else numpy.zeros((3, 0)))
+            ids, end = ids.astype(int), start + oscRange
+            first, last = numpy.minimum(start, end), numpy.maximum(start, end)
+            order = numpy.argsort(first, kind='stable')
+            self._angleIndex = (first[order], last[order], ids[order],
+                                (last - first).max() if len(ids) else 0)
+        return self._angleIndex[:3]
+
+    def framesInAngleRange(self, angle1, angle2):
+        """ Return the ids of the images whose oscillation overlaps the
+        rotation angles between angle1 and angle2 (degrees), sorted by
+        angle.
+        """
+        first, last, ids = self.getAngleIndex()
+        maxRange = self._angleIndex[3]
+        lo, hi = min(angle1, angle2), max(angle1, angle2)
+        i, j = numpy.searchsorted(first, [lo - maxRange, hi])
+        overlap = last[i:j] > lo
+        # Zero range images only overlap if their angle is inside
+        overlap |= (first[i:j] == last[i:j]) & (first[i:j] >= lo)
+        return ids[i:j][overlap].tolist()
+
+    def frameAtAngle(self, angle):
+        """ Return the id of the image whose oscillation contains the
+        rotation angle (degrees), or None.
+        """
+        first, last, ids = self.getAngleIndex()
+        i = int(numpy.searchsorted(first, angle, side='right')) - 1
+        # Oscillations could overlap, check the previous images too
+        while i >= 0 and first[i] >= angle - self._angleIndex[3]:
+            if first[i] <= angle < last[i]:
+                return int(ids[i])
+            i -= 1
+        return None
+
+
+class SubsetOfDiffractionImages(SetOfDiffractionImages):
+    """ Read-only view of some of the images of another set. Only the
+    ranges of selected ids are stored; the images are read from the
+    database of the parent set, that should not be deleted.
+    """
+    # With more id ranges than this, the selection is applied to the
+    # rows read from the database instead of in the SQL query
+    MAX_SQL_RANGES = 64
+
+    def __init__(self, **kwargs):
+        SetOfDiffractionImages.__init__(self, **kwargs)
+        # First and last id of each range of selected images
+        self._idRanges = pwobj.CsvList(pType=int)
+        self._ranges = None
+
+    def setSelection(self, parentSet, ids):
+        """ Select the images of parentSet with the given ids. """
+        from pwed.convert.utilities import find_subranges
+
+        self.close()
+        self._mapperPath.set('%s, %s' % (parentSet.getFileName(),
+                                         parentSet.getPrefix() or ''))
+        self.copyAttributes(parentSet, '_skipImages', '_dialsModelPath',
+                            '_dialsReflPath', '_radialProfiles',
+                            '_radialBinWidth')
+        ranges = list(find_subranges(sorted(set(ids))))
+        self._idRanges.set([i for r in ranges for i in r])
+        self._size.set(sum(last - first + 1 for first, last in ranges))
+        self._ranges = None
+        self._angleIndex = None
+
+    def getRanges(self):
+        """ Return the arrays with the first and last id of each range. """
+        if self._ranges is None:
+            ranges = numpy.array(self._idRanges, dtype=int).reshape(-1, 2)
+            self._ranges = (ranges[:, 0], ranges[:, 1])
+        return self._ranges
+
+    def isSelected(self, itemId):
+        first, last = self.getRanges()
+        i = int(numpy.searchsorted(first, itemId, side='right')) - 1
+        return i >= 0 and itemId <= last[i]
+
+    def _isRowSelected(self, row):
+        return self.isSelected(row['id'])
+
+    def _getSelection(self, where=None):
+        """ Return the SQL condition to select the images (and the where
+        condition, if given) and a row filter, if the condition is not
+        enough to select them.
+        """
+        first, last = self.getRanges()
+        rowFilter = None
+        if len(first) <= self.MAX_SQL_RANGES:
+            selection = ' OR '.join('id BETWEEN %d AND %d' % r
+                                    for r in zip(first, last))
+        else:
+            selection = 'id BETWEEN %d AND %d' % (first[0], last[-1])
+            rowFilter = self._isRowSelected
+        if where:
+            # Columns are translated here, the parenthesis would not
+            # let the mapper find them
+            where = self._getMapper().db._whereToWhereStr(where)
+            selection = '(%s) AND (%s)' % (where, selection)
+        return selection, rowFilter
+
+    def load(self):
+        # The size is the one of the selection, not of the parent set
+        size = self._size.get()
+        SetOfDiffractionImages.load(self)
+        self._size.set(size)
+
+    def iterItems(self, orderBy='id', direction='ASC', where=None,
+                  limit=None, iterate=True, rowFilter=None):
+        if self.isEmpty():
+            return iter([]) if iterate else []
+        selection, selFilter = self._getSelection(where)
+        if selFilter is None:
+            return SetOfDiffractionImages.iterItems(
+                self, orderBy=orderBy, direction=direction, where=selection,
+                limit=limit, iterate=iterate, rowFilter=rowFilter)
+
+        def _filter(row):
+            return selFilter(row) and (rowFilter is None or rowFilter(row))
+
+        items = SetOfDiffractionImages.iterItems(
+            self, orderBy=orderBy, direction=direction, where=selection,
+            iterate=iterate, rowFilter=_filter)
+        if limit:
+            limit, skip = limit if isinstance(limit, tuple) else (limit, 0)
+            items = itertools.islice(items, skip or 0, (skip or 0) + limit)
+            if not iterate:
+                items = list(items)
+        return items
+
+    def getFirstItem(self):
+        for item in self.iterItems(limit=1):
+            return item
+        return None
+
+    def __getitem__(self, itemId):
+        if isinstance(itemId, dict):
+            return SetOfDiffractionImages.__getitem__(self, itemId)
+        return (SetOfDiffractionImages.__getitem__(self, itemId)
+                if self.isSelected(itemId) else None)
+
+    def __contains__(self, itemId):
+        return self.isSelected(itemId) and \
+            SetOfDiffractionImages.__contains__(self, itemId)
+
+    def getUniqueValues(self, attributes, where=None):
+        if self.isEmpty():
+            return {a: [] for a in attributes} \
+                if isinstance(attributes, list) else []
+        selection, selFilter = self._getSelection(where)
+        if selFilter is None:
+            return SetOfDiffractionImages.getUniqueValues(self, attributes,
+                                                          selection)
+        labels = [attributes] if isinstance(attributes, str) else attributes
+        values = SetOfDiffractionImages.getUniqueValues(
+            self, ['id'] + [a for a in labels if a != 'id'], selection)
+        # Rows are not unique anymore once the ids are added to the query
+        rows = dict.fromkeys(tuple(values[a][i] for a in labels)
+                             for i, itemId in enumerate(values['id'])
+                             if self.isSelected(itemId))
+        if isinstance(attributes, str):
+            return [row[0] for row in rows]
+        return {a: [row[k] for row in rows] for k, a in enumerate(labels)}
+
+    def getFiles(self):
+        return set(self.getUniqueValues('_filename'))
+
+    def append(self, item):
+        raise Exception("Images can not be added to a subset, "
+                        "use setSelection.")
+
+    def write(self, properties=True):
+        """ Nothing is written, the selection is stored with the
+        attributes of this object and the images are in the parent set.
+        """
+        pass
+
 
 class DiffractionSpot(EdBaseObject):
     ''' Represents an individual diffraction spot. '''
@@ -503,3 +877,56 @@ class SetOfExportFiles(EdBaseSet):
 
     def __init__(self, **kwargs):
         EdBaseSet.__init__(self, **kwargs)
+
+
+class BackgroundStack(EdBaseObject):
+    """ Background images of a SetOfDiffractionImages, one per block of
+    consecutive images, stored in a container file. The block of an image
+    is found from the id of the first image of each block.
+    """
+    def __init__(self, **kwargs):
+        EdBaseObject.__init__(self, **kwargs)
+        self._filename = pwobj.String()
+        self._window = pwobj.Integer()
+        self._blockSize = pwobj.Integer()
+        self._method = pwobj.String()
+        self._blockStarts = pwobj.CsvList(pType=int)
+
+    def getFileName(self):
+        return self._filename.get()
+
+    def setFileName(self, filename):
+        self._filename.set(filename)
+
+    def getWindow(self):
+        return self._window.get()
+
+    def setWindow(self, value):
+        self._window.set(value)
+
+    def getBlockSize(self):
+        return self._blockSize.get()
+
+    def setBlockSize(self, value):
+        self._blockSize.set(value)
+
+    def getMethod(self):
+        return self._method.get()
+
+    def setMethod(self, value):
+        self._method.set(value)
+
+    def getBlockStarts(self):
+        return list(self._blockStarts)
+
+    def setBlockStarts(self, imageIds):
+        """ Set the ids of the first image of each block. """
+        self._blockStarts.set(list(imageIds))
+
+    def getSize(self):
+        return len(self._blockStarts)
+
+    def getLocation(self, imageId):
+        """ Return the (index, filename) of the background of the image. """
+        i = bisect.bisect_right(self.getBlockStarts(), imageId)
+        return max(i, 1), self.getFileName()
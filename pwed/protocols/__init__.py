@@ -26,3 +26,13 @@
 
 from .protocol_base import EdBaseProtocol, EdProtFindSpots, EdProtIndexSpots, EdProtRefineSpots, EdProtIntegrateSpots, EdProtExport
 from .protocol_import_diffraction_images import ProtImportDiffractionImages
+from .protocol_pack_images import ProtPackDiffractionImages
+from .protocol_import_events import ProtImportEvents
+from .protocol_bin_images import ProtBinImages
+from .protocol_background import ProtEstimateBackground
+from .protocol_bad_pixels import ProtBadPixelMask
+from .protocol_radial_profile import ProtRadialProfile
+from .protocol_beam_center import ProtFindBeamCenter
+from .protocol_rotation_axis import ProtFindRotationAxis
+from .protocol_hit_finding import ProtFindHits
+from .protocol_subset_images import ProtSubsetDiffractionImages
@@ -0,0 +1,137 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import pyworkflow.protocol as pwprot
+
+import pwed.convert as pwedconv
+from pwed.objects import BackgroundStack
+from .protocol_base import EdBaseProtocol
+
+
+class ProtEstimateBackground(EdBaseProtocol):
+    """ Estimate the background of each pixel along the rotation series,
+    with the mean or median of a rolling window of consecutive images.
+    One background image is written per block of images, into a container
+    that other protocols can memory map.
+    """
+    METHOD_MEAN = 0
+    METHOD_MEDIAN = 1
+
+    _label = 'estimate background'
+
+    # -------------------------- DEFINE param functions -----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputImages', pwprot.PointerParam,
+                      pointerClass='SetOfDiffractionImages',
+                      label="Input diffraction images")
+        form.addParam('method', pwprot.EnumParam,
+                      default=self.METHOD_MEDIAN,
+                      choices=['Mean', 'Median'],
+                      display=pwprot.EnumParam.DISPLAY_HLIST,
+                      label="Method",
+                      help="The median is not affected by the diffraction "
+                           "spots, the mean is faster.")
+        form.addParam('window', pwprot.IntParam, default=10,
+                      label="Window (images)",
+                      help="Number of consecutive images used to estimate "
+                           "the background.")
+        form.addParam('blockSize', pwprot.IntParam, default=10,
+                      label="Block size (images)",
+                      help="One background image is stored for each block "
+                           "of consecutive images, estimated from the "
+                           "window centered on the block.")
+
+    # -------------------------- INSERT functions ------------------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('estimateBackgroundStep',
+                                 self.inputImages.get().getObjId(),
+                                 self.getMethod(), self.window.get(),
+                                 self.blockSize.get())
+        self._insertFunctionStep('createOutputStep')
+
+    # -------------------------- STEPS functions -------------------------------
+    def estimateBackgroundStep(self, inputId, method, window, blockSize):
+        locations = self.getLocations()
+        blocks = pwedconv.getBackgroundBlocks(len(locations), blockSize,
+                                              window)
+        background = pwedconv.RollingBackground(window, method)
+        self.info("Estimating %d background images from %d images"
+                  % (len(blocks), len(locations)))
+
+        with pwedconv.ContainerWriter(self.getBackgroundFile()) as writer:
+            b = 0
+            for j, (index, fn) in enumerate(locations):
+                background.add(pwedconv.readImage(fn, index))
+                # Blocks whose window ends at this image
+                while b < len(blocks) and blocks[b][2] == j:
+                    first, last, _ = blocks[b]
+                    writer.addFrame({'FIRST_IMAGE': first + 1,
+                                     'LAST_IMAGE': last + 1},
+                                    background.getBackground())
+                    b += 1
+
+    def createOutputStep(self):
+        inputImages = self.inputImages.get()
+        ids = [img.getObjId() for img in inputImages.iterItems(orderBy='id')]
+        blocks = pwedconv.getBackgroundBlocks(len(ids), self.blockSize.get(),
+                                              self.window.get())
+        bg = BackgroundStack()
+        bg.setFileName(self.getBackgroundFile())
+        bg.setWindow(self.window.get())
+        bg.setBlockSize(self.blockSize.get())
+        bg.setMethod(self.getMethod())
+        bg.setBlockStarts([ids[first] for first, _, _ in blocks])
+        self._defineOutputs(outputBackground=bg)
+
+    # -------------------------- INFO functions -------------------------------
+    def _validate(self):
+        errors = []
+        if self.window.get() < 1 or self.blockSize.get() < 1:
+            errors.append("Window and block size should be at least 1.")
+        return errors
+
+    def _summary(self):
+        return ["%s of %d images, one background every %d images."
+                % (self.getMethod(), self.window.get(),
+                   self.blockSize.get())]
+
+    # -------------------------- UTILS functions ------------------------------
+    def getBackgroundFile(self):
+        return self._getExtraPath('background.edpack')
+
+    def getMethod(self):
+        return {
+            self.METHOD_MEAN: pwedconv.RollingBackground.MEAN,
+            self.METHOD_MEDIAN: pwedconv.RollingBackground.MEDIAN,
+        }[self.method.get()]
+
+    def getLocations(self):
+        """ Return the (index, filename) of the input images, by id. """
+        return [img.getLocation() for img
+                in self.inputImages.get().iterItems(orderBy='id')]
@@ -0,0 +1,137 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+
+import numpy
+import pyworkflow.protocol as pwprot
+import pyworkflow.utils as pwutils
+
+import pwed.convert as pwedconv
+from .protocol_base import EdBaseProtocol
+
+
+class ProtBadPixelMask(EdBaseProtocol):
+    """ Find the hot and dead pixels of the detector from the mean and
+    variance of each pixel over several images. The mask is written in
+    this protocol and, optionally, stored for the detector serial number
+    to be reused by later runs and imports.
+    """
+    _label = 'bad pixel mask'
+
+    # -------------------------- DEFINE param functions -----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputImages', pwprot.PointerParam,
+                      pointerClass='SetOfDiffractionImages',
+                      label="Input diffraction images")
+        form.addParam('numberOfImages', pwprot.IntParam, default=100,
+                      label="Number of images",
+                      help="Images used to compute the pixel statistics, "
+                           "evenly spread along the set.")
+        form.addParam('hotSigma', pwprot.FloatParam, default=5.0,
+                      label="Hot pixel threshold (sigma)",
+                      help="Pixels with a mean above the median of all "
+                           "pixels by more than this many times their "
+                           "spread are considered hot.")
+        form.addParam('recompute', pwprot.BooleanParam, default=False,
+                      label="Compute again?",
+                      help="By default, the last mask stored for the "
+                           "same detector serial number is reused.")
+        form.addParam('storeMask', pwprot.BooleanParam, default=True,
+                      label="Store for the detector?",
+                      help="Store the mask for the detector serial number, "
+                           "to be reused by other runs and imports. Stored "
+                           "masks are never overwritten.")
+
+    # -------------------------- INSERT functions ------------------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('computeMaskStep',
+                                 self.inputImages.get().getObjId(),
+                                 self.numberOfImages.get(),
+                                 self.hotSigma.get())
+        self._insertFunctionStep('createOutputStep')
+
+    # -------------------------- STEPS functions -------------------------------
+    def computeMaskStep(self, inputId, numberOfImages, hotSigma):
+        maskFile = self.getMaskFile()
+        serialNumber = self.getSerialNumber()
+        storedFile = (pwedconv.findBadPixelMaskFile(serialNumber)
+                      if serialNumber and not self.recompute.get() else None)
+        if storedFile:
+            self.info("Using stored mask: %s" % storedFile)
+            pwutils.copyFile(storedFile, maskFile)
+            return
+
+        images = [img.getLocation() for img
+                  in self.inputImages.get().iterItems(orderBy='id')]
+        step = max(1, len(images) // max(1, numberOfImages))
+        stats = pwedconv.PixelStatistics()
+        for index, fn in images[::step][:numberOfImages]:
+            stats.add(pwedconv.readImage(fn, index))
+
+        mask = pwedconv.findBadPixels(stats.getMean(), stats.getVariance(),
+                                      hotSigma=hotSigma)
+        self.info("Found %d bad pixels in %d images"
+                  % (numpy.count_nonzero(mask), stats.getCount()))
+        pwedconv.saveBadPixelMask(maskFile, mask)
+        if serialNumber and self.storeMask.get():
+            self.info("Stored mask: %s"
+                      % pwedconv.storeBadPixelMask(serialNumber, mask))
+
+    def createOutputStep(self):
+        inputImages = self.inputImages.get()
+        maskFile = self.getMaskFile()
+        outputSet = self._createSetOfDiffractionImages()
+        outputSet.setSkipImages(inputImages.getSkipImages())
+
+        for img in inputImages.iterItems(orderBy='id'):
+            newImg = img.clone()
+            newImg.getDetector().setBadPixelMaskFile(maskFile)
+            outputSet.append(newImg)
+
+        outputSet.write()
+        self._defineOutputs(outputDiffractionImages=outputSet)
+
+    # -------------------------- INFO functions -------------------------------
+    def _summary(self):
+        summary = []
+        maskFile = self.getMaskFile()
+        if os.path.exists(maskFile):
+            mask = pwedconv.loadBadPixelMask(maskFile)
+            summary.append("%d bad pixels (mask %s)."
+                           % (numpy.count_nonzero(mask), maskFile))
+        return summary
+
+    # -------------------------- UTILS functions ------------------------------
+    def getMaskFile(self):
+        return self._getExtraPath('badpixels.npz')
+
+    def getSerialNumber(self):
+        first = self.inputImages.get().getFirstItem()
+        return first.getDetector().getSerialNumber()
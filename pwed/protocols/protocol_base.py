@@ -38,21 +38,24 @@ class EdBaseProtocol(pwprot.Protocol):
     """
     _base = True
 
-    def __createSet(self, SetClass, template, suffix, **kwargs):
+    def __createSet(self, SetClass, template, suffix, clean=True, **kwargs):
         """ Create a set and set the filename using the suffix.
-        If the file exists, it will be deleted. """
+        If the file exists, it will be deleted, unless clean is False,
+        then the existing set will be loaded. """
         setFn = self._getPath(template % suffix)
         # Close the connection to the database if
         # it is open before deleting the file
-        pw.utils.cleanPath(setFn)
+        if clean:
+            pw.utils.cleanPath(setFn)
 
         SqliteDb.closeConnection(setFn)
         setObj = SetClass(filename=setFn, **kwargs)
         return setObj
 
-    def _createSetOfDiffractionImages(self, suffix=''):
+    def _createSetOfDiffractionImages(self, suffix='', clean=True):
         return self.__createSet(SetOfDiffractionImages,
-                                'diffraction-images%s.sqlite', suffix)
+                                'diffraction-images%s.sqlite', suffix,
+                                clean=clean)
 
     def _createSetOfSpots(self, suffix=''):
         return self.__createSet(SetOfSpots, 'diffraction-spots%s.sqlite', suffix)
@@ -0,0 +1,147 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import json
+
+import numpy
+import pyworkflow.protocol as pwprot
+
+import pwed.convert as pwedconv
+from .protocol_base import EdBaseProtocol
+
+
+class ProtFindBeamCenter(EdBaseProtocol):
+    """ Refine the beam center from the sum of the images. Frames are
+    added one by one to a running sum, so memory does not grow with the
+    number of images, and the center of symmetry of the sum (where each
+    pixel matches its Friedel mate) is used as the new beam center of
+    all output images.
+    """
+    _label = 'find beam center'
+
+    # -------------------------- DEFINE param functions -----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputImages', pwprot.PointerParam,
+                      pointerClass='SetOfDiffractionImages',
+                      label="Input diffraction images")
+        form.addParam('imageStep', pwprot.IntParam, default=1,
+                      label="Use every Nth image",
+                      help="Only add one of every N images to the sum, "
+                           "to speed up long sweeps.")
+        form.addParam('searchRadius', pwprot.FloatParam, default=20.0,
+                      label="Search radius (pixels)",
+                      help="Look for the center only within this distance "
+                           "of the beam center of the input images. Use 0 "
+                           "to search the whole image.")
+
+    # -------------------------- INSERT functions ------------------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('findCenterStep',
+                                 self.inputImages.get().getObjId(),
+                                 self.imageStep.get(),
+                                 self.searchRadius.get())
+        self._insertFunctionStep('createOutputStep')
+
+    # -------------------------- STEPS functions -------------------------------
+    def findCenterStep(self, inputId, imageStep, searchRadius):
+        inputImages = self.inputImages.get()
+        first = inputImages.getFirstItem()
+        if first is None:
+            raise Exception("There are no input images.")
+        guess = first.getBeamCenter()
+        mask = first.getDetector().getBadPixelMask()
+
+        total, count = None, 0
+        for i, img in enumerate(inputImages.iterItems(orderBy='id')):
+            if i % max(1, imageStep):
+                continue
+            data = pwedconv.readImage(img.getFileName(), img.getIndex())
+            if total is None:
+                total = numpy.zeros(data.shape, dtype=numpy.float64)
+            total += data
+            count += 1
+
+        if mask is not None and mask.shape != total.shape:
+            self.warning("Ignoring bad pixel mask with a different shape "
+                         "than the images.")
+            mask = None
+        numpy.save(self._getExtraPath('sum.npy'), total)
+
+        if searchRadius > 0 and None not in guess:
+            center = pwedconv.findBeamCenter(total, mask, guess,
+                                             searchRadius)
+        else:
+            center = pwedconv.findBeamCenter(total, mask)
+        self.info("Beam center from the sum of %d images: %0.2f, %0.2f "
+                  "(was %s, %s)" % (count, center[0], center[1],
+                                    guess[0], guess[1]))
+        with open(self.getCenterFile(), 'w') as f:
+            json.dump({'count': count, 'input': guess,
+                       'center': center}, f)
+
+    def createOutputStep(self):
+        inputImages = self.inputImages.get()
+        x, y = self.getCenter()['center']
+        outputSet = self._createSetOfDiffractionImages()
+        outputSet.setSkipImages(inputImages.getSkipImages())
+
+        for img in inputImages.iterItems(orderBy='id'):
+            newImg = img.clone()
+            newImg.setBeamCenter(x, y)
+            outputSet.append(newImg)
+
+        outputSet.write()
+        self._defineOutputs(outputDiffractionImages=outputSet)
+
+    # -------------------------- INFO functions -------------------------------
+    def _validate(self):
+        errors = []
+        inputImages = self.inputImages.get()
+        if inputImages is not None and inputImages.isEmpty():
+            errors.append("The input set has no images.")
+        if self.imageStep.get() < 1:
+            errors.append("The image step should be at least 1.")
+        return errors
+
+    def _summary(self):
+        summary = []
+        if hasattr(self, 'outputDiffractionImages'):
+            info = self.getCenter()
+            summary.append("Beam center %0.2f, %0.2f from %d images."
+                           % (info['center'][0], info['center'][1],
+                              info['count']))
+        return summary
+
+    # -------------------------- UTILS functions ------------------------------
+    def getCenterFile(self):
+        return self._getExtraPath('beam-center.json')
+
+    def getCenter(self):
+        with open(self.getCenterFile()) as f:
+            return json.load(f)
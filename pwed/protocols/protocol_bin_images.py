@@ -0,0 +1,175 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import bisect
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import pyworkflow.protocol as pwprot
+
+import pwed.convert as pwedconv
+from .protocol_base import EdBaseProtocol
+
+
+class ProtBinImages(EdBaseProtocol):
+    """ Reduce a set of diffraction images for quick screening, by
+    summing groups of consecutive frames and binning their pixels.
+    The reduced images are written into a single container file.
+    """
+    _label = 'bin and sum images'
+
+    # Groups of images read at once when creating the output
+    BATCH_SIZE = 256
+
+    # -------------------------- DEFINE param functions -----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputImages', pwprot.PointerParam,
+                      pointerClass='SetOfDiffractionImages',
+                      label="Input diffraction images")
+        form.addParam('binning', pwprot.IntParam, default=2,
+                      label="Binning factor",
+                      help="Sum blocks of NxN pixels (e.g. 2 or 4). "
+                           "Use 1 to keep the original pixels.")
+        form.addParam('sumFrames', pwprot.IntParam, default=1,
+                      label="Frames to sum",
+                      help="Sum every N consecutive frames into one. The "
+                           "oscillation range and exposure time of the "
+                           "output images are the sum of the input ones.")
+        form.addParam('binThreads', pwprot.IntParam, default=4,
+                      expertLevel=pwprot.LEVEL_ADVANCED,
+                      label="Threads",
+                      help="Number of groups of frames processed at once.")
+
+    # -------------------------- INSERT functions ------------------------------
+    def _insertAllSteps(self):
+        groups = self.getGroups()
+        self._insertFunctionStep('reduceStep',
+                                 self.inputImages.get().getObjId(),
+                                 self.binning.get(), self.sumFrames.get(),
+                                 groups)
+        self._insertFunctionStep('createOutputStep', groups)
+
+    # -------------------------- STEPS functions -------------------------------
+    def reduceStep(self, inputId, binning, sumFrames, groups):
+        threads = max(1, self.binThreads.get())
+        self.info("Reducing %d groups of %d frames with binning %d"
+                  % (len(groups), sumFrames, binning))
+
+        def _reduce(group):
+            locations = [img.getLocation() for img in group]
+            headers = [pwedconv.readImageHeader(fn, index)
+                       for index, fn in locations]
+            return (pwedconv.reduceHeader(headers, binning),
+                    pwedconv.reduceFrames(locations, binning))
+
+        # Groups are processed in batches to limit the memory used
+        done = 0
+        with pwedconv.ContainerWriter(self.getContainerFile()) as writer, \
+                ThreadPoolExecutor(max_workers=threads) as executor:
+            for batch in self.iterGroups(groups, threads * 4):
+                for header, data in executor.map(_reduce, batch):
+                    writer.addFrame(header, data)
+                done += len(batch)
+                self.info("Reduced groups: %d/%d" % (done, len(groups)))
+
+    def createOutputStep(self, groups):
+        inputImages = self.inputImages.get()
+        binning = self.binning.get()
+        containerFile = self.getContainerFile()
+        outputSet = self._createSetOfDiffractionImages()
+        outputSet.setSkipImages(inputImages.getSkipImages())
+
+        batches = self.iterGroups(groups, self.BATCH_SIZE)
+        for i, group in enumerate(itertools.chain.from_iterable(batches), 1):
+            img = group[0]
+            img.setLocation(i, containerFile)
+            start, _ = img.getOscillation()
+            ranges = [g.getOscillation()[1] for g in group]
+            if None not in ranges:
+                img.setOscillation(start, sum(ranges))
+            times = [g.getExposureTime() for g in group]
+            if None not in times:
+                img.setExposureTime(sum(times))
+            if binning > 1:
+                self._binImageInfo(img, binning)
+            outputSet.append(img)
+
+        outputSet.write()
+        self._defineOutputs(outputDiffractionImages=outputSet)
+
+    # -------------------------- INFO functions -------------------------------
+    def _validate(self):
+        errors = []
+        if self.binning.get() < 1 or self.sumFrames.get() < 1:
+            errors.append("Binning and frames to sum should be at least 1.")
+        return errors
+
+    def _summary(self):
+        return ["Binning %d, sum of %d frames."
+                % (self.binning.get(), self.sumFrames.get())]
+
+    # -------------------------- UTILS functions ------------------------------
+    def getContainerFile(self):
+        return self._getExtraPath('reduced-images.edpack')
+
+    def getGroups(self):
+        """ Return the (firstId, lastId) of the groups of sumFrames
+        consecutive input images. An incomplete last group is discarded.
+        """
+        n = self.sumFrames.get()
+        ids = sorted(self.inputImages.get().getIdSet())
+        return [(ids[i], ids[i + n - 1])
+                for i in range(0, len(ids) - n + 1, n)]
+
+    def iterGroups(self, groups, batchSize):
+        """ Yield lists of batchSize groups of input images (as lists of
+        images). The images of each batch are read with a single query,
+        so only a window of the input is in memory at a time.
+        """
+        inputImages = self.inputImages.get()
+        for i in range(0, len(groups), batchSize):
+            batch = groups[i:i + batchSize]
+            where = 'id>=%d AND id<=%d' % (batch[0][0], batch[-1][1])
+            images = [img.clone() for img
+                      in inputImages.iterItems(orderBy='id', where=where)]
+            lasts = [last for _, last in batch]
+            result = [[] for _ in batch]
+            for img in images:
+                result[bisect.bisect_left(lasts, img.getObjId())].append(img)
+            yield result
+
+    def _binImageInfo(self, img, binning):
+        if img.getPixelSize() is not None:
+            img.setPixelSize(img.getPixelSize() * binning)
+        dimX, _ = img.getDim()
+        if dimX is not None:
+            img.setDim(dimX // binning)
+        x, y = img.getBeamCenter()
+        if x is not None and y is not None:
+            img.setBeamCenter(x / binning, y / binning)
@@ -0,0 +1,132 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import pyworkflow.protocol as pwprot
+
+import pwed.convert as pwedconv
+from .protocol_base import EdBaseProtocol
+
+
+class ProtFindHits(EdBaseProtocol):
+    """ Find the hits of a serial ED collection, where most frames are
+    blank. The peaks above the background are counted in every frame,
+    and only the frames with enough peaks are kept in the output set.
+    """
+    _label = 'find hits'
+
+    # -------------------------- DEFINE param functions -----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputImages', pwprot.PointerParam,
+                      pointerClass='SetOfDiffractionImages',
+                      label="Input diffraction images")
+        form.addParam('peakSigma', pwprot.FloatParam, default=5.0,
+                      label="Peak threshold (sigma)",
+                      help="Peaks are local maxima above the background of "
+                           "the image by more than this many times the "
+                           "Poisson noise.")
+        form.addParam('minPeaks', pwprot.IntParam, default=10,
+                      label="Minimum number of peaks",
+                      help="Frames with at least this many peaks are hits.")
+        form.addParam('hitThreads', pwprot.IntParam, default=4,
+                      expertLevel=pwprot.LEVEL_ADVANCED,
+                      label="Threads")
+
+    # -------------------------- INSERT functions ------------------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('countPeaksStep',
+                                 self.inputImages.get().getObjId(),
+                                 self.peakSigma.get())
+        self._insertFunctionStep('createOutputStep')
+
+    # -------------------------- STEPS functions -------------------------------
+    def countPeaksStep(self, inputId, peakSigma):
+        inputImages = self.inputImages.get()
+        mask = inputImages.getFirstItem().getDetector().getBadPixelMask()
+        locations = [img.getLocation() for img
+                     in inputImages.iterItems(orderBy='id')]
+        counts = numpy.lib.format.open_memmap(
+            self.getCountsFile(), mode='w+', dtype=numpy.int32,
+            shape=(len(locations),))
+
+        def _count(location):
+            index, fn = location
+            # Sparse frames (e.g. binned events) are searched only
+            # in their non-zero pixels
+            if pwedconv.hasSparseData(fn):
+                data = pwedconv.readSparse(fn, index)
+            else:
+                data = pwedconv.readImage(fn, index)
+            valid = mask is not None and mask.shape == data.shape
+            return len(pwedconv.findPeaks(data, sigma=peakSigma,
+                                          mask=mask if valid else None)[0])
+
+        # Frames are processed in batches to report the progress
+        threads = max(1, self.hitThreads.get())
+        batchSize = threads * 64
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for i in range(0, len(locations), batchSize):
+                batch = locations[i:i + batchSize]
+                counts[i:i + len(batch)] = list(executor.map(_count, batch))
+                self.info("Counted peaks: %d/%d"
+                          % (i + len(batch), len(locations)))
+        counts.flush()
+
+    def createOutputStep(self):
+        inputImages = self.inputImages.get()
+        counts = numpy.load(self.getCountsFile())
+        minPeaks = self.minPeaks.get()
+        outputSet = self._createSetOfDiffractionImages()
+        outputSet.setSkipImages(inputImages.getSkipImages())
+
+        for img, count in zip(inputImages.iterItems(orderBy='id'), counts):
+            if count >= minPeaks:
+                newImg = img.clone()
+                newImg.setPeakCount(int(count))
+                outputSet.append(newImg)
+
+        outputSet.write()
+        self._defineOutputs(outputDiffractionImages=outputSet)
+
+    # -------------------------- INFO functions -------------------------------
+    def _summary(self):
+        summary = []
+        output = getattr(self, 'outputDiffractionImages', None)
+        if output is not None:
+            n = self.inputImages.get().getSize()
+            summary.append("%d hits in %d images (%0.1f%%)."
+                           % (output.getSize(), n,
+                              100.0 * output.getSize() / max(n, 1)))
+        return summary
+
+    # -------------------------- UTILS functions ------------------------------
+    def getCountsFile(self):
+        return self._getExtraPath('peak-counts.npy')
@@ -27,14 +27,13 @@
 # **************************************************************************
 
 import os
-import re
 import pathlib
-from glob import glob
+from functools import partial
 
-import pyworkflow as pw
 import pyworkflow.protocol as pwprot
 
-from pwed.objects import DiffractionImage, SetOfDiffractionImages
+import pwed.convert as pwedconv
+from pwed.convert import DiffractionImageImporter
 from .protocol_base import EdBaseProtocol
 
 
@@ -54,6 +53,8 @@ class ProtImportDiffractionImages(EdBaseProtocol):
     IMPORT_COPY_FILES = 0
     IMPORT_LINK_ABS = 1
     IMPORT_LINK_REL = 2
+    IMPORT_HARDLINK = 3
+    IMPORT_REFLINK = 4
 
     IMPORT_TYPE_MICS = 0
     IMPORT_TYPE_MOVS = 1
@@ -62,6 +63,9 @@ class ProtImportDiffractionImages(EdBaseProtocol):
     ANGLES_FROM_HEADER = 1
     ANGLES_FROM_MDOC = 2
 
+    GAPS_NONE = 0
+    GAPS_TIMEPIX_QUAD = 1
+
     _label = 'import diffraction images'
 
     # -------------------------- DEFINE param functions -----------------------
@@ -85,11 +89,65 @@ class ProtImportDiffractionImages(EdBaseProtocol):
                       default=self.IMPORT_LINK_REL,
                       choices=['Copy files',
                                'Absolute symlink',
-                               'Relative symlink'],
+                               'Relative symlink',
+                               'Hard link',
+                               'Reflink'],
                       display=pwprot.EnumParam.DISPLAY_HLIST,
                       expertLevel=pwprot.LEVEL_ADVANCED,
                       label="Import action on files",
-                      help="By default ...")
+                      help="By default, a relative symlink to each file is "
+                           "created in the project.\n"
+                           "Hard links only work if the files are in the "
+                           "same filesystem as the project.\n"
+                           "Reflink makes a copy-on-write clone of the files "
+                           "on filesystems that support it (e.g. btrfs or "
+                           "xfs), otherwise it will do a regular copy.\n"
+                           "Files already copied or linked in a previous run "
+                           "are not processed again.")
+        form.addParam('importThreads', pwprot.IntParam, default=4,
+                      expertLevel=pwprot.LEVEL_ADVANCED,
+                      label="Threads",
+                      help="Number of threads used to copy or link the "
+                           "files and to read their headers.")
+
+        form.addParam('resumeImport', pwprot.BooleanParam, default=True,
+                      expertLevel=pwprot.LEVEL_ADVANCED,
+                      label="Resume previous import?",
+                      help="When continuing this protocol, only the files "
+                           "that are new or have been modified since the "
+                           "previous execution will be imported. Otherwise, "
+                           "the output set is created again from scratch.")
+
+        form.addParam('extrapolateHeaders', pwprot.BooleanParam,
+                      default=False,
+                      expertLevel=pwprot.LEVEL_ADVANCED,
+                      label="Extrapolate headers?",
+                      help="For continuous rotation sweeps, only read the "
+                           "header of some images and extrapolate the "
+                           "starting angle of the others. If the sampled "
+                           "headers differ in anything else than the angle, "
+                           "or the angle is not linear with the image "
+                           "identifier, all headers will be read.")
+        form.addParam('headerStride', pwprot.IntParam, default=50,
+                      condition='extrapolateHeaders',
+                      expertLevel=pwprot.LEVEL_ADVANCED,
+                      label="Header sampling stride",
+                      help="Read the header of every N-th image, besides "
+                           "the first and last ones.")
+
+        form.addParam('computeStats', pwprot.BooleanParam, default=False,
+                      label="Compute image statistics?",
+                      help="Compute the mean, maximum, total counts, number "
+                           "of saturated pixels and fraction of non-zero "
+                           "pixels of each image, to find blank or "
+                           "saturated images without reading them again.")
+
+        form.addParam('useDetectorMask', pwprot.BooleanParam, default=False,
+                      expertLevel=pwprot.LEVEL_ADVANCED,
+                      label="Use stored detector mask?",
+                      help="Set the last bad pixel mask stored for the "
+                           "detector serial number (see the bad pixel mask "
+                           "protocol) in the imported images.")
 
         form.addParam('skipImages', pwprot.IntParam, default=None,
                       allowsNull=True,
@@ -112,6 +170,18 @@ class ProtImportDiffractionImages(EdBaseProtocol):
                       condition="replaceRotationAxis",
                       )
 
+        form.addParam('detectorGaps', pwprot.EnumParam,
+                      default=self.GAPS_NONE,
+                      choices=['None', 'Timepix quad'],
+                      display=pwprot.EnumParam.DISPLAY_HLIST,
+                      expertLevel=pwprot.LEVEL_ADVANCED,
+                      label="Detector chip gaps",
+                      help="Layout of the gaps between the detector chips "
+                           "in the raw images. A Timepix quad has 2x2 chips "
+                           "of 256x256 pixels, with 3 times wider pixels "
+                           "along the cross between them. The gaps can be "
+                           "corrected later when packing the images.")
+
         # Enable using template
         group = form.group = form.addGroup('Template input')
         group.addParam('useTemplate', pwprot.BooleanParam,
@@ -192,48 +262,43 @@ class ProtImportDiffractionImages(EdBaseProtocol):
     # -------------------------- INSERT functions ------------------------------
     def _insertAllSteps(self):
         self.loadPatterns()
-        self._insertFunctionStep('convertInputStep', self._pattern)
-        self._insertFunctionStep('createOutputStep')
+        # Changes in the files will make a continued execution run again
+        filesSignature = self._getFilesSignature()
+        self._insertFunctionStep('convertInputStep', self._pattern,
+                                 filesSignature)
+        self._insertFunctionStep('createOutputStep', filesSignature)
 
     # -------------------------- STEPS functions -------------------------------
-    def convertInputStep(self, pattern):
+    def convertInputStep(self, pattern, filesSignature=None):
         self.loadPatterns()
         self.info("Using glob pattern: '%s'" % self._globPattern)
         self.info("Using regex pattern: '%s'" % self._regexPattern)
 
-    def createOutputStep(self, **kwargs):
-        outputSet = self._createSetOfDiffractionImages()
+        filePairs = [(f, staged) for (f, _), (staged, _) in
+                     zip(self.getMatchingFiles(), self.getStagedFiles())]
+        self.info("Importing %d files (%s)"
+                  % (len(filePairs), self.getEnumText('importAction')))
+        staged = pwedconv.stageFiles(filePairs, self.getImportAction(),
+                                     threads=self.importThreads.get(),
+                                     progress=self._logStagingProgress)
+        self.info("%d files imported, %d were already imported."
+                  % (staged, len(filePairs) - staged))
+
+    def createOutputStep(self, filesSignature=None, **kwargs):
+        outputSet = self._createSetOfDiffractionImages(
+            clean=not self.resumeImport.get())
         outputSet.setDialsModel(kwargs.get('dialsModel'))
         outputSet.setSkipImages(self.skipImages.get())
 
-        dImg = DiffractionImage()
-
-        for f, ti in self.getMatchingFiles():
-            dImg.setFileName(f)
-            dImg.setObjId(int(ti))
-            if self.skipImages.get() is not None:
-                dImg.setIgnore(true_or_false=bool(int(ti) %
-                                                  self.skipImages.get() == 0))
-            if self.getRotationAxis():
-                dImg.setRotationAxis(self.getRotationAxis())
-
-            try:
-                if f.endswith('.img'):
-                    h = self.readSmvHeader(f)
-                    dImg.setPixelSize(float(h.get('PIXEL_SIZE')))
-                    dImg.setDim(int(h.get('SIZE1')))
-                    dImg.setWavelength(float(h.get('WAVELENGTH')))
-                    dImg.setDistance(float(h.get('DISTANCE')))
-                    dImg.setOscillation(float(h.get('OSC_START')),
-                                        float(h.get('OSC_RANGE')))
-                    dImg.setBeamCenter(float(h.get('BEAM_CENTER_X')),
-                                       float(h.get('BEAM_CENTER_Y')))
-                    dImg.setExposureTime(float(h.get('TIME')))
-                    dImg.setTwoTheta(float(h.get('TWOTHETA')))
-            except Exception as e:
-                print(e)
-
-            outputSet.append(dImg)
+        # Changes are found in the source files, the staged files are
+        # copies or links made by this protocol
+        importer = self.getFilesImporter()
+        fileStats = [importer.getFileStat(f)
+                     for f, _ in self.getMatchingFiles()]
+        n = importer.importImages(outputSet, self.getStagedFiles(),
+                                  fileStats=fileStats)
+        self.info("%d new or modified images, %d images in total."
+                  % (n, outputSet.getSize()))
 
         outputSet.write()
 
@@ -264,36 +329,80 @@ class ProtImportDiffractionImages(EdBaseProtocol):
         """ Expand the pattern using environ vars or username
         and also replacing special character # by digit matching.
         """
-        self._pattern = os.path.join(self.filesPath.get('').strip(),
-                                     self.filesPattern.get('').strip())
-
-        def _replace(p, ti):
-            p = p.replace('{TI}', ti)
-            return p
-
-        self._regexPattern = _replace(self._pattern.replace('*', '(.*)'),
-                                      r'(?P<TI>\d+)')
-        self._regex = re.compile(self._regexPattern)
-        self._globPattern = _replace(self._pattern, '*')
-        self._templatePattern = _replace(
-            self._pattern, self.tsReplacement.get())
+        importer = self.getImporter()
+        self._pattern = importer.getPattern()
+        self._regexPattern = importer.getRegexPattern()
+        self._globPattern = importer.getGlobPattern()
+        # The output images are the staged files, so is the template
+        self._templatePattern = self.getStagedPattern().replace(
+            '{TI}', self.tsReplacement.get())
+
+    def getImporter(self):
+        """ Return a DiffractionImageImporter configured with
+        the values of this protocol.
+        """
+        pattern = os.path.join(self.filesPath.get('').strip(),
+                               self.filesPattern.get('').strip())
+        headerStride = (self.headerStride.get()
+                        if self.extrapolateHeaders.get() else None)
+        return DiffractionImageImporter(pattern,
+                                        overwrites=self._overwriteParams(),
+                                        skipImages=self.skipImages.get(),
+                                        rotationAxis=self.getRotationAxis(),
+                                        threads=self.importThreads.get(),
+                                        headerStride=headerStride,
+                                        gapSpec=self.getGapSpec(),
+                                        computeStats=self.computeStats.get(),
+                                        detectorMasks=self.useDetectorMask.get())
+
+    def getFilesImporter(self):
+        """ Return the importer that lists the matching files (and keeps
+        their size and mtime). It is cached in this protocol instance
+        until the pattern changes.
+        """
+        importer = self.getImporter()
+        cached = getattr(self, '_filesImporter', None)
+        if cached is None or cached.getPattern() != importer.getPattern():
+            cached = self._filesImporter = importer
+        return cached
 
     def getMatchingFiles(self):
-        """ Return a sorted list with the paths of files that
-        matched the pattern.
+        """ Return a list with (path, TI) of files that matched
+        the pattern, sorted by TI.
         """
-        self.loadPatterns()
-
-        filePaths = glob(self._globPattern)
-        filePaths.sort()
+        return self.getFilesImporter().getMatchingFiles()
 
-        matchingFiles = []
-        for f in filePaths:
-            m = self._regex.match(f)
-            if m is not None:
-                matchingFiles.append((f, int(m.group('TI'))))
-
-        return matchingFiles
+    def getStagedFiles(self):
+        """ Return a list with (path, TI) of the files copied or linked
+        into the project, in the same order as getMatchingFiles.
+        The folders structure is kept relative to the common folder
+        of all matching files.
+        """
+        matchingFiles = self.getMatchingFiles()
+        if not matchingFiles:
+            return []
+        root = self._getStagingRoot(matchingFiles)
+        return [(self._getExtraPath(os.path.relpath(os.path.abspath(f), root)),
+                 ti) for f, ti in matchingFiles]
+
+    def getStagedPattern(self):
+        """ Return the files pattern of the staged files (or the input
+        pattern if no file matches it yet).
+        """
+        importer = self.getFilesImporter()
+        matchingFiles = importer.getMatchingFiles()
+        if not matchingFiles:
+            return importer.getPattern()
+        root = self._getStagingRoot(matchingFiles)
+        return self._getExtraPath(
+            os.path.relpath(os.path.abspath(importer.getPattern()), root))
+
+    def _getStagingRoot(self, matchingFiles):
+        """ Common folder of the matching files, which is the extra
+        folder once they are staged.
+        """
+        return os.path.commonpath([os.path.dirname(os.path.abspath(f))
+                                   for f, _ in matchingFiles])
 
     def getRotationAxis(self):
         try:
@@ -304,6 +413,13 @@ class ProtImportDiffractionImages(EdBaseProtocol):
             axis = None
         return axis
 
+    def getGapSpec(self):
+        """ Return the gap specification of the selected detectorGaps. """
+        return {
+            self.GAPS_NONE: None,
+            self.GAPS_TIMEPIX_QUAD: pwedconv.TIMEPIX_QUAD,
+        }[self.detectorGaps.get()]
+
     def getFileParents(self, file_list):
         uniquePaths = []
         for f in file_list:
@@ -315,46 +431,40 @@ class ProtImportDiffractionImages(EdBaseProtocol):
         else:
             return uniquePaths
 
+    def _getFilesSignature(self):
+        """ Return the number of matching files and the latest
+        modification time among them.
+        """
+        matchingFiles = self.getMatchingFiles()
+        importer = self.getFilesImporter()
+        lastMtime = max((importer.getFileStat(f)[1]
+                         for f, _ in matchingFiles), default=0)
+        return [len(matchingFiles), lastMtime]
+
+    def getImportAction(self):
+        """ Return the pwed.convert STAGE_* action for the
+        selected importAction.
+        """
+        return {
+            self.IMPORT_COPY_FILES: pwedconv.STAGE_COPY,
+            self.IMPORT_LINK_ABS: pwedconv.STAGE_LINK_ABS,
+            self.IMPORT_LINK_REL: pwedconv.STAGE_LINK_REL,
+            self.IMPORT_HARDLINK: pwedconv.STAGE_HARDLINK,
+            self.IMPORT_REFLINK: pwedconv.STAGE_REFLINK,
+        }[self.importAction.get()]
+
     def getCopyOrLink(self):
-        # Set a function to copyFile or createLink
-        # depending in the user selected option
-        if self.copyFiles:
-            return pw.utils.copyFile
-        else:
-            return pw.utils.createAbsLink
+        """ Return a function(source, dest) to copy or link a file,
+        depending in the user selected option.
+        """
+        return partial(pwedconv.stageFile, action=self.getImportAction())
+
+    def _logStagingProgress(self, done, total):
+        if done == total or done % max(1, total // 10) == 0:
+            self.info("Imported files: %d/%d" % (done, total))
 
     def readSmvHeader(self, image_file):
-        # Reimplemented from get_smv_header in
-        # https://github.com/dials/dxtbx/blob/master/format/FormatSMV.py
-        with open(image_file, "rb") as fh:
-            header_info = fh.read(45).decode("ascii", "ignore")
-            header_size = int(
-                header_info.split("\n")[1].split(
-                    "=")[1].replace(";", "").strip()
-            )
-            header_text = fh.read(header_size).decode("ascii", "ignore")
-        header_dictionary = {}
-
-        # Check that we have the whole header, contained within { }.  Stop
-        # extracting data once a record solely composed of a closing curly
-        # brace is seen.  If there is no such character in header_text
-        # either HEADER_BYTES caused a short read of the header or the
-        # header is malformed.
-
-        overwrites = self._overwriteParams()
-
-        for record in header_text.split("\n"):
-            if record == "}":
-                break
-            if "=" not in record:
-                continue
-
-            key, value = record.replace(";", "").split("=")
-
-            header_dictionary[key.strip()] = value.strip()
-            header_dictionary.update(overwrites)
-
-        return header_dictionary
+        return self.getImporter().readSmvHeader(image_file)
 
     def _overwriteParams(self):
         new_params = {}
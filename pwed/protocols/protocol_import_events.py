@@ -0,0 +1,164 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import pyworkflow.protocol as pwprot
+
+import pwed.convert as pwedconv
+from pwed.convert import DiffractionImageImporter
+from pwed.objects import DiffractionImage
+from .protocol_base import EdBaseProtocol
+
+
+class ProtImportEvents(EdBaseProtocol):
+    """ Import the events recorded by a counting detector (e.g. Timepix)
+    as virtual diffraction images, binning the events in frames of a
+    given time or rotation width. The events are never converted into
+    dense images, so the same file can be imported again with a
+    different width quickly.
+    """
+    WIDTH_TIME = 0
+    WIDTH_ANGLE = 1
+
+    _label = 'import events'
+
+    # -------------------------- DEFINE param functions -----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Import')
+
+        form.addParam('eventsFile', pwprot.PathParam,
+                      label="Events file",
+                      help="Numpy (.npy) file with a structured array of "
+                           "events with fields x, y and toa (time of "
+                           "arrival), sorted by toa.")
+        form.addParam('toaUnit', pwprot.FloatParam, default=1.5625e-9,
+                      label="Time of arrival unit (s)",
+                      help="Seconds per tick of the toa values.")
+        form.addParam('frameWidthType', pwprot.EnumParam,
+                      default=self.WIDTH_TIME,
+                      choices=['Time', 'Angle'],
+                      display=pwprot.EnumParam.DISPLAY_HLIST,
+                      label="Frame width in")
+        form.addParam('frameTime', pwprot.FloatParam, default=0.5,
+                      condition='frameWidthType==%d' % self.WIDTH_TIME,
+                      label="Frame time (s)")
+        form.addParam('frameAngle', pwprot.FloatParam, default=0.5,
+                      condition='frameWidthType==%d' % self.WIDTH_ANGLE,
+                      label="Frame oscillation (deg)")
+        form.addParam('oscStart', pwprot.FloatParam, default=0.0,
+                      label="Starting angle (deg)",
+                      help="Rotation angle at the first event.")
+        form.addParam('rotationSpeed', pwprot.FloatParam, default=1.0,
+                      label="Rotation speed (deg/s)")
+
+        group = form.addGroup('Geometry')
+        group.addParam('size1', pwprot.IntParam, default=512,
+                       label="Size1 (pixels)")
+        group.addParam('size2', pwprot.IntParam, default=512,
+                       label="Size2 (pixels)")
+        group.addParam('pixelSize', pwprot.FloatParam, default=0.055,
+                       label="Pixel size (mm)")
+        group.addParam('wavelength', pwprot.FloatParam, default=0.0251,
+                       label="Wavelength (A)")
+        group.addParam('distance', pwprot.FloatParam, default=None,
+                       allowsNull=True,
+                       label="Detector distance (mm)")
+        group.addParam('beamCenterX', pwprot.FloatParam, default=None,
+                       allowsNull=True,
+                       label="Beam center X (pixels)")
+        group.addParam('beamCenterY', pwprot.FloatParam, default=None,
+                       allowsNull=True,
+                       label="Beam center Y (pixels)")
+
+    # -------------------------- INSERT functions ------------------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('binEventsStep', self.eventsFile.get(),
+                                 self.getFrameTime())
+        self._insertFunctionStep('createOutputStep')
+
+    # -------------------------- STEPS functions -------------------------------
+    def binEventsStep(self, eventsFile, frameTime):
+        events = pwedconv.loadEvents(eventsFile)
+        self.info("Checking %d events" % len(events))
+        pwedconv.checkSorted(events)
+
+        shape = (self.size2.get(), self.size1.get())
+        offsets = pwedconv.binEvents(eventsFile,
+                                     frameTime / self.toaUnit.get(),
+                                     shape=shape)
+        pwedconv.writeBinning(self.getBinningFile(), eventsFile, shape,
+                              offsets, header=self.getHeader(),
+                              oscStart=self.oscStart.get(),
+                              oscRange=frameTime * self.rotationSpeed.get(),
+                              frameTime=frameTime)
+        self.info("Binned events into %d frames of %0.4f s"
+                  % (len(offsets) - 1, frameTime))
+
+    def createOutputStep(self):
+        binningFile = self.getBinningFile()
+        reader = pwedconv.getReader(binningFile)
+        importer = DiffractionImageImporter(binningFile)
+        outputSet = self._createSetOfDiffractionImages()
+
+        for i in range(1, reader.getSize(binningFile) + 1):
+            dImg = DiffractionImage()
+            importer.setImageInfo(dImg, binningFile, i,
+                                  reader.readHeader(binningFile, i))
+            dImg.setLocation(i, binningFile)
+            outputSet.append(dImg)
+
+        outputSet.write()
+        self._defineOutputs(outputDiffractionImages=outputSet)
+
+    # -------------------------- INFO functions -------------------------------
+    def _validate(self):
+        errors = []
+        if self.getFrameTime() <= 0:
+            errors.append("The frame width and rotation speed should be "
+                          "positive.")
+        return errors
+
+    # -------------------------- UTILS functions ------------------------------
+    def getBinningFile(self):
+        return self._getExtraPath('frames' + pwedconv.BINNING_EXTENSION)
+
+    def getFrameTime(self):
+        """ Return the time (in seconds) of each frame. """
+        if self.frameWidthType.get() == self.WIDTH_ANGLE:
+            speed = self.rotationSpeed.get()
+            return self.frameAngle.get() / speed if speed else 0
+        return self.frameTime.get()
+
+    def getHeader(self):
+        """ Return the header values, with SMV keys, of all frames. """
+        header = {'PIXEL_SIZE': self.pixelSize.get(),
+                  'WAVELENGTH': self.wavelength.get(),
+                  'DISTANCE': self.distance.get()}
+        if self.beamCenterX.hasValue() and self.beamCenterY.hasValue():
+            header['BEAM_CENTER_X'] = self.beamCenterX.get()
+            header['BEAM_CENTER_Y'] = self.beamCenterY.get()
+        return {k: str(v) for k, v in header.items() if v is not None}
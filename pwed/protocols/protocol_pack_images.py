@@ -0,0 +1,187 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+
+import pyworkflow.protocol as pwprot
+import pyworkflow.utils as pwutils
+
+import pwed.convert as pwedconv
+from .protocol_base import EdBaseProtocol
+
+
+class ProtPackDiffractionImages(EdBaseProtocol):
+    """ Pack a set of diffraction images into a single container file.
+    The output images point into the container with (index, filename),
+    so reading them is a slice of a memory mapped stack (or the
+    decompression of a single chunk) instead of opening one file
+    per image.
+    """
+    COMPRESS_NONE = 0
+    COMPRESS_ZLIB = 1
+    COMPRESS_BZ2 = 2
+    COMPRESS_LZMA = 3
+    COMPRESS_SPARSE = 4
+
+    _label = 'pack images'
+
+    # -------------------------- DEFINE param functions -----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputImages', pwprot.PointerParam,
+                      pointerClass='SetOfDiffractionImages',
+                      label="Input diffraction images",
+                      help="Images to pack into a single file.")
+        form.addParam('compression', pwprot.EnumParam,
+                      default=self.COMPRESS_NONE,
+                      choices=['None', 'zlib', 'bz2', 'lzma', 'Sparse'],
+                      display=pwprot.EnumParam.DISPLAY_HLIST,
+                      label="Compression",
+                      help="Without compression, the images can be memory "
+                           "mapped from the container. Otherwise each image "
+                           "is compressed separately and decompressed when "
+                           "it is read.\n"
+                           "Sparse only stores the non-zero pixels, which is "
+                           "much smaller and faster to sum or search for "
+                           "spots with low-dose data.")
+        form.addParam('correctGaps', pwprot.BooleanParam, default=False,
+                      label="Correct detector chip gaps?",
+                      help="Split the wide pixels between the detector "
+                           "chips into pixels of normal size, if the input "
+                           "images have a chip gaps layout (e.g. a 512x512 "
+                           "Timepix quad is corrected to 516x516). The "
+                           "corrected images are stored as float32.")
+
+    # -------------------------- INSERT functions ------------------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('packStep', self.inputImages.get().getObjId(),
+                                 self.compression.get(),
+                                 self.correctGaps.get())
+        self._insertFunctionStep('createOutputStep')
+
+    # -------------------------- STEPS functions -------------------------------
+    def packStep(self, inputId, compression, correctGaps):
+        inputImages = self.inputImages.get()
+        n = inputImages.getSize()
+        self.info("Packing %d images into %s" % (n, self.getContainerFile()))
+
+        with pwedconv.ContainerWriter(self.getContainerFile(),
+                                      codec=self.getCodec()) as writer:
+            for i, img in enumerate(inputImages.iterItems(orderBy='id'), 1):
+                index, fn = img.getLocation()
+                data = pwedconv.readImage(fn, index)
+                remap = self.getGapRemap(img)
+                if remap is not None:
+                    data = pwedconv.correctGaps(data, remap)
+                writer.addFrame(pwedconv.readImageHeader(fn, index), data)
+                if i == n or i % max(1, n // 10) == 0:
+                    self.info("Packed images: %d/%d" % (i, n))
+
+    def createOutputStep(self):
+        inputImages = self.inputImages.get()
+        containerFile = self.getContainerFile()
+        outputSet = self._createSetOfDiffractionImages()
+        outputSet.setSkipImages(inputImages.getSkipImages())
+        outputSet.setDialsModel(inputImages.getDialsModel())
+
+        # Images are in the container in the same order as packed
+        maskFiles = {}
+        for i, img in enumerate(inputImages.iterItems(orderBy='id'), 1):
+            newImg = img.clone()
+            newImg.setLocation(i, containerFile)
+            detector = img.getDetector()
+            gapSpec = detector.getGapSpec()
+            if self.getGapRemap(img) is not None:
+                newImg.setDim(pwedconv.getCorrectedSize(*gapSpec))
+                x, y = img.getBeamCenter()
+                if x is not None and y is not None:
+                    newImg.setBeamCenter(
+                        float(pwedconv.correctCoordinates(x, gapSpec)),
+                        float(pwedconv.correctCoordinates(y, gapSpec)))
+                newDetector = newImg.getDetector()
+                newDetector.setGapSpec(None)
+                newDetector.setBadPixelMaskFile(
+                    self.getCorrectedMaskFile(detector, maskFiles))
+            outputSet.append(newImg)
+
+        outputSet.write()
+        self._defineOutputs(outputDiffractionImages=outputSet)
+
+    # -------------------------- INFO functions -------------------------------
+    def _summary(self):
+        summary = []
+        containerFile = self.getContainerFile()
+        if os.path.exists(containerFile):
+            summary.append("Packed %d images into %s (%s)."
+                           % (self.inputImages.get().getSize(),
+                              os.path.basename(containerFile),
+                              pwutils.prettySize(
+                                  os.path.getsize(containerFile))))
+        return summary
+
+    # -------------------------- UTILS functions ------------------------------
+    def getContainerFile(self):
+        return self._getExtraPath('images.edpack')
+
+    def getGapRemap(self, img):
+        """ Return the gap remap for the detector of img if the
+        gaps should be corrected, or None.
+        """
+        if not self.correctGaps.get():
+            return None
+        return img.getDetector().getGapRemap()
+
+    def getCorrectedMaskFile(self, detector, maskFiles):
+        """ Return the file with the gap corrected bad pixel mask of the
+        detector (written once per raw mask file into the extra folder),
+        or None if the detector has no mask.
+        """
+        rawFile = detector.getBadPixelMaskFile()
+        if rawFile not in maskFiles:
+            mask = detector.getBadPixelMask()
+            if mask is None:
+                maskFiles[rawFile] = None
+            else:
+                # A corrected pixel is bad if any raw pixel it takes
+                # counts from is bad
+                corrected = pwedconv.correctGaps(mask,
+                                                 detector.getGapRemap()) > 0
+                maskFiles[rawFile] = self._getExtraPath(
+                    'badpixels-%d.npz' % (len(maskFiles) + 1))
+                pwedconv.saveBadPixelMask(maskFiles[rawFile], corrected)
+        return maskFiles[rawFile]
+
+    def getCodec(self):
+        """ Return the container codec for the selected compression. """
+        return {
+            self.COMPRESS_NONE: None,
+            self.COMPRESS_ZLIB: 'zlib',
+            self.COMPRESS_BZ2: 'bz2',
+            self.COMPRESS_LZMA: 'lzma',
+            self.COMPRESS_SPARSE: pwedconv.SPARSE,
+        }[self.compression.get()]
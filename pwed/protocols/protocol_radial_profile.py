@@ -0,0 +1,160 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import pyworkflow.protocol as pwprot
+
+import pwed.convert as pwedconv
+from .protocol_base import EdBaseProtocol
+
+
+class ProtRadialProfile(EdBaseProtocol):
+    """ Compute the radial profile of every image and look for ice rings
+    (or other powder rings) in them. Profiles are stored with the output
+    set, one row per image, and each image gets the score and number of
+    ice rings found, to select the affected images with a query.
+    """
+    _label = 'radial profile'
+
+    # -------------------------- DEFINE param functions -----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputImages', pwprot.PointerParam,
+                      pointerClass='SetOfDiffractionImages',
+                      label="Input diffraction images")
+        form.addParam('binWidth', pwprot.FloatParam, default=1.0,
+                      label="Radial bin width (pixels)")
+        form.addParam('iceThreshold', pwprot.FloatParam, default=5.0,
+                      label="Ice ring threshold",
+                      help="An ice ring is found when the profile at its "
+                           "resolution is above the surrounding profile by "
+                           "more than this many standard deviations.")
+        form.addParam('profileThreads', pwprot.IntParam, default=4,
+                      expertLevel=pwprot.LEVEL_ADVANCED,
+                      label="Threads")
+
+    # -------------------------- INSERT functions ------------------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('computeProfilesStep',
+                                 self.inputImages.get().getObjId(),
+                                 self.binWidth.get(), self.iceThreshold.get())
+        self._insertFunctionStep('createOutputStep')
+
+    # -------------------------- STEPS functions -------------------------------
+    def computeProfilesStep(self, inputId, binWidth, iceThreshold):
+        inputImages = self.inputImages.get()
+        n = inputImages.getSize()
+        cache = pwedconv.getGeometryCache()
+        geometries = set(pwedconv.getGeometry(img)
+                         for img in inputImages.iterItems())
+        nBins = max(len(cache.getMaps(g, binWidth)['binResolution'])
+                    for g in geometries)
+        self.info("Computing %d radial profiles of up to %d bins"
+                  % (n, nBins))
+
+        profiles = numpy.lib.format.open_memmap(
+            self.getProfilesFile(), mode='w+', dtype=numpy.float32,
+            shape=(n, nBins))
+        profiles[:] = numpy.nan
+        iceRings = numpy.zeros((n, 2))
+        binCounts = {}  # by geometry and bad pixel mask
+        lock = threading.Lock()
+
+        def _profile(args):
+            i, img = args
+            geometry = pwedconv.getGeometry(img)
+            maps = cache.getMaps(geometry, binWidth)
+            mask = img.getDetector().getBadPixelMask()
+            if mask is not None and mask.shape != maps['radialBins'].shape:
+                mask = None
+            key = (geometry, img.getDetector().getBadPixelMaskFile())
+            with lock:
+                if key not in binCounts:
+                    binCounts[key] = pwedconv.getBinCounts(
+                        maps['radialBins'], len(maps['binResolution']),
+                        mask)
+                counts = binCounts[key]
+            data = pwedconv.readImage(img.getFileName(), img.getIndex())
+            profile = pwedconv.radialProfile(data, maps['radialBins'],
+                                             counts, mask)
+            scores, count = pwedconv.findIceRings(
+                profile, maps['binResolution'], threshold=iceThreshold)
+            profiles[i, :len(profile)] = profile
+            iceRings[i] = (numpy.nanmax(scores) if numpy.isfinite(
+                scores).any() else numpy.nan, count)
+
+        # Images are read in batches to limit the memory used
+        threads = max(1, self.profileThreads.get())
+        images = enumerate(img.clone() for img
+                           in inputImages.iterItems(orderBy='id'))
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            while True:
+                batch = list(itertools.islice(images, threads * 4))
+                if not batch:
+                    break
+                list(executor.map(_profile, batch))
+
+        profiles.flush()
+        numpy.save(self._getExtraPath('ice-rings.npy'), iceRings)
+
+    def createOutputStep(self):
+        inputImages = self.inputImages.get()
+        iceRings = numpy.load(self._getExtraPath('ice-rings.npy'))
+        outputSet = self._createSetOfDiffractionImages()
+        outputSet.setSkipImages(inputImages.getSkipImages())
+        outputSet.setRadialProfiles(self.getProfilesFile(),
+                                    self.binWidth.get())
+
+        for i, img in enumerate(inputImages.iterItems(orderBy='id')):
+            img = img.clone()
+            score, count = iceRings[i]
+            img.setProfileIndex(i)
+            img.setIceRings(None if numpy.isnan(score) else float(score),
+                            int(count))
+            outputSet.append(img)
+
+        outputSet.write()
+        self._defineOutputs(outputDiffractionImages=outputSet)
+
+    # -------------------------- INFO functions -------------------------------
+    def _summary(self):
+        summary = []
+        output = getattr(self, 'outputDiffractionImages', None)
+        if output is not None:
+            n = len(output.getUniqueValues('id', where='_iceRings > 0'))
+            summary.append("%d of %d images with ice rings."
+                           % (n, output.getSize()))
+        return summary
+
+    # -------------------------- UTILS functions ------------------------------
+    def getProfilesFile(self):
+        return self._getExtraPath('radial-profiles.npy')
@@ -0,0 +1,150 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import pyworkflow.protocol as pwprot
+
+import pwed.convert as pwedconv
+from .protocol_base import EdBaseProtocol
+
+
+class ProtFindRotationAxis(EdBaseProtocol):
+    """ Estimate the rotation axis from the spots found along the sweep,
+    instead of entering it manually. Spots are reconstructed in reciprocal
+    space with candidate axes in the image plane, and the axis giving the
+    most compact reconstruction is set in all output images.
+
+    Only the line of the axis can be found; its sign is taken from the
+    axis of the input images when they have one.
+    """
+    _label = 'find rotation axis'
+
+    # -------------------------- DEFINE param functions -----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputImages', pwprot.PointerParam,
+                      pointerClass='SetOfDiffractionImages',
+                      label="Input diffraction images")
+        form.addParam('peakSigma', pwprot.FloatParam, default=5.0,
+                      label="Spot threshold (sigma)",
+                      help="Spots are local maxima above the background of "
+                           "the image by more than this many times the "
+                           "Poisson noise.")
+        form.addParam('angleStep', pwprot.FloatParam, default=1.0,
+                      expertLevel=pwprot.LEVEL_ADVANCED,
+                      label="Angular step (deg)",
+                      help="Step between the candidate axis directions.")
+        form.addParam('voxelSize', pwprot.FloatParam, default=2.0,
+                      expertLevel=pwprot.LEVEL_ADVANCED,
+                      label="Voxel size (pixels)",
+                      help="Size of the voxels used to compare the "
+                           "reconstructions.")
+        form.addParam('spotThreads', pwprot.IntParam, default=4,
+                      expertLevel=pwprot.LEVEL_ADVANCED,
+                      label="Threads")
+
+    # -------------------------- INSERT functions ------------------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('findSpotsStep',
+                                 self.inputImages.get().getObjId(),
+                                 self.peakSigma.get())
+        self._insertFunctionStep('estimateAxisStep', self.angleStep.get(),
+                                 self.voxelSize.get())
+        self._insertFunctionStep('createOutputStep')
+
+    # -------------------------- STEPS functions -------------------------------
+    def findSpotsStep(self, inputId, peakSigma):
+        images = [(img.getLocation(), img.getOscillation()) for img
+                  in self.inputImages.get().iterItems(orderBy='id')]
+        first = self.inputImages.get().getFirstItem()
+        mask = first.getDetector().getBadPixelMask()
+
+        def _spots(item):
+            (index, fn), (oscStart, oscRange) = item
+            data = pwedconv.readImage(fn, index)
+            valid = mask is not None and mask.shape == data.shape
+            x, y, _ = pwedconv.findPeaks(data, sigma=peakSigma,
+                                         mask=mask if valid else None)
+            phi = oscStart + 0.5 * (oscRange or 0)
+            return numpy.stack([x, y, numpy.full(len(x), phi)], axis=1)
+
+        threads = max(1, self.spotThreads.get())
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            spots = numpy.concatenate(list(executor.map(_spots, images)))
+        self.info("Found %d spots in %d images" % (len(spots), len(images)))
+        numpy.save(self.getSpotsFile(), spots)
+
+    def estimateAxisStep(self, angleStep, voxelSize):
+        first = self.inputImages.get().getFirstItem()
+        x, y, phi = numpy.load(self.getSpotsFile()).T
+        angle, _ = pwedconv.estimateRotationAxis(
+            x, y, phi, first.getBeamCenter(), step=angleStep,
+            voxel=voxelSize)
+        axis = pwedconv.getAxisVector(angle, first.getRotationAxis())
+        self.info("Rotation axis at %0.1f deg in the image: %s"
+                  % (angle, axis))
+        with open(self.getAxisFile(), 'w') as f:
+            json.dump({'angle': angle, 'axis': axis, 'spots': len(x)}, f)
+
+    def createOutputStep(self):
+        inputImages = self.inputImages.get()
+        axis = self.getAxis()['axis']
+        outputSet = self._createSetOfDiffractionImages()
+        outputSet.setSkipImages(inputImages.getSkipImages())
+
+        for img in inputImages.iterItems(orderBy='id'):
+            newImg = img.clone()
+            newImg.setRotationAxis(axis)
+            outputSet.append(newImg)
+
+        outputSet.write()
+        self._defineOutputs(outputDiffractionImages=outputSet)
+
+    # -------------------------- INFO functions -------------------------------
+    def _summary(self):
+        summary = []
+        if hasattr(self, 'outputDiffractionImages'):
+            info = self.getAxis()
+            summary.append("Rotation axis %s (%0.1f deg in the image) "
+                           "from %d spots." % (tuple(info['axis']),
+                                               info['angle'], info['spots']))
+        return summary
+
+    # -------------------------- UTILS functions ------------------------------
+    def getSpotsFile(self):
+        return self._getExtraPath('spots.npy')
+
+    def getAxisFile(self):
+        return self._getExtraPath('rotation-axis.json')
+
+    def getAxis(self):
+        with open(self.getAxisFile()) as f:
+            return json.load(f)
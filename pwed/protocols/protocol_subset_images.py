@@ -0,0 +1,92 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              V. E.G. Bengtsson (viktor.bengtsson@mmk.su.se) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] Department of Materials and Environmental Chemistry, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import pyworkflow.protocol as pwprot
+
+from pwed.objects import SubsetOfDiffractionImages
+from .protocol_base import EdBaseProtocol
+
+
+class ProtSubsetDiffractionImages(EdBaseProtocol):
+    """ Select a rotation wedge of a set of images, and optionally drop
+    the ignored images. The output is a view of the input set that only
+    stores the selected ids, so no image rows are copied.
+    """
+    _label = 'subset images'
+
+    # -------------------------- DEFINE param functions -----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputImages', pwprot.PointerParam,
+                      pointerClass='SetOfDiffractionImages',
+                      label="Input diffraction images")
+        form.addParam('selectWedge', pwprot.BooleanParam, default=False,
+                      label="Select a rotation wedge?")
+        form.addParam('minAngle', pwprot.FloatParam, default=0.0,
+                      condition='selectWedge',
+                      label="First angle (deg)")
+        form.addParam('maxAngle', pwprot.FloatParam, default=0.0,
+                      condition='selectWedge',
+                      label="Last angle (deg)",
+                      help="Images whose oscillation overlaps the angles "
+                           "between the first and last ones are selected.")
+        form.addParam('excludeIgnored', pwprot.BooleanParam, default=True,
+                      label="Exclude ignored images?",
+                      help="Drop the images ignored on import, see the "
+                           "skip images option.")
+
+    # -------------------------- INSERT functions ------------------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('createOutputStep')
+
+    # -------------------------- STEPS functions -------------------------------
+    def createOutputStep(self):
+        inputImages = self.inputImages.get()
+        if self.selectWedge.get():
+            ids = inputImages.framesInAngleRange(self.minAngle.get(),
+                                                 self.maxAngle.get())
+        else:
+            ids = inputImages.getUniqueValues('id')
+        if self.excludeIgnored.get():
+            ignored = set(inputImages.getUniqueValues('id',
+                                                      where='_ignore=1'))
+            ids = [i for i in ids if i not in ignored]
+
+        outputSet = SubsetOfDiffractionImages()
+        outputSet.setSelection(inputImages, ids)
+        self._defineOutputs(outputDiffractionImages=outputSet)
+
+    # -------------------------- INFO functions -------------------------------
+    def _summary(self):
+        summary = []
+        output = getattr(self, 'outputDiffractionImages', None)
+        if output is not None:
+            summary.append("%d of %d images selected."
+                           % (output.getSize(),
+                              self.inputImages.get().getSize()))
+        return summary
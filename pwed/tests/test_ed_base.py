@@ -25,22 +25,57 @@
 # **************************************************************************
 
 import os
+import io
+import bz2
+import gzip
+import contextlib
+import sqlite3
+import struct
+import sys
+import subprocess
+import time
+from unittest import mock
+
+import numpy
 
 import pyworkflow as pw
 import pyworkflow.tests as pwtests
+import pyworkflow.protocol as pwprot
 
 import pwed
-from pwed.objects import DiffractionImage, SetOfDiffractionImages
-from pwed.protocols import ProtImportDiffractionImages
+from pwed.objects import (DiffractionImage, SetOfDiffractionImages,
+                          SubsetOfDiffractionImages, Detector)
+from pwed.protocols import (ProtImportDiffractionImages,
+                            ProtPackDiffractionImages, ProtImportEvents,
+                            ProtBinImages, ProtEstimateBackground,
+                            ProtBadPixelMask, ProtRadialProfile,
+                            ProtFindBeamCenter, ProtFindRotationAxis,
+                            ProtFindHits, ProtSubsetDiffractionImages)
+import pwed.convert as pwedconv
+from pwed.convert import DiffractionImageImporter
 
 
-pw.Config.setDomain(pwed)
+pwed.Config.setup()
 
 
-class TestEdBase(pwtests.BaseTest):
-    @classmethod
-    def setUpClass(cls):
-        pwtests.setupTestOutput(cls)
+# Maximum time (in seconds) that importing the pwed modules should take,
+# not including the time used to import pyworkflow itself
+IMPORT_TIME_BUDGET = 0.5
+
+
+class SmvDataMixin:
+    """ Helpers to write synthetic SMV images. """
+    def ringImage(self, geometry, resolution, seed=0):
+        """ Return an image with Poisson background and
+        a ring at the given resolution.
+        """
+        radius = pwedconv.geometry.getRadiusMap(geometry)
+        ringRadius = pwedconv.geometry.resolutionToRadius(geometry,
+                                                          resolution)
+        rng = numpy.random.default_rng(seed)
+        data = rng.poisson(5, radius.shape)
+        data[numpy.abs(radius - ringRadius) < 1] += 50
+        return data.astype(numpy.uint16)
 
     def mockHeader(self):
         header_dict = {"HEADER_BYTES": "512",
@@ -71,6 +106,95 @@ class TestEdBase(pwtests.BaseTest):
                        }
         return header_dict
 
+    def latticeSpots(self, angle, n, oscRange=0.35, center=(131.2, 122.7),
+                     seed=0):
+        """ Return (x, y, phi, frame) of the spots of a random lattice
+        rotated about an axis at the given angle in the image.
+        """
+        rng = numpy.random.default_rng(seed)
+        hkl = numpy.stack(numpy.meshgrid(*[numpy.arange(-15, 16)] * 3,
+                                         indexing='ij'), -1).reshape(-1, 3)
+        q, _ = numpy.linalg.qr(rng.normal(size=(3, 3)))
+        points = hkl @ numpy.diag([8.7, 9.6, 11.3]) @ q.T
+        points = points[numpy.linalg.norm(points, axis=1) < 120]
+        theta = numpy.radians(angle)
+        k = numpy.array([[0, 0, numpy.sin(theta)],
+                         [0, 0, -numpy.cos(theta)],
+                         [-numpy.sin(theta), numpy.cos(theta), 0]])
+        spots = []
+        for i in range(n):
+            phi = numpy.radians(i * oscRange)
+            rot = numpy.eye(3) + numpy.sin(phi) * k + (1 - numpy.cos(phi)) * k @ k
+            p = points @ rot.T
+            p = p[numpy.abs(p[:, 2]) < 1.0]
+            spots.append(numpy.stack([p[:, 0] + center[0], p[:, 1] + center[1],
+                                      numpy.full(len(p), i * oscRange),
+                                      numpy.full(len(p), i)], axis=1))
+        return numpy.concatenate(spots).T
+
+    def writeSmvImage(self, filename, header, data=None):
+        """ Write a SMV image with the given header values and data. """
+        size1, size2 = int(header['SIZE1']), int(header['SIZE2'])
+        if data is None:
+            data = numpy.zeros((size2, size1), dtype=numpy.uint16)
+        headerText = '{\n%s}\n' % ''.join('%s=%s;\n' % (k, v)
+                                           for k, v in header.items())
+        headerBytes = int(header['HEADER_BYTES'])
+        with open(filename, 'wb') as f:
+            f.write(headerText.encode('ascii').ljust(headerBytes, b'\0'))
+            f.write(data.astype('<u2').tobytes())
+
+    def writeSmvSweep(self, folder, n, oscStart=-33.9, oscRange=0.3512,
+                      fmt='%05d.img', size=16, data=None, header=None):
+        """ Write n SMV images of a continuous rotation sweep.
+        If given, data(i) should return the data of each image, and
+        header values replace those of the mock header.
+        """
+        pw.utils.cleanPath(folder)
+        pw.utils.makePath(folder)
+        h = self.mockHeader()
+        h.update(header or {})
+        h['SIZE1'] = h['SIZE2'] = str(size)
+        for i in range(1, n + 1):
+            h['OSC_START'] = h['PHI'] = '%0.4f' % (oscStart + (i - 1) * oscRange)
+            self.writeSmvImage(os.path.join(folder, fmt % i), h,
+                               data(i) if data else None)
+        return os.path.join(folder,
+                            fmt.replace('%05d', '{TI}').replace('%d', '{TI}'))
+
+
+class TestEdBase(SmvDataMixin, pwtests.BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def test_import_time(self):
+        """ Import pwed in a clean process with an empty home folder,
+        check that there are no side effects and that the import time
+        of pwed modules is within budget.
+        """
+        home = self.getOutputPath('home')
+        pw.utils.makePath(home)
+        env = {k: v for k, v in os.environ.items()
+               if not k.startswith('SCIPION')}
+        env['HOME'] = home
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(pwed.__file__))
+        code = ("import os, sys; env = dict(os.environ); import pwed; "
+                "print(env == dict(os.environ)); "
+                "print(any(m.startswith('pyworkflow.gui') for m in sys.modules))")
+        p = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                           env=env, capture_output=True, text=True)
+        self.assertEqual(p.returncode, 0, p.stderr)
+        self.assertEqual(p.stdout.split(), ['True', 'False'])
+        self.assertFalse(os.path.exists(os.path.join(home, 'ScipionEdUserData')))
+
+        selfTime = 0
+        for line in p.stderr.splitlines():
+            parts = line.split('|')
+            if len(parts) == 3 and parts[2].strip().startswith('pwed'):
+                selfTime += int(parts[0].split(':')[1])
+        self.assertLess(selfTime / 1e6, IMPORT_TIME_BUDGET)
+
     def test_plugin(self):
         self.assertTrue(hasattr(pwed, 'Domain'))
 
@@ -82,6 +206,25 @@ class TestEdBase(pwtests.BaseTest):
             self.assertTrue(
                 e in objects, "%s should be in Domain.getObjects" % e)
 
+    def test_mapper_dict(self):
+        mapperDict = pwed.Domain.getMapperDict()
+        self.assertIn('SetOfDiffractionImages', mapperDict)
+        self.assertIn('ProtImportDiffractionImages', mapperDict)
+        # The dictionary is built only once and callers get a copy
+        mapperDict.pop('SetOfDiffractionImages')
+        self.assertIn('SetOfDiffractionImages', pwed.Domain.getMapperDict())
+        self.assertEqual(pwed.Domain.getMapperDict(),
+                         SetOfDiffractionImages()._loadClassesDict())
+
+        # Invalidating also forgets the discovered classes
+        pwed.Domain.invalidateMapperDict()
+        self.assertEqual(pwed.Domain._objects, {})
+        self.assertEqual(pwed.Domain._protocols, {})
+        newMapperDict = pwed.Domain.getMapperDict()
+        self.assertIn('SetOfDiffractionImages', newMapperDict)
+        self.assertIn('ProtImportDiffractionImages', newMapperDict)
+        self.assertIn('DiffractionImage', pwed.Domain.getObjects())
+
     def test_create_diffractionImages(self):
         setFn = self.getOutputPath('diffraction-images.sqlite')
         pw.utils.cleanPath(setFn)
@@ -127,6 +270,830 @@ class TestEdBase(pwtests.BaseTest):
 
         testSet2.close()
 
+    def test_importer(self):
+        # Non padded TI values should be sorted numerically
+        pattern = self.writeSmvSweep(self.getOutputPath('smv', 'sweep1'), 12,
+                                     fmt='frame_%d.img')
+        importer = DiffractionImageImporter(pattern, skipImages=5,
+                                            overwrites={'WAVELENGTH': '0.1'},
+                                            threads=4)
+        matchingFiles = importer.getMatchingFiles()
+        self.assertEqual([ti for _, ti in matchingFiles], list(range(1, 13)))
+        # Sizes and times are taken while listing the files
+        f = matchingFiles[0][0]
+        st = os.stat(f)
+        self.assertEqual(importer.getFileStat(f), (st.st_size, st.st_mtime))
+
+        wildcardPattern = os.path.join(self.getOutputPath('smv'),
+                                       'sweep?', 'frame_{TI}.img')
+        wildcardImporter = DiffractionImageImporter(wildcardPattern)
+        self.assertEqual(wildcardImporter.getMatchingFiles(), matchingFiles)
+        self.assertEqual(DiffractionImageImporter(
+            pattern.replace('frame_', 'other_')).getMatchingFiles(), [])
+
+        setFn = self.getOutputPath('imported-images.sqlite')
+        pw.utils.cleanPath(setFn)
+        outputSet = SetOfDiffractionImages(filename=setFn)
+        self.assertEqual(importer.importImages(outputSet), 12)
+        outputSet.write()
+        outputSet.close()
+
+        outputSet = SetOfDiffractionImages(filename=setFn)
+        self.assertEqual(outputSet.getSize(), 12)
+        for dImg in outputSet:
+            i = dImg.getObjId()
+            self.assertEqual(dImg.getDim(), (16, 16))
+            self.assertEqual(dImg.getWavelength(), 0.1)
+            self.assertAlmostEqual(dImg.getOscillation()[0],
+                                   -33.9 + (i - 1) * 0.3512, places=4)
+            self.assertEqual(dImg.getIgnore(), i % 5 == 0)
+        outputSet.close()
+
+        # Importing again should only process new or modified files
+        folder = os.path.dirname(pattern)
+        h = self.mockHeader()
+        h['SIZE1'] = h['SIZE2'] = '16'
+        for i in [13, 14]:
+            self.writeSmvImage(os.path.join(folder, 'frame_%d.img' % i), h)
+        modifiedFile = os.path.join(folder, 'frame_3.img')
+        h['DISTANCE'] = '100'
+        self.writeSmvImage(modifiedFile, h)
+        os.utime(modifiedFile, (0, os.path.getmtime(modifiedFile) + 10))
+
+        outputSet = SetOfDiffractionImages(filename=setFn)
+        importer = DiffractionImageImporter(pattern, skipImages=5)
+        self.assertEqual(importer.importImages(outputSet, chunkSize=2), 3)
+        outputSet.write()
+        outputSet.close()
+
+        outputSet = SetOfDiffractionImages(filename=setFn)
+        self.assertEqual(outputSet.getSize(), 14)
+        self.assertEqual(outputSet[3].getDistance(), 100)
+        self.assertEqual(outputSet[4].getDistance(), 532.2773)
+        self.assertEqual(importer.importImages(outputSet), 0)
+        outputSet.close()
+
+        # Values missing in a header are not taken from other images
+        folder = self.getOutputPath('smv', 'missing')
+        pattern = self.writeSmvSweep(folder, 3)
+        h = dict(self.mockHeader(), SIZE1='16', SIZE2='16')
+        for key in ['DISTANCE', 'BEAM_CENTER_X', 'BEAM_CENTER_Y']:
+            h.pop(key)
+        self.writeSmvImage(os.path.join(folder, '00002.img'), h)
+        with open(os.path.join(folder, '00003.img'), 'wb') as f:
+            f.write(b'broken')
+        setFn = self.getOutputPath('missing-images.sqlite')
+        pw.utils.cleanPath(setFn)
+        outputSet = SetOfDiffractionImages(filename=setFn)
+        DiffractionImageImporter(pattern).importImages(outputSet)
+        images = {img.getObjId(): img.clone() for img in outputSet}
+        self.assertEqual(images[1].getDistance(), 532.2773)
+        self.assertIsNone(images[2].getDistance())
+        self.assertEqual(images[2].getBeamCenter(), (None, None))
+        self.assertEqual(images[2].getDim(), (16, 16))
+        self.assertIsNone(images[3].getDim()[0])
+        self.assertIsNone(images[3].getOscillation()[0])
+        outputSet.close()
+
+    def runMain(self, *args):
+        """ Run the command line with the given arguments and
+        return what it printed.
+        """
+        from pwed.__main__ import main
+        out = io.StringIO()
+        with mock.patch.object(sys, 'argv', ['pwed'] + list(args)), \
+                contextlib.redirect_stdout(out):
+            main()
+        return out.getvalue()
+
+    def test_command_line(self):
+        folder = self.getOutputPath('cli')
+        pattern = self.writeSmvSweep(
+            folder, 6, data=lambda i: numpy.full((16, 16), i,
+                                                 dtype=numpy.uint16))
+        out = self.runMain('scan', '--pattern', pattern,
+                           '--header-stride', '4')
+        self.assertIn("Matching files: 6", out)
+        self.assertIn("Image identifiers: 1-6", out)
+        self.assertIn("Read headers: 6", out)
+
+        setFn = self.getOutputPath('cli-images.sqlite')
+        importArgs = ['import', '--pattern', pattern, '--out', setFn,
+                      '--chunk-size', '4', '--header-stride', '4', '--stats']
+        out = self.runMain(*importArgs)
+        self.assertIn("Imported 6 new or modified images", out)
+
+        def _checkOutput(n):
+            with sqlite3.connect(setFn) as db:
+                count, = db.execute("SELECT COUNT(*) FROM Objects").fetchone()
+            self.assertEqual(count, n)
+            outputSet = SetOfDiffractionImages(filename=setFn)
+            self.assertEqual(outputSet.getSize(), n)
+            for img in outputSet.iterItems(orderBy='id'):
+                i = img.getObjId()
+                self.assertAlmostEqual(img.getOscillation()[0],
+                                       -33.9 + (i - 1) * 0.3512, places=4)
+                self.assertEqual(img.getStats()[:3], (i, i, 256 * i))
+            outputSet.close()
+
+        _checkOutput(6)
+
+        # Resuming only imports the new frames
+        h = self.mockHeader()
+        h['SIZE1'] = h['SIZE2'] = '16'
+        for i in [7, 8]:
+            h['OSC_START'] = h['PHI'] = '%0.4f' % (-33.9 + (i - 1) * 0.3512)
+            self.writeSmvImage(os.path.join(folder, '%05d.img' % i), h,
+                               numpy.full((16, 16), i, dtype=numpy.uint16))
+        out = self.runMain(*(importArgs + ['--resume']))
+        self.assertIn("Imported 2 new or modified images", out)
+        self.assertIn("8 images in total", out)
+        _checkOutput(8)
+
+        # Without resume the output is written again
+        out = self.runMain(*importArgs)
+        self.assertIn("Imported 8 new or modified images", out)
+        _checkOutput(8)
+
+    def test_formats(self):
+        h = self.mockHeader()
+        fn = self.getOutputPath('format-image.img')
+        self.writeSmvImage(fn, h)
+        reader = pwedconv.formats.getReader(fn)
+        self.assertIsInstance(reader, pwedconv.formats.SmvReader)
+        headers = reader.readHeaders([fn, fn + '.missing'],
+                                     overwrites={'DISTANCE': '100'})
+        expected = dict(h, DISTANCE='100')
+        self.assertEqual(headers, [expected, None])
+
+        fn = self.getOutputPath('format-image.mrc')
+        header = numpy.zeros(256, dtype='<i4')
+        header[:4] = [32, 16, 1, 1]
+        with open(fn, 'wb') as f:
+            f.write(header.tobytes())
+            f.write(numpy.zeros((16, 32), dtype='<i2').tobytes())
+        h = pwedconv.formats.getReader(fn).readHeader(fn)
+        self.assertEqual((h['SIZE1'], h['SIZE2']), ('32', '16'))
+        self.assertIsNone(pwedconv.formats.getReader('image.unknown'))
+
+        data = numpy.arange(32 * 16, dtype=numpy.uint16).reshape(16, 32)
+        fn = self.getOutputPath('format-image.img')
+        self.writeSmvImage(fn, dict(h, SIZE1='32', SIZE2='16'), data)
+        self.assertTrue(numpy.array_equal(pwedconv.readImage(fn), data))
+
+        # MRC stacks, with an extended header before the data
+        stack = numpy.arange(2 * 16 * 32, dtype='<u2').reshape(2, 16, 32)
+        fn = self.getOutputPath('format-stack.mrc')
+        header[:4] = [32, 16, 2, 6]
+        header[23] = 128  # NSYMBT
+        with open(fn, 'wb') as f:
+            f.write(header.tobytes())
+            f.write(b'\0' * 128)
+            f.write(stack.tobytes())
+        self.assertEqual(pwedconv.readImageHeader(fn)['HEADER_BYTES'],
+                         '1152')
+        self.assertTrue(numpy.array_equal(pwedconv.readImage(fn), stack[0]))
+        self.assertTrue(numpy.array_equal(pwedconv.readImage(fn, 2),
+                                          stack[1]))
+        header[3] = 4  # complex values
+        with open(fn, 'r+b') as f:
+            f.write(header.tobytes())
+        with self.assertRaisesRegex(Exception, 'not supported'):
+            pwedconv.readImage(fn)
+
+        # Uncompressed TIFF, with the rows in two strips
+        fn = self.getOutputPath('format-image.tif')
+        tags = [(256, 3, 1, 32), (257, 3, 1, 16), (258, 3, 1, 16),
+                (259, 3, 1, 1), (273, 4, 2, 8), (277, 3, 1, 1),
+                (279, 4, 2, 16), (339, 3, 1, 1)]
+        ifdOffset = 8 + 16 + data.nbytes
+        offsets = [24, 24 + data.nbytes // 2]
+        with open(fn, 'wb') as f:
+            f.write(struct.pack('<2sHI', b'II', 42, ifdOffset))
+            f.write(struct.pack('<2I', *offsets))
+            f.write(struct.pack('<2I', data.nbytes // 2, data.nbytes // 2))
+            f.write(data[:8].tobytes())
+            f.write(data[8:].tobytes())
+            f.write(struct.pack('<H', len(tags)))
+            for tag, valueType, count, value in tags:
+                f.write(struct.pack('<HHI', tag, valueType, count))
+                f.write(struct.pack('<I', value) if valueType == 4
+                        else struct.pack('<HH', value, 0))
+            f.write(struct.pack('<I', 0))
+        self.assertEqual(pwedconv.readImageHeader(fn)['SIZE1'], '32')
+        self.assertTrue(numpy.array_equal(pwedconv.readImage(fn), data))
+        with open(fn, 'r+b') as f:
+            f.seek(ifdOffset + 2 + 3 * 12 + 8)  # compression value
+            f.write(struct.pack('<H', 5))
+        with self.assertRaisesRegex(Exception, 'not supported'):
+            pwedconv.readImage(fn)
+
+    def test_compressed_formats(self):
+        formats = pwedconv.formats
+        h = dict(self.mockHeader(), SIZE1='32', SIZE2='16')
+        data = numpy.arange(32 * 16, dtype=numpy.uint16).reshape(16, 32)
+        fn = self.getOutputPath('format-compressed.img')
+        self.writeSmvImage(fn, h, data)
+        with open(fn, 'rb') as f:
+            raw = f.read()
+
+        for ext, module in [('.gz', gzip), ('.bz2', bz2)]:
+            cfn = fn + ext
+            with module.open(cfn, 'wb') as f:
+                f.write(raw)
+            self.assertIsInstance(formats.getReader(cfn), formats.SmvReader)
+            self.assertEqual(formats.getReader(cfn).readHeader(cfn), h)
+            self.assertTrue(numpy.array_equal(pwedconv.readImage(cfn), data))
+
+        # Decompressed files are evicted when the cache is full
+        cache = formats._DataCache(len(raw) + 1)
+        cache.get(fn + '.gz', gzip.open)
+        cache.get(fn + '.bz2', bz2.open)
+        self.assertEqual(len(cache._items), 1)
+        self.assertLessEqual(cache._size, len(raw) + 1)
+
+    def test_container(self):
+        pattern = self.writeSmvSweep(self.getOutputPath('pack'), 5)
+        files = DiffractionImageImporter(pattern).getMatchingFiles()
+        rng = numpy.random.default_rng(0)
+        frames = [rng.integers(0, 100, (16, 16)).astype(numpy.uint16)
+                  for _ in files]
+
+        for codec in [None, 'zlib', 'lzma']:
+            fn = self.getOutputPath('pack-%s.edpack' % codec)
+            with pwedconv.ContainerWriter(fn, codec=codec) as writer:
+                for (f, _), data in zip(files, frames):
+                    writer.addFrame(pwedconv.readImageHeader(f), data)
+
+            reader = pwedconv.getReader(fn)
+            self.assertIsInstance(reader, pwedconv.ContainerReader)
+            self.assertEqual(reader.getSize(fn), len(files))
+            for i, ((f, _), data) in enumerate(zip(files, frames), 1):
+                self.assertTrue(numpy.array_equal(
+                    pwedconv.readImage(fn, i), data))
+                self.assertEqual(pwedconv.readImageHeader(fn, i),
+                                 pwedconv.readImageHeader(f))
+
+        with pwedconv.ContainerWriter(fn) as writer:
+            writer.addFrame({}, frames[0])
+            with self.assertRaises(Exception):
+                writer.addFrame({}, frames[0].astype(numpy.int32))
+
+    def test_sparse(self):
+        rng = numpy.random.default_rng(0)
+        frames = [(rng.random((16, 16)) < 0.05).astype(numpy.uint16)
+                  * rng.integers(1, 50, (16, 16)).astype(numpy.uint16)
+                  for _ in range(4)]
+        sparse = [pwedconv.SparseFrame.fromDense(f) for f in frames]
+        for s, f in zip(sparse, frames):
+            self.assertEqual(s.nnz, numpy.count_nonzero(f))
+            self.assertTrue(numpy.array_equal(s.toDense(), f))
+            rows, cols, values = s.getCoordinates(minValue=10)
+            self.assertTrue(numpy.array_equal(values, f[rows, cols]))
+            self.assertEqual(len(values), numpy.count_nonzero(f >= 10))
+
+        total = sum(f.astype(numpy.int64) for f in frames)
+        self.assertTrue(numpy.array_equal(pwedconv.sumFrames(sparse), total))
+        self.assertTrue(numpy.array_equal(
+            pwedconv.sumFrames(sparse[:2] + frames[2:]), total))
+        summed = pwedconv.addFrames(sparse)
+        self.assertTrue(numpy.array_equal(summed.toDense(), total))
+        self.assertTrue(numpy.all(numpy.diff(summed.indexes.astype(int)) > 0))
+        # Sparse frames are binned into dense frames, like dense ones
+        for factor in [1, 3]:
+            self.assertTrue(numpy.array_equal(
+                pwedconv.binFrame(summed, factor),
+                pwedconv.binFrame(total, factor)))
+
+        fn = self.getOutputPath('sparse.edpack')
+        with pwedconv.ContainerWriter(fn, codec=pwedconv.SPARSE) as writer:
+            for f in frames:
+                writer.addFrame({}, f)
+        for i, f in enumerate(frames, 1):
+            s = pwedconv.readSparse(fn, i)
+            self.assertIsInstance(s, pwedconv.SparseFrame)
+            self.assertTrue(numpy.array_equal(s.toDense(), f))
+            self.assertTrue(numpy.array_equal(pwedconv.readImage(fn, i), f))
+        # Only indexes and values of non-zero pixels are stored
+        self.assertLess(os.path.getsize(fn),
+                        4096 + sum(f.nbytes for f in frames))
+
+    def test_events(self):
+        rng = numpy.random.default_rng(0)
+        n = 5000
+        events = numpy.zeros(n, dtype=[('x', '<u2'), ('y', '<u2'),
+                                       ('toa', '<u8')])
+        events['x'] = rng.integers(0, 32, n)
+        events['y'] = rng.integers(0, 16, n)
+        events['toa'] = numpy.sort(rng.integers(1000, 101000, n))
+        eventsFile = self.getOutputPath('events.npy')
+        numpy.save(eventsFile, events)
+        pwedconv.checkSorted(pwedconv.loadEvents(eventsFile), chunkSize=1000)
+
+        for frameTicks in [10000, 3000]:
+            offsets = pwedconv.binEvents(eventsFile, frameTicks)
+            self.assertEqual(len(offsets) - 1,
+                             int(numpy.ceil(100000 / frameTicks)))
+            fn = self.getOutputPath('events-%d.edbin' % frameTicks)
+            pwedconv.writeBinning(fn, eventsFile, (16, 32), offsets,
+                                  header={'DISTANCE': '530'},
+                                  oscStart=-30, oscRange=0.5)
+            reader = pwedconv.getReader(fn)
+            frames = [pwedconv.readImage(fn, i)
+                      for i in range(1, reader.getSize(fn) + 1)]
+            # The descriptor is parsed once
+            self.assertIs(reader.readBinning(fn), reader.readBinning(fn))
+            self.assertEqual(sum(f.sum() for f in frames), n)
+            first = events[events['toa'] < events['toa'][0] + frameTicks]
+            expected = numpy.zeros((16, 32), dtype=numpy.int64)
+            numpy.add.at(expected, (first['y'], first['x']), 1)
+            self.assertTrue(numpy.array_equal(frames[0], expected))
+            h = pwedconv.readImageHeader(fn, 3)
+            self.assertEqual((h['DISTANCE'], h['SIZE1']), ('530', '32'))
+            self.assertAlmostEqual(float(h['OSC_START']), -29)
+            # Binned events are summed as sparse frames
+            self.assertTrue(pwedconv.hasSparseData(fn))
+            self.assertTrue(numpy.array_equal(
+                pwedconv.reduceFrames([(1, fn), (2, fn)], 2),
+                pwedconv.binFrame(frames[0] + frames[1], 2)))
+
+        # Events outside of the detector are rejected when binning and
+        # are not counted when reading
+        self.assertEqual(pwedconv.binEvents(eventsFile, 10000,
+                                            shape=(16, 32))[-1], n)
+        with self.assertRaises(Exception):
+            pwedconv.binEvents(eventsFile, 10000, shape=(16, 16))
+        fn = self.getOutputPath('events-small.edbin')
+        pwedconv.writeBinning(fn, eventsFile, (16, 16), [0, n])
+        self.assertEqual(pwedconv.readImage(fn, 1).sum(),
+                         (events['x'] < 16).sum())
+
+        numpy.save(eventsFile, events[::-1])
+        with self.assertRaises(Exception):
+            pwedconv.checkSorted(pwedconv.loadEvents(eventsFile),
+                                 chunkSize=1000)
+
+    def test_gap_remap(self):
+        detector = Detector()
+        self.assertIsNone(detector.getGapRemap())
+        detector.setGapSpec(pwedconv.TIMEPIX_QUAD)
+        remap = detector.getGapRemap()
+        # The remap is computed once for all detectors with the same gaps
+        other = Detector()
+        other.setGapSpec(pwedconv.TIMEPIX_QUAD)
+        self.assertIs(other.getGapRemap(), remap)
+
+        rng = numpy.random.default_rng(0)
+        stack = rng.integers(0, 100, (3, 512, 512)).astype(numpy.uint16)
+        corrected = pwedconv.correctGaps(stack, remap)
+        self.assertEqual(corrected.shape, (3, 516, 516))
+        # Counts are preserved and the wide pixels are split in 3
+        self.assertTrue(numpy.allclose(corrected.sum(axis=(1, 2)),
+                                       stack.sum(axis=(1, 2))))
+        self.assertTrue(numpy.allclose(corrected[0, 0, 255:258],
+                                       stack[0, 0, 255] / 3.0))
+        self.assertTrue(numpy.allclose(corrected[0, 255:258, 255:258],
+                                       stack[0, 255, 255] / 9.0))
+        self.assertTrue(numpy.array_equal(corrected[1, 300, 10],
+                                          stack[1, 296, 10]))
+        self.assertTrue(numpy.array_equal(
+            pwedconv.correctGaps(stack[2], remap), corrected[2]))
+        self.assertEqual(remap[2], (512, 512))
+        with self.assertRaises(Exception):
+            pwedconv.correctGaps(stack[:, :256], remap)
+        self.assertEqual(pwedconv.getCorrectedSize(*pwedconv.TIMEPIX_QUAD),
+                         516)
+        self.assertEqual(list(pwedconv.correctCoordinates(
+            [10, 256, 300], pwedconv.TIMEPIX_QUAD)), [10, 258, 304])
+
+    def test_import_stats(self):
+        def _data(i):
+            data = numpy.zeros((16, 16), dtype=numpy.uint16)
+            data[:i, 0] = 10 * i
+            if i == 3:
+                data[5, 5] = 65535
+            return data
+
+        pattern = self.writeSmvSweep(self.getOutputPath('stats'), 4,
+                                     data=_data)
+        importer = DiffractionImageImporter(pattern, threads=2,
+                                            computeStats=True)
+        setFn = self.getOutputPath('stats-images.sqlite')
+        pw.utils.cleanPath(setFn)
+        outputSet = SetOfDiffractionImages(filename=setFn)
+        importer.importImages(outputSet)
+        outputSet.write()
+
+        for dImg in outputSet:
+            i = dImg.getObjId()
+            data = _data(i)
+            mean, maximum, total, saturated, nonzero = dImg.getStats()
+            self.assertAlmostEqual(mean, data.mean())
+            self.assertEqual(maximum, data.max())
+            self.assertEqual(total, data.sum())
+            self.assertEqual(saturated, 1 if i == 3 else 0)
+            self.assertAlmostEqual(nonzero, numpy.count_nonzero(data) / 256.)
+        # Screening is a query on the set
+        saturated = [img.getObjId() for img in
+                     outputSet.iterItems(where='_statSaturated > 0')]
+        self.assertEqual(saturated, [3])
+        outputSet.close()
+
+    def test_bin_frames(self):
+        data = numpy.arange(6 * 10, dtype=numpy.uint16).reshape(6, 10)
+        binned = pwedconv.binFrame(data, 4)
+        self.assertEqual(binned.shape, (1, 2))
+        self.assertEqual(binned[0, 1], data[:4, 4:8].sum())
+        stack = numpy.stack([data, data * 2])
+        self.assertTrue(numpy.array_equal(pwedconv.binFrame(stack, 2)[1],
+                                          pwedconv.binFrame(data, 2) * 2))
+        h = pwedconv.reduceHeader([{'SIZE1': '516', 'OSC_RANGE': '0.3',
+                                    'BEAM_CENTER_X': '200', 'TIME': '0.5'}]
+                                  * 3, binning=2)
+        self.assertEqual(h['SIZE1'], '258')
+        self.assertAlmostEqual(float(h['OSC_RANGE']), 0.9)
+        self.assertAlmostEqual(float(h['TIME']), 1.5)
+        self.assertAlmostEqual(float(h['BEAM_CENTER_X']), 100)
+
+    def test_rolling_background(self):
+        rng = numpy.random.default_rng(0)
+        frames = rng.poisson(5, (12, 8, 8)).astype(numpy.uint16)
+        for method, func in [('mean', numpy.mean), ('median', numpy.median)]:
+            bg = pwedconv.RollingBackground(4, method)
+            for j, f in enumerate(frames):
+                bg.add(f)
+                expected = func(frames[max(0, j - 3):j + 1], axis=0)
+                self.assertTrue(numpy.allclose(bg.getBackground(), expected))
+            self.assertEqual(bg.getSize(), 4)
+
+        blocks = pwedconv.getBackgroundBlocks(25, 10, 6)
+        self.assertEqual(blocks, [(0, 9, 7), (10, 19, 17), (20, 24, 24)])
+
+    def test_bad_pixels(self):
+        rng = numpy.random.default_rng(0)
+        frames = rng.poisson(10, (20, 32, 32)).astype(numpy.uint16)
+        frames[:, 3, 4] = 1000  # hot
+        frames[:, 7, 8] = 0  # dead
+        stats = pwedconv.PixelStatistics()
+        for f in frames:
+            stats.add(f)
+        self.assertTrue(numpy.allclose(stats.getMean(), frames.mean(axis=0)))
+        self.assertTrue(numpy.allclose(stats.getVariance(),
+                                       frames.var(axis=0, ddof=1)))
+        mask = pwedconv.findBadPixels(stats.getMean(), stats.getVariance())
+        self.assertEqual(list(zip(*numpy.nonzero(mask))), [(3, 4), (7, 8)])
+
+        # Masks are stored with one bit per pixel, in files named by
+        # their content that are never overwritten
+        serialNumber = 'test-%d' % os.getpid()
+        folder = self.getOutputPath('detectors')
+        pw.utils.cleanPath(folder)
+        defaultFolder = pwed.Config.SCIPION_ED_DETECTORS
+        pwed.Config.SCIPION_ED_DETECTORS = folder
+        try:
+            self.assertIsNone(pwedconv.findBadPixelMaskFile(serialNumber))
+            maskFile = pwedconv.storeBadPixelMask(serialNumber, mask)
+            self.assertEqual(os.path.dirname(maskFile), folder)
+            self.assertLess(os.path.getsize(maskFile),
+                            mask.size // 8 + 1024)
+            self.assertEqual(pwedconv.storeBadPixelMask(serialNumber, mask),
+                             maskFile)
+            otherFile = pwedconv.storeBadPixelMask(serialNumber, ~mask)
+            self.assertNotEqual(otherFile, maskFile)
+            self.assertTrue(numpy.array_equal(
+                pwedconv.loadBadPixelMask(maskFile), mask))
+            os.utime(otherFile, (0, 0))
+            self.assertEqual(pwedconv.findBadPixelMaskFile(serialNumber),
+                             maskFile)
+
+            # Imports only use the stored masks when asked to
+            pattern = self.writeSmvSweep(self.getOutputPath('masked'), 2)
+            for detectorMasks in [False, True]:
+                importer = DiffractionImageImporter(
+                    pattern, overwrites={'DETECTOR_SN': serialNumber},
+                    detectorMasks=detectorMasks)
+                dImg = DiffractionImage()
+                f, ti = importer.getMatchingFiles()[0]
+                importer.setImageInfo(dImg, f, ti, importer.readHeader(f))
+                detector = dImg.getDetector()
+                self.assertEqual(detector.getBadPixelMaskFile(),
+                                 maskFile if detectorMasks else None)
+            self.assertTrue(numpy.array_equal(detector.getBadPixelMask(),
+                                              mask))
+            self.assertIs(detector.getBadPixelMask(),
+                          detector.getBadPixelMask())
+            # A removed mask file is not an error
+            detector.setBadPixelMaskFile(os.path.join(folder, 'none.npz'))
+            self.assertIsNone(detector.getBadPixelMask())
+        finally:
+            pwed.Config.SCIPION_ED_DETECTORS = defaultFolder
+
+    def test_geometry_cache(self):
+        dImg = DiffractionImage()
+        dImg.setDim(516)
+        dImg.setPixelSize(0.055)
+        dImg.setDistance(532.2773)
+        dImg.setWavelength(0.0251)
+        dImg.setBeamCenter(258.0, 258.0)
+        geometry = pwedconv.getGeometry(dImg)
+
+        resolution = pwedconv.getResolutionMap(dImg)
+        self.assertEqual(resolution.shape, (516, 516))
+        self.assertIs(pwedconv.getResolutionMap(dImg), resolution)
+        # d = wavelength / (2 sin(atan(r / distance) / 2))
+        r = numpy.hypot(0.5, 100.5) * 0.055
+        expected = 0.0251 / (2 * numpy.sin(numpy.arctan(r / 532.2773) / 2))
+        self.assertAlmostEqual(float(resolution[258, 358]), expected,
+                               places=3)
+        bins, binResolution = pwedconv.getRadialBins(dImg, binWidth=2)
+        self.assertEqual(bins[258, 358], 50)
+        self.assertTrue(numpy.all(numpy.diff(binResolution) < 0))
+
+        # Maps are saved and loaded from disk, and evicted from memory
+        folder = self.getOutputPath('geometry')
+        pw.utils.cleanPath(folder)
+        cache = pwedconv.GeometryCache(maxBytes=3 * 516 * 516 * 4,
+                                       folder=folder)
+        maps = cache.getMaps(geometry)
+        self.assertEqual(len(os.listdir(folder)), 1)
+        cache.getMaps(geometry._replace(distance=600.0))
+        self.assertEqual(len(os.listdir(folder)), 2)
+        self.assertEqual(len(cache._items), 1)
+        loaded = cache.getMaps(geometry)
+        self.assertIsNot(loaded, maps)
+        self.assertTrue(numpy.array_equal(loaded['resolution'],
+                                          maps['resolution']))
+
+    def test_radial_profile(self):
+        geometry = pwedconv.Geometry(256, 256, 0.055, 532.2773, 0.0251,
+                                     128.0, 128.0)
+        data = self.ringImage(geometry, 3.669)
+        maps = pwedconv.GeometryCache().getMaps(geometry)
+        bins = maps['radialBins']
+        mask = numpy.zeros(data.shape, dtype=bool)
+        mask[10, 10] = True
+        counts = pwedconv.getBinCounts(bins, len(maps['binResolution']),
+                                       mask)
+        profile = pwedconv.radialProfile(data, bins, counts, mask)
+        k = bins[10, 10]
+        valid = (bins == k) & ~mask
+        self.assertAlmostEqual(profile[k], data[valid].mean())
+
+        scores, count = pwedconv.findIceRings(profile, maps['binResolution'])
+        self.assertEqual(count, 1)
+        self.assertEqual(numpy.nanargmax(scores),
+                         pwedconv.ICE_RINGS.index(3.669))
+        noise = self.ringImage(geometry, 50.0)
+        profile = pwedconv.radialProfile(noise, bins, counts, mask)
+        self.assertEqual(pwedconv.findIceRings(
+            profile, maps['binResolution'])[1], 0)
+
+    def test_beam_center(self):
+        geometry = pwedconv.Geometry(256, 256, 0.055, 532.2773, 0.0251,
+                                     121.3, 133.8)
+        data = self.ringImage(geometry, 3.669).astype(numpy.float64)
+        data[:, 120:126] = 0  # beam stop holder, not symmetric
+        x, y = pwedconv.findBeamCenter(data)
+        self.assertAlmostEqual(x, 121.3, delta=0.2)
+        self.assertAlmostEqual(y, 133.8, delta=0.2)
+        mask = numpy.zeros(data.shape, dtype=bool)
+        mask[:, 120:126] = True
+        x, y = pwedconv.findBeamCenter(data, mask, guess=(125, 130),
+                                       searchRadius=10)
+        self.assertAlmostEqual(x, 121.3, delta=0.2)
+        self.assertAlmostEqual(y, 133.8, delta=0.2)
+
+    def test_rotation_axis(self):
+        rng = numpy.random.default_rng(0)
+        data = rng.poisson(3, (64, 64)).astype(numpy.uint16)
+        data[20, 30] += 100
+        data[20, 31] += 100
+        data[40, 10] += 200
+        x, y, intensity = pwedconv.findPeaks(data)
+        order = numpy.argsort(y)
+        self.assertTrue(numpy.allclose(x[order], [31.0, 10.5], atol=0.1))
+        self.assertTrue(numpy.allclose(y[order], [20.5, 40.5], atol=0.1))
+        mask = numpy.zeros(data.shape, dtype=bool)
+        mask[40, 10] = True
+        self.assertEqual(len(pwedconv.findPeaks(data, mask=mask)[0]), 1)
+        # Sparse frames give the same peaks, also with low counts
+        for lam in [3, 0.05]:
+            data = rng.poisson(lam, (64, 64)).astype(numpy.uint16)
+            data[20, 30:32] += 100
+            data[0, 5] += 100  # not a peak at the border
+            sparse = pwedconv.SparseFrame.fromDense(data)
+            for m in [None, mask]:
+                dense = pwedconv.findPeaks(data, sigma=3, mask=m)
+                found = pwedconv.findPeaks(sparse, sigma=3, mask=m)
+                self.assertEqual(len(found[0]), len(dense[0]))
+                for a, b in zip(found, dense):
+                    self.assertTrue(numpy.allclose(a, b))
+
+        for angle in [0.0, 75.0, 250.0]:
+            x, y, phi, _ = self.latticeSpots(angle, 60)
+            found, scores = pwedconv.estimateRotationAxis(x, y, phi,
+                                                          (131.2, 122.7))
+            self.assertEqual(len(scores), 180)
+            diff = abs(found - angle) % 180
+            self.assertLessEqual(min(diff, 180 - diff), 3.0)
+        self.assertEqual(pwedconv.getAxisVector(90), (0.0, -1.0, 0.0))
+        self.assertEqual(pwedconv.getAxisVector(90, (0, 1, 0)),
+                         (0.0, 1.0, 0.0))
+
+    def test_angle_index(self):
+        setFn = self.getOutputPath('angle-images.sqlite')
+        pw.utils.cleanPath(setFn)
+        imgSet = SetOfDiffractionImages(filename=setFn)
+        for i in range(100):
+            img = DiffractionImage()
+            img.setOscillation(-10.0 + i * 0.5, 0.5)
+            imgSet.append(img)
+        imgSet.write()
+
+        self.assertEqual(imgSet.framesInAngleRange(10, 12),
+                         [41, 42, 43, 44])
+        self.assertEqual(imgSet.framesInAngleRange(12, 10.2),
+                         [41, 42, 43, 44])
+        self.assertEqual(imgSet.framesInAngleRange(100, 110), [])
+        self.assertEqual(imgSet.frameAtAngle(-10.0), 1)
+        self.assertEqual(imgSet.frameAtAngle(10.3), 41)
+        self.assertEqual(imgSet.frameAtAngle(40.0), None)
+        self.assertEqual(imgSet.frameAtAngle(-10.1), None)
+
+        img = DiffractionImage()
+        img.setOscillation(40.0, 0.5)
+        imgSet.append(img)
+        self.assertEqual(imgSet.frameAtAngle(40.0), 101)
+        # Updating an image without changing the size also updates
+        # the index
+        img.setOscillation(50.0, 0.5)
+        imgSet.update(img)
+        self.assertEqual(imgSet.frameAtAngle(40.0), None)
+        self.assertEqual(imgSet.frameAtAngle(50.2), 101)
+
+        with sqlite3.connect(setFn) as db:
+            indexes = [r[0] for r in db.execute(
+                "SELECT name FROM sqlite_master WHERE type='index'")]
+        self.assertIn('index__oscStart', indexes)
+
+    def test_subset_images(self):
+        setFn = self.getOutputPath('subset-images.sqlite')
+        pw.utils.cleanPath(setFn)
+        imgSet = SetOfDiffractionImages(filename=setFn)
+        for i in range(100):
+            img = DiffractionImage()
+            img.setOscillation(i * 0.5, 0.5)
+            img.setIgnore(i % 10 == 9)
+            imgSet.append(img)
+        imgSet.write()
+
+        subset = SubsetOfDiffractionImages()
+        subset.setSelection(imgSet, imgSet.framesInAngleRange(10, 15))
+        self.assertEqual(subset.getSize(), 10)
+        self.assertEqual(subset.getFileName(), setFn)
+        self.assertEqual([img.getObjId() for img in subset],
+                         list(range(21, 31)))
+        self.assertEqual([img.getObjId() for img in
+                          subset.iterItems(where='_ignore=1')], [30])
+        self.assertEqual(subset.getFirstItem().getObjId(), 21)
+        self.assertEqual(subset.frameAtAngle(12.2), 25)
+        self.assertIsNone(subset.frameAtAngle(20.0))
+        self.assertIsNone(subset[31])
+        self.assertEqual(subset[22].getOscillation(), (10.5, 0.5))
+
+        # Many ranges are filtered when reading the rows
+        ids = imgSet.getUniqueValues('id', where='_ignore=0')
+        subset.setSelection(imgSet, ids)
+        self.assertGreater(len(subset.getRanges()[0]),
+                           subset.MAX_SQL_RANGES / 10)
+        subset.MAX_SQL_RANGES = 5
+        self.assertEqual(subset.getSize(), 90)
+        self.assertEqual([img.getObjId() for img in subset], ids)
+        self.assertEqual([img.getObjId() for img in
+                          subset.iterItems(limit=(3, 8))], [9, 11, 12])
+        self.assertEqual(subset.framesInAngleRange(4, 6), [9, 11, 12])
+        self.assertEqual(len(imgSet), 100)
+
+    def test_cbf_escapes(self):
+        formats = pwedconv.formats
+        rng = numpy.random.default_rng(0)
+        # Every difference is escaped, many with 0x80 in their bytes
+        data = rng.integers(-2 ** 20, 2 ** 20, 200000)
+        data[::7] = rng.integers(-2 ** 40, 2 ** 40, len(data[::7]))
+        data[1::5] = 0x8080
+        binary = formats.compressByteOffset(data)
+        t0 = time.time()
+        values = formats.decompressByteOffset(binary, data.size)
+        self.assertLess(time.time() - t0, 2.0)
+        self.assertTrue(numpy.array_equal(values, data))
+
+    def test_cbf(self):
+        formats = pwedconv.formats
+        rng = numpy.random.default_rng(0)
+        data = rng.poisson(1, (20, 30)).astype(numpy.int32)
+        # Differences of 1, 2, 4 and 8 bytes, some with 0x80 in their values
+        data.flat[:8] = [-1, 128, 0x8080, -40000, 0x800080, 2 ** 31 - 1,
+                         -2 ** 31, 0]
+        binary = formats.compressByteOffset(data)
+        values = formats.decompressByteOffset(binary, data.size)
+        self.assertTrue(numpy.array_equal(values, data.ravel()))
+
+        fn = self.getOutputPath('format-image.cbf')
+        header = ('###CBF: VERSION 1.5\n'
+                  '# Detector: PILATUS 300K, S/N 3-0101\n'
+                  '# Pixel_size 172e-6 m x 172e-6 m\n'
+                  '# Exposure_time 0.5000000 s\n'
+                  '# Wavelength 0.0251 A\n'
+                  '# Detector_distance 0.53 m\n'
+                  '# Beam_xy (15.00, 10.50) pixels\n'
+                  '# Start_angle -33.9000 deg.\n'
+                  '# Angle_increment 0.3512 deg.\n'
+                  'X-Binary-Element-Type: "signed 32-bit integer"\n'
+                  'X-Binary-Size: %d\n'
+                  'X-Binary-Size-Fastest-Dimension: 30\n'
+                  'X-Binary-Size-Second-Dimension: 20\n'
+                  '\n' % len(binary))
+        with open(fn, 'wb') as f:
+            f.write(header.encode('ascii') + formats.CbfReader.BINARY_START)
+            f.write(binary)
+
+        reader = formats.getReader(fn)
+        self.assertIsInstance(reader, formats.CbfReader)
+        h = reader.readHeader(fn)
+        self.assertEqual((h['SIZE1'], h['SIZE2']), ('30', '20'))
+        self.assertAlmostEqual(float(h['DISTANCE']), 530)
+        self.assertAlmostEqual(float(h['PIXEL_SIZE']), 0.172)
+        self.assertEqual(h['DETECTOR_SN'], '3-0101')
+        self.assertEqual(h['BEAM_CENTER_Y'], '10.50')
+        self.assertTrue(numpy.array_equal(pwedconv.readImage(fn), data))
+
+    def test_extrapolate_headers(self):
+        pattern = self.writeSmvSweep(self.getOutputPath('sweep'), 40)
+
+        class CountingImporter(DiffractionImageImporter):
+            reads = 0
+
+            def readHeaders(self, imageFiles):
+                CountingImporter.reads += len(imageFiles)
+                return DiffractionImageImporter.readHeaders(self, imageFiles)
+
+        importer = CountingImporter(pattern, headerStride=10)
+        files = importer.getMatchingFiles()
+        fullHeaders = DiffractionImageImporter(pattern).readHeaders(
+            [f for f, _ in files])
+        headers = importer.readSweepHeaders(files)
+        # Only first, last and every 10th header should be read
+        self.assertEqual(CountingImporter.reads, 5)
+        for h, fullH in zip(headers, fullHeaders):
+            self.assertEqual(h['DISTANCE'], fullH['DISTANCE'])
+            self.assertAlmostEqual(float(h['OSC_START']),
+                                   float(fullH['OSC_START']), places=3)
+
+        # If a sampled header is different, all headers should be read
+        h = self.mockHeader()
+        h['SIZE1'] = h['SIZE2'] = '16'
+        h['DISTANCE'] = '100'
+        self.writeSmvImage(files[20][0], h)
+        CountingImporter.reads = 0
+        headers = importer.readSweepHeaders(files)
+        self.assertEqual(CountingImporter.reads, 45)
+        self.assertEqual(headers[20]['DISTANCE'], '100')
+
+    def test_stage_files(self):
+        srcFolder = self.getOutputPath('stage', 'src')
+        pw.utils.makePath(srcFolder)
+        sources = []
+        for i in range(10):
+            fn = os.path.join(srcFolder, 'frame_%d.img' % i)
+            with open(fn, 'wb') as f:
+                f.write(bytes([i]) * 1000)
+            sources.append(fn)
+
+        for action in [pwedconv.STAGE_COPY, pwedconv.STAGE_LINK_ABS,
+                       pwedconv.STAGE_LINK_REL, pwedconv.STAGE_HARDLINK,
+                       pwedconv.STAGE_REFLINK]:
+            dstFolder = self.getOutputPath('stage', action)
+            pairs = [(fn, os.path.join(dstFolder, os.path.basename(fn)))
+                     for fn in sources]
+            progress = []
+            staged = pwedconv.stageFiles(
+                pairs, action, threads=4,
+                progress=lambda done, total: progress.append(done))
+            self.assertEqual(staged, 10)
+            self.assertEqual(progress, list(range(1, 11)))
+            for src, dst in pairs:
+                with open(src, 'rb') as f1, open(dst, 'rb') as f2:
+                    self.assertEqual(f1.read(), f2.read())
+            self.assertEqual(os.path.islink(pairs[0][1]),
+                             action in [pwedconv.STAGE_LINK_ABS,
+                                        pwedconv.STAGE_LINK_REL])
+            # Nothing should be done for already staged files
+            self.assertEqual(pwedconv.stageFiles(pairs, action, threads=4), 0)
+
+        # Changing the action should replace the staged files
+        self.assertEqual(pwedconv.stageFiles(pairs, pwedconv.STAGE_LINK_REL), 10)
+        self.assertTrue(os.path.islink(pairs[0][1]))
+
 
 class TestEdBaseProtocols(pwtests.BaseTest):
     @classmethod
@@ -204,3 +1171,370 @@ class TestEdBaseProtocols(pwtests.BaseTest):
             if img.getObjId() % 10 == 0:
                 self.assertTrue(img.getIgnore())
             self.assertEqual(img.getRotationAxis(), (1000.0, 1000.0, 0.0))
+
+
+class TestEdSyntheticProtocols(SmvDataMixin, pwtests.BaseTest):
+    """ Protocol tests with synthetic data. """
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestProject(cls, writeLocalConfig=True)
+
+    def _runImportSweep(self, n):
+        folder = self.getOutputPath('sweep')
+        pattern = self.writeSmvSweep(folder, n)
+        protImport = self.newProtocol(ProtImportDiffractionImages,
+                                      filesPath=folder,
+                                      filesPattern=os.path.basename(pattern))
+        self.launchProtocol(protImport)
+        return protImport
+
+    def test_import_resume(self):
+        folder = self.getOutputPath('resume')
+        pattern = self.writeSmvSweep(folder, 5)
+        protImport = self.newProtocol(
+            ProtImportDiffractionImages, filesPath=folder,
+            filesPattern=os.path.basename(pattern),
+            importAction=ProtImportDiffractionImages.IMPORT_COPY_FILES)
+        self.launchProtocol(protImport)
+        output = protImport.outputDiffractionImages
+        oldStats = output.getFileStats()
+        staged = [img.getFileName() for img in output.iterItems()]
+        self.assertTrue(all(f.startswith(protImport.getWorkingDir())
+                            for f in staged))
+        # The template names the staged files
+        protImport.loadPatterns()
+        self.assertEqual(protImport._templatePattern,
+                         protImport._getExtraPath('00###.img'))
+        # The stats of the source files are stored, not of the copies
+        for img in output:
+            source = os.path.join(folder, '%05d.img' % img.getObjId())
+            self.assertEqual(img.getFileStat(),
+                             (os.path.getsize(source),
+                              os.path.getmtime(source)))
+
+        # Modify a source frame and continue the import
+        h = dict(self.mockHeader(), SIZE1='16', SIZE2='16',
+                 OSC_START='-33.1976', PHI='-33.1976', DISTANCE='100')
+        modifiedFile = os.path.join(folder, '00003.img')
+        self.writeSmvImage(modifiedFile, h)
+        os.utime(modifiedFile, (0, os.path.getmtime(modifiedFile) + 10))
+        protImport.runMode.set(pwprot.MODE_RESUME)
+        self.launchProtocol(protImport)
+
+        with open(protImport.getLogPaths()[0]) as f:
+            self.assertIn("1 new or modified images, 5 images in total",
+                          f.read())
+        output = protImport.outputDiffractionImages
+        newStats = output.getFileStats()
+        self.assertEqual([i for i in oldStats if oldStats[i] != newStats[i]],
+                         [3])
+        self.assertEqual(output[3].getDistance(), 100)
+        self.assertEqual(output[2].getDistance(), 532.2773)
+
+    def test_pack(self):
+        protImport = self._runImportSweep(6)
+        protPack = self.newProtocol(
+            ProtPackDiffractionImages,
+            compression=ProtPackDiffractionImages.COMPRESS_ZLIB)
+        protPack.inputImages.set(protImport.outputDiffractionImages)
+        self.launchProtocol(protPack)
+
+        inputImages = protImport.outputDiffractionImages
+        output = protPack.outputDiffractionImages
+        self.assertEqual(output.getSize(), 6)
+        for img, packedImg in zip(inputImages, output):
+            self.assertEqual(packedImg.getFileName(),
+                             protPack.getContainerFile())
+            self.assertEqual(packedImg.getOscillation(), img.getOscillation())
+            self.assertTrue(numpy.array_equal(
+                pwedconv.readImage(packedImg.getFileName(),
+                                   packedImg.getIndex()),
+                pwedconv.readImage(img.getFileName())))
+
+    def test_import_events(self):
+        n = 1000
+        events = numpy.zeros(n, dtype=[('x', '<u2'), ('y', '<u2'),
+                                       ('toa', '<u8')])
+        events['x'] = numpy.arange(n) % 512
+        events['toa'] = numpy.arange(n) * 1000  # one event per us
+        eventsFile = self.getOutputPath('events.npy')
+        numpy.save(eventsFile, events)
+
+        protEvents = self.newProtocol(
+            ProtImportEvents, eventsFile=eventsFile, toaUnit=1e-9,
+            frameWidthType=ProtImportEvents.WIDTH_ANGLE, frameAngle=0.1,
+            rotationSpeed=1000.0, oscStart=-30.0)
+        self.launchProtocol(protEvents)
+        output = protEvents.outputDiffractionImages
+        # 1 ms of events, 0.1 ms (0.1 deg) per frame
+        self.assertEqual(output.getSize(), 10)
+        for i, img in enumerate(output):
+            self.assertAlmostEqual(img.getOscillation()[0], -30 + i * 0.1)
+            self.assertEqual(img.getDim(), (512, 512))
+            data = pwedconv.readImage(img.getFileName(), img.getIndex())
+            self.assertEqual(data.sum(), 100)
+
+    def test_pack_gaps(self):
+        def _data(i):
+            data = numpy.full((512, 512), 10 + i % 3, dtype=numpy.uint16)
+            data[2, 256] = 5000
+            return data
+
+        folder = self.getOutputPath('quad')
+        pattern = self.writeSmvSweep(folder, 3, size=512, data=_data)
+        protImport = self.newProtocol(
+            ProtImportDiffractionImages, filesPath=folder,
+            filesPattern=os.path.basename(pattern),
+            detectorGaps=ProtImportDiffractionImages.GAPS_TIMEPIX_QUAD)
+        self.launchProtocol(protImport)
+        protMask = self.newProtocol(ProtBadPixelMask, recompute=True,
+                                    storeMask=False)
+        protMask.inputImages.set(protImport.outputDiffractionImages)
+        self.launchProtocol(protMask)
+        protPack = self.newProtocol(ProtPackDiffractionImages,
+                                    correctGaps=True)
+        protPack.inputImages.set(protMask.outputDiffractionImages)
+        self.launchProtocol(protPack)
+
+        for i, img in enumerate(protPack.outputDiffractionImages, 1):
+            self.assertEqual(img.getDim(), (516, 516))
+            self.assertIsNone(img.getDetector().getGapSpec())
+            self.assertEqual(img.getDetector().getSerialNumber(), '901')
+            data = pwedconv.readImage(img.getFileName(), img.getIndex())
+            self.assertEqual(data.shape, (516, 516))
+            self.assertAlmostEqual(float(data.sum()),
+                                   (10 + i % 3) * (512 * 512 - 1) + 5000, 0)
+            # The mask is corrected like the images: the wide hot pixel
+            # is split in 3
+            mask = img.getDetector().getBadPixelMask()
+            self.assertEqual(mask.shape, (516, 516))
+            self.assertEqual(list(zip(*numpy.nonzero(mask))),
+                             [(2, 258), (2, 259), (2, 260)])
+
+    def test_bin_images(self):
+        protImport = self._runImportSweep(7)
+        protBin = self.newProtocol(ProtBinImages, binning=2, sumFrames=3)
+        protBin.inputImages.set(protImport.outputDiffractionImages)
+        self.launchProtocol(protBin)
+
+        inputImages = [img.clone() for img in
+                       protImport.outputDiffractionImages.iterItems(
+                           orderBy='id')]
+        output = protBin.outputDiffractionImages
+        # The last incomplete group is discarded
+        self.assertEqual(output.getSize(), 2)
+        for img, first in zip(output, inputImages[::3]):
+            start, oscRange = first.getOscillation()
+            self.assertAlmostEqual(img.getOscillation()[0], start)
+            self.assertAlmostEqual(img.getOscillation()[1], 3 * oscRange)
+            self.assertAlmostEqual(img.getPixelSize(),
+                                   2 * first.getPixelSize())
+            self.assertEqual(img.getDim(), (8, 8))
+            data = pwedconv.readImage(img.getFileName(), img.getIndex())
+            self.assertEqual(data.shape, (8, 8))
+
+    def test_background(self):
+        folder = self.getOutputPath('background')
+        pattern = self.writeSmvSweep(
+            folder, 9, data=lambda i: numpy.full((16, 16), i,
+                                                 dtype=numpy.uint16))
+        protImport = self.newProtocol(ProtImportDiffractionImages,
+                                      filesPath=folder,
+                                      filesPattern=os.path.basename(pattern))
+        self.launchProtocol(protImport)
+        protBg = self.newProtocol(
+            ProtEstimateBackground, window=3, blockSize=4,
+            method=ProtEstimateBackground.METHOD_MEAN)
+        protBg.inputImages.set(protImport.outputDiffractionImages)
+        self.launchProtocol(protBg)
+
+        bg = protBg.outputBackground
+        self.assertEqual(bg.getBlockStarts(), [1, 5, 9])
+        # Windows centered on each block: images 1-3, 5-7 and 7-9
+        for imageId, expected in [(2, 2), (5, 6), (8, 6), (9, 8)]:
+            index, fn = bg.getLocation(imageId)
+            data = pwedconv.readImage(fn, index)
+            self.assertTrue(numpy.allclose(data, expected))
+
+    def test_bad_pixel_mask(self):
+        def _data(i):
+            data = numpy.full((16, 16), 10 + i % 3, dtype=numpy.uint16)
+            data[2, 3] = 5000
+            return data
+
+        folder = self.getOutputPath('hot')
+        pattern = self.writeSmvSweep(folder, 5, data=_data)
+        protImport = self.newProtocol(ProtImportDiffractionImages,
+                                      filesPath=folder,
+                                      filesPattern=os.path.basename(pattern))
+        self.launchProtocol(protImport)
+        protMask = self.newProtocol(ProtBadPixelMask, recompute=True,
+                                    storeMask=False)
+        protMask.inputImages.set(protImport.outputDiffractionImages)
+        self.launchProtocol(protMask)
+
+        for img in protMask.outputDiffractionImages:
+            self.assertEqual(img.getDetector().getBadPixelMaskFile(),
+                             protMask.getMaskFile())
+            mask = img.getDetector().getBadPixelMask()
+            self.assertEqual(list(zip(*numpy.nonzero(mask))), [(2, 3)])
+
+    def test_radial_profile(self):
+        h = self.mockHeader()
+        geometry = pwedconv.Geometry(
+            512, 512, float(h['PIXEL_SIZE']), float(h['DISTANCE']),
+            float(h['WAVELENGTH']), float(h['BEAM_CENTER_X']),
+            float(h['BEAM_CENTER_Y']))
+        folder = self.getOutputPath('rings')
+        pattern = self.writeSmvSweep(
+            folder, 3, size=512,
+            data=lambda i: self.ringImage(geometry, 3.897 if i == 2 else 50,
+                                          seed=i))
+        protImport = self.newProtocol(ProtImportDiffractionImages,
+                                      filesPath=folder,
+                                      filesPattern=os.path.basename(pattern))
+        self.launchProtocol(protImport)
+        protProfile = self.newProtocol(ProtRadialProfile)
+        protProfile.inputImages.set(protImport.outputDiffractionImages)
+        self.launchProtocol(protProfile)
+
+        output = protProfile.outputDiffractionImages
+        self.assertEqual([img.getObjId() for img in
+                          output.iterItems(where='_iceRings > 0')], [2])
+        self.assertEqual(protProfile.summary(),
+                         ["1 of 3 images with ice rings."])
+        profiles, binWidth = output.getRadialProfiles()
+        self.assertEqual(profiles.shape[0], 3)
+        self.assertEqual(binWidth, 1.0)
+        for img in output:
+            self.assertEqual(img.getProfileIndex(), img.getObjId() - 1)
+
+    def test_beam_center(self):
+        h = self.mockHeader()
+        geometry = pwedconv.Geometry(
+            512, 512, float(h['PIXEL_SIZE']), float(h['DISTANCE']),
+            float(h['WAVELENGTH']), 228.4, 219.1)
+        folder = self.getOutputPath('center')
+        pattern = self.writeSmvSweep(
+            folder, 4, size=512,
+            data=lambda i: self.ringImage(geometry, 3.669, seed=i))
+        protImport = self.newProtocol(ProtImportDiffractionImages,
+                                      filesPath=folder,
+                                      filesPattern=os.path.basename(pattern))
+        self.launchProtocol(protImport)
+        protCenter = self.newProtocol(ProtFindBeamCenter, imageStep=2)
+        protCenter.inputImages.set(protImport.outputDiffractionImages)
+        self.launchProtocol(protCenter)
+
+        self.assertEqual(protCenter.getCenter()['count'], 2)
+        output = protCenter.outputDiffractionImages
+        self.assertEqual(output.getSize(), 4)
+        for img in output:
+            x, y = img.getBeamCenter()
+            self.assertAlmostEqual(x, 228.4, delta=0.2)
+            self.assertAlmostEqual(y, 219.1, delta=0.2)
+
+        # An empty input is reported before running
+        protSubset = self.newProtocol(ProtSubsetDiffractionImages,
+                                      selectWedge=True, minAngle=100,
+                                      maxAngle=110)
+        protSubset.inputImages.set(protImport.outputDiffractionImages)
+        self.launchProtocol(protSubset)
+        protEmpty = self.newProtocol(ProtFindBeamCenter)
+        protEmpty.inputImages.set(protSubset.outputDiffractionImages)
+        self.assertEqual(protEmpty.validate(),
+                         ["The input set has no images."])
+
+    def test_rotation_axis(self):
+        x, y, _, frame = self.latticeSpots(75.0, 40, center=(128.0, 128.0))
+
+        def _frame(i):
+            data = numpy.full((256, 256), 3, dtype=numpy.uint16)
+            sel = frame == i - 1
+            data[y[sel].astype(int), x[sel].astype(int)] += 100
+            return data
+
+        folder = self.getOutputPath('rotation')
+        pattern = self.writeSmvSweep(
+            folder, 40, oscStart=0.0, oscRange=0.35, size=256, data=_frame,
+            header={'BEAM_CENTER_X': '128.0', 'BEAM_CENTER_Y': '128.0'})
+        protImport = self.newProtocol(ProtImportDiffractionImages,
+                                      filesPath=folder,
+                                      filesPattern=os.path.basename(pattern))
+        self.launchProtocol(protImport)
+        protAxis = self.newProtocol(ProtFindRotationAxis)
+        protAxis.inputImages.set(protImport.outputDiffractionImages)
+        self.launchProtocol(protAxis)
+
+        info = protAxis.getAxis()
+        diff = abs(info['angle'] - 75.0) % 180
+        self.assertLessEqual(min(diff, 180 - diff), 5.0)
+        for img in protAxis.outputDiffractionImages:
+            self.assertTrue(numpy.allclose(img.getRotationAxis(),
+                                           info['axis']))
+
+    def test_find_hits(self):
+        def _frame(i):
+            rng = numpy.random.default_rng(i)
+            data = rng.poisson(2, (64, 64)).astype(numpy.uint16)
+            if i in (2, 5):
+                rows, cols = numpy.mgrid[4:60:8, 4:60:8]
+                data[rows.ravel(), cols.ravel()] += 100
+            return data
+
+        folder = self.getOutputPath('hits')
+        pattern = self.writeSmvSweep(folder, 6, size=64, data=_frame)
+        protImport = self.newProtocol(ProtImportDiffractionImages,
+                                      filesPath=folder,
+                                      filesPattern=os.path.basename(pattern))
+        self.launchProtocol(protImport)
+        protHits = self.newProtocol(ProtFindHits, minPeaks=20)
+        protHits.inputImages.set(protImport.outputDiffractionImages)
+        self.launchProtocol(protHits)
+
+        output = protHits.outputDiffractionImages
+        self.assertEqual([img.getObjId() for img in output], [2, 5])
+        for img in output:
+            self.assertGreaterEqual(img.getPeakCount(), 49)
+
+        # The same hits are found in sparse frames
+        protPack = self.newProtocol(
+            ProtPackDiffractionImages,
+            compression=ProtPackDiffractionImages.COMPRESS_SPARSE)
+        protPack.inputImages.set(protImport.outputDiffractionImages)
+        self.launchProtocol(protPack)
+        protHits = self.newProtocol(ProtFindHits, minPeaks=20)
+        protHits.inputImages.set(protPack.outputDiffractionImages)
+        self.launchProtocol(protHits)
+        self.assertEqual([(img.getObjId(), img.getPeakCount())
+                          for img in protHits.outputDiffractionImages],
+                         [(img.getObjId(), img.getPeakCount())
+                          for img in output])
+
+    def test_subset_images(self):
+        folder = self.getOutputPath('subset')
+        pattern = self.writeSmvSweep(folder, 20, oscStart=0.0,
+                                     oscRange=0.5)
+        protImport = self.newProtocol(ProtImportDiffractionImages,
+                                      filesPath=folder,
+                                      filesPattern=os.path.basename(pattern),
+                                      skipImages=5)
+        self.launchProtocol(protImport)
+        protSubset = self.newProtocol(ProtSubsetDiffractionImages,
+                                      selectWedge=True, minAngle=2.0,
+                                      maxAngle=6.0)
+        protSubset.inputImages.set(protImport.outputDiffractionImages)
+        self.launchProtocol(protSubset)
+
+        output = protSubset.outputDiffractionImages
+        self.assertIsInstance(output, SubsetOfDiffractionImages)
+        self.assertEqual(output.getFileName(),
+                         protImport.outputDiffractionImages.getFileName())
+        # Images 5 and 10 are ignored on import
+        self.assertEqual([img.getObjId() for img in output],
+                         [6, 7, 8, 9, 11, 12])
+        loaded = self.proj.getProtocol(protSubset.getObjId())
+        output = loaded.outputDiffractionImages
+        self.assertEqual(output.getSize(), 6)
+        self.assertEqual([img.getObjId() for img in output],
+                         [6, 7, 8, 9, 11, 12])